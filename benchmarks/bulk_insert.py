@@ -0,0 +1,93 @@
+"""
+Compare the row insert rate of `execute_many` against the COPY based
+`TableDataSource.bulk_create`.
+
+    scripts/benchmark bulk_insert [number of rows]
+
+Runs against `DATABASE_URL`, inside a transaction that is always rolled back.
+"""
+from source import tables
+from source.datasource import TableDataSource
+from source.resources import database
+import asyncio
+import datetime
+import sys
+import time
+import uuid
+
+
+def make_values(count):
+    return [
+        {"name": f"name {idx}", "description": "x" * 40, "score": idx}
+        for idx in range(count)
+    ]
+
+
+async def create_table():
+    query = tables.users.insert()
+    values = {
+        "created_at": datetime.datetime.now(),
+        "last_login": datetime.datetime.now(),
+        "github_id": 0,
+        "username": "benchmark",
+        "is_admin": False,
+        "name": "Benchmark",
+        "avatar_url": "",
+    }
+    user_pk = await database.execute(query, values=values)
+
+    query = tables.table.insert()
+    values = {
+        "created_at": datetime.datetime.now(),
+        "identity": "benchmark",
+        "name": "Benchmark",
+        "user_id": user_pk,
+    }
+    table_pk = await database.execute(query, values=values)
+
+    query = tables.table.select().where(tables.table.c.pk == table_pk)
+    return await database.fetch_one(query)
+
+
+async def insert_execute_many(datasource, values):
+    insert_values = [
+        {
+            "created_at": datetime.datetime.now(),
+            "uuid": str(uuid.uuid4()),
+            "table": datasource.table["pk"],
+            "data": value,
+            "search_text": value["name"],
+        }
+        for value in values
+    ]
+    query = tables.row.insert()
+    await database.execute_many(query, insert_values)
+
+
+async def insert_copy(datasource, values):
+    await datasource.bulk_create(values)
+
+
+async def main(count):
+    await database.connect()
+    try:
+        async with database.transaction(force_rollback=True):
+            table = await create_table()
+            datasource = TableDataSource("benchmark", table, columns=[])
+            values = make_values(count)
+
+            for name, insert in [
+                ("execute_many", insert_execute_many),
+                ("copy", insert_copy),
+            ]:
+                start = time.perf_counter()
+                await insert(datasource, values)
+                elapsed = time.perf_counter() - start
+                print(f"{name:>14}: {count / elapsed:10.0f} rows/sec ({elapsed:.3f}s)")
+    finally:
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    asyncio.run(main(count))
@@ -0,0 +1,88 @@
+"""
+Compare the CPU time spent on the queries for a page of a table, when they
+are built and compiled by SQLAlchemy on every request, against the compiled
+statements used by `source.datasource`.
+
+    scripts/benchmark queries [number of requests]
+
+Runs against `DATABASE_URL`, inside a transaction that is always rolled back.
+"""
+from benchmarks.bulk_insert import create_table, make_values
+from source import datasource, tables
+from source.resources import database
+import asyncio
+import sys
+import time
+
+
+async def request_compiled_queries(table):
+    query = (
+        tables.table.select()
+        .select_from(tables.table.join(tables.users))
+        .where(tables.users.c.username == "benchmark")
+        .where(tables.table.c.identity == table["identity"])
+        .where(tables.table.c.deleted_at.is_(None))
+    )
+    table = await database.fetch_one(query)
+    query = (
+        tables.column.select()
+        .where(tables.column.c.table == table["pk"])
+        .order_by(tables.column.c.position)
+    )
+    await database.fetch_all(query)
+
+    query = tables.row.count().where(tables.row.c.table == table["pk"])
+    await database.fetch_val(query)
+    query = (
+        tables.row.select()
+        .where(tables.row.c.table == table["pk"])
+        .order_by(tables.row.c.created_at, tables.row.c.pk)
+    )
+    rows = await database.fetch_all(query)
+    return [row["data"] for row in rows[:10]]
+
+
+async def request_statements(table):
+    table = await datasource.TABLE_STATEMENT.fetch_one(
+        username="benchmark", identity=table["identity"]
+    )
+    await datasource.COLUMNS_STATEMENT.fetch_all(table_pk=table["pk"])
+
+    filters = (False, False)
+    await datasource.ROW_COUNT_STATEMENTS[filters].fetch_val(table_pk=table["pk"])
+    rows = await datasource.ROW_SELECT_STATEMENTS[filters].fetch_all(
+        table_pk=table["pk"]
+    )
+    return [row["data"] for row in rows[:10]]
+
+
+async def main(count):
+    await database.connect()
+    try:
+        async with database.transaction(force_rollback=True):
+            table = await create_table()
+            table_datasource = datasource.TableDataSource(
+                "benchmark", table, columns=[]
+            )
+            await table_datasource.bulk_create(make_values(50))
+
+            results = []
+            for name, request in [
+                ("compiled", request_compiled_queries),
+                ("statements", request_statements),
+            ]:
+                # Warm up the connection's prepared statements.
+                results.append(await request(table))
+                start = time.process_time()
+                for _ in range(count):
+                    await request(table)
+                elapsed = time.process_time() - start
+                print(f"{name:>14}: {elapsed / count * 1000000:8.0f}µs CPU/request")
+            assert results[0] == results[1]
+    finally:
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    asyncio.run(main(count))
@@ -0,0 +1,65 @@
+"""
+Compare the row validation rate of `typesystem` against the compiled
+`RowValidator`, for a typical uploaded table.
+
+    scripts/benchmark validation [number of rows]
+"""
+from source.csv_utils import get_schema
+from source.validation import RowValidator
+import sys
+import time
+import typesystem
+
+
+IDENTITIES = ["name", "description", "score", "height", "member", "joined"]
+TYPES = ["string", "string", "integer", "float", "boolean", "date"]
+
+
+def make_rows(count):
+    return [
+        {
+            "name": f"name {idx}",
+            "description": "x" * 40,
+            "score": str(idx),
+            "height": f"{idx / 7:.3f}",
+            "member": "true" if idx % 2 else "",
+            "joined": "2020-01-31",
+        }
+        for idx in range(count)
+    ]
+
+
+def validate_typesystem(schema, rows):
+    return [
+        dict(instance)
+        for instance in typesystem.Array(
+            items=typesystem.Reference(to=schema)
+        ).validate(rows)
+    ]
+
+
+def validate_compiled(schema, rows):
+    validator = RowValidator(schema)
+    return [validator.validate(row) for row in rows]
+
+
+def main(count):
+    schema = get_schema(IDENTITIES, TYPES)
+    rows = make_rows(count)
+
+    results = []
+    for name, validate in [
+        ("typesystem", validate_typesystem),
+        ("compiled", validate_compiled),
+    ]:
+        start = time.perf_counter()
+        results.append(validate(schema, rows))
+        elapsed = time.perf_counter() - start
+        print(f"{name:>14}: {count / elapsed:10.0f} rows/sec ({elapsed:.3f}s)")
+
+    assert results[0] == results[1]
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    main(count)
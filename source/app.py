@@ -4,8 +4,10 @@ from starlette.middleware import Middleware
 from starlette.middleware.httpsredirect import HTTPSRedirectMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
-from source import endpoints, settings
-from source.resources import database, statics, templates
+from source import endpoints, jobs, settings
+from source.middleware import DatabaseMiddleware
+from source.resources import database, process_pool, statics, templates
+from source.response_cache import response_cache
 from source.auth.routes import routes as auth_routes
 from source.mock_github.routes import routes as github_routes
 import httpx
@@ -20,7 +22,13 @@ routes = [
     Route("/{username}/tables/{table_id}/columns", endpoints.columns, name="columns", methods=["GET", "POST"]),
     Route("/{username}/tables/{table_id}/delete", endpoints.delete_table, name="delete-table", methods=["POST"]),
     Route("/{username}/tables/{table_id}/upload", endpoints.upload, name="upload", methods=["POST"]),
+    Route("/{username}/tables/{table_id}/upload/{token}", endpoints.upload_preview, name="upload-preview", methods=["GET", "POST"]),
+    Route("/{username}/tables/{table_id}/chunked-uploads", endpoints.chunked_uploads, name="chunked-uploads", methods=["POST"]),
+    Route("/{username}/tables/{table_id}/chunked-uploads/{token}", endpoints.chunked_upload, name="chunked-upload", methods=["GET", "POST"]),
+    Route("/{username}/tables/{table_id}/chunked-uploads/{token}/{index:int}", endpoints.upload_chunk, name="upload-chunk", methods=["PUT"]),
+    Route("/{username}/tables/{table_id}/jobs/{job_id:int}", endpoints.job, name="job", methods=["GET"]),
     Route("/{username}/tables/{table_id}/columns/{column_id}/delete", endpoints.delete_column, name="delete-column", methods=["POST"]),
+    Route("/{username}/tables/{table_id}/columns/{column_id}/retype", endpoints.retype_column, name="retype-column", methods=["POST"]),
     Route("/{username}/tables/{table_id}/{row_uuid}", endpoints.detail, name="detail", methods=["GET", "POST"]),
     Route("/{username}/tables/{table_id}/{row_uuid}/delete", endpoints.delete_row, name="delete-row", methods=["POST"]),
     Mount("/static", statics, name="static"),
@@ -59,7 +67,21 @@ if settings.HTTPS_ONLY:  # pragma: nocover
     middleware += [Middleware(HTTPSRedirectMiddleware)]
 
 middleware += [
-    Middleware(SessionMiddleware, secret_key=settings.SECRET, https_only=settings.HTTPS_ONLY)
+    Middleware(SessionMiddleware, secret_key=settings.SECRET, https_only=settings.HTTPS_ONLY),
+    # Static files don't use the database, and the OAuth callback records
+    # the user's login on a GET request. Uploads, and chunks of uploads,
+    # stream their request body, so they mustn't hold a connection for the
+    # whole of the transfer.
+    Middleware(
+        DatabaseMiddleware,
+        database=database,
+        exclude_paths=["/static/", "/auth/"],
+        exclude_patterns=[
+            r"/[^/]+/tables/[^/]+/upload",
+            r"/[^/]+/tables/[^/]+/chunked-uploads/[^/]+/\d+",
+        ],
+        write_window=settings.REPLICA_WRITE_WINDOW,
+    ),
 ]
 
 exception_handlers = {
@@ -72,6 +94,11 @@ app = Starlette(
     routes=routes,
     middleware=middleware,
     exception_handlers=exception_handlers,
-    on_startup=[database.connect],
-    on_shutdown=[database.disconnect],
+    on_startup=[database.connect, response_cache.connect, jobs.startup],
+    on_shutdown=[
+        jobs.shutdown,
+        response_cache.disconnect,
+        database.disconnect,
+        process_pool.shutdown,
+    ],
 )
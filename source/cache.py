@@ -0,0 +1,104 @@
+"""
+An in-process cache for the results of table queries.
+
+Entries are keyed by the table's write version, as well as the shape of the
+query, so there's no need to invalidate them explicitly. Once a table
+changes, requests load the new version and no longer match the old entries,
+which are evicted as they become the least recently used.
+
+The cache is bounded by the estimated size of its values, rather than by the
+number of entries, since a single entry may hold anything from a row count
+to a full table export.
+"""
+import asyncio
+import collections
+import contextvars
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        Return the cached value for the key, or `None` if there isn't one.
+        """
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key][0]
+
+    def set(self, key, value, size):
+        """
+        Store a value, given its estimated size in bytes, evicting the least
+        recently used entries as needed. Values larger than the whole cache
+        aren't stored.
+        """
+        if size > self.max_size:
+            return
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def evict(self, predicate):
+        """
+        Remove any entries with keys that match the predicate.
+        """
+        for key in [key for key in self.entries if predicate(key)]:
+            self.size -= self.entries.pop(key)[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_size,
+        }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key, so that only the first
+    call runs, and any others made while it is in flight share its result.
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    async def run(self, key, func, context=None):
+        """
+        Return the result of `func()`, or of the call already in flight with
+        the same key.
+
+        The call runs in a copy of the first caller's context, unless another
+        `context` is given, so that it needn't share anything that belongs to
+        the first caller, such as a database connection.
+        """
+        future = self.calls.get(key)
+        if future is None:
+            # The call runs as a task of its own, so that it completes for
+            # any other callers even if the first caller is cancelled.
+            if context is None:
+                context = contextvars.copy_context()
+            future = context.run(asyncio.ensure_future, func())
+            self.calls[key] = future
+            future.add_done_callback(lambda _: self.calls.pop(key, None))
+        return await asyncio.shield(future)
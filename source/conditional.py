@@ -0,0 +1,57 @@
+from email.utils import format_datetime
+import datetime
+import hashlib
+
+
+def get_etag(request, version):
+    """
+    Return an ETag for a response, derived from the table's write version
+    and the parts of the request that determine the response content.
+    """
+    content = "|".join(
+        [
+            str(version),
+            request.url.path,
+            request.url.query,
+            request.headers.get("Accept", ""),
+        ]
+    )
+    digest = hashlib.md5(content.encode("utf-8")).hexdigest()
+    return f'"{version}-{digest[:16]}"'
+
+
+def get_last_modified(table):
+    """
+    Return the time that a table's rows or columns last changed, as an HTTP
+    date. Tables that have not changed since they were created have no
+    `updated_at` time.
+    """
+    modified = table["updated_at"] or table["created_at"]
+    return format_datetime(modified.astimezone(datetime.timezone.utc), usegmt=True)
+
+
+def get_headers(request, table):
+    return {
+        "ETag": get_etag(request, table["version"]),
+        "Last-Modified": get_last_modified(table),
+        "Vary": "Accept, Cookie",
+    }
+
+
+def is_not_modified(request, etag):
+    """
+    Determine if the client's cached response, given by the `If-None-Match`
+    header, is still current.
+    """
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
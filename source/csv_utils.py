@@ -1,6 +1,59 @@
 from collections import Counter
+from dataclasses import dataclass
 from slugify import slugify
+from source.validation import RowValidator
+import chardet
+import codecs
+import contextlib
+import csv
+import datetime
+import gzip
+import io
+import itertools
+import re
 import typesystem
+import typing
+import zipfile
+
+
+# The number of bytes at the start of a file used to determine its encoding.
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+# The number of non-blank rows at the start of a file used to determine how
+# the table should be normalized.
+NORMALIZE_SAMPLE_SIZE = 10000
+
+# CSV files are imported in blocks of roughly this many characters, each
+# ending on a row boundary, so that the blocks can be parsed independently.
+CSV_BLOCK_SIZE = 1024 * 1024
+
+# Matches the complete rows at the start of some CSV text, in the default
+# dialect that files are read with. Quoted values may contain delimiters and
+# line breaks, and a quote anywhere else in a value is an ordinary character.
+CSV_FIELD = r'(?:"[^"]*(?:""[^"]*)*"(?:[^",\r\n][^,\r\n]*)?|[^",\r\n][^,\r\n]*|)'
+CSV_ROWS_PATTERN = re.compile(r"(?:%s(?:,%s)*(?:\r\n|\r|\n))*" % (CSV_FIELD, CSV_FIELD))
+
+# The number of bytes at the start of a file that are parsed to preview it,
+# and the number of rows that are displayed.
+PREVIEW_SIZE = 1024 * 1024
+PREVIEW_ROWS = 10
+
+
+@dataclass
+class TableLayout:
+    names: typing.List[str]
+    identities: typing.List[str]
+    types: typing.List[str]
+    row_count: int
+
+
+@dataclass
+class TablePreview:
+    names: typing.List[str]
+    identities: typing.List[str]
+    types: typing.List[str]
+    rows: typing.List[typing.List[str]]
+    is_truncated: bool
 
 
 def normalize_length(row, length):
@@ -12,74 +65,450 @@ def normalize_length(row, length):
     return row
 
 
-def normalize_table(rows):
-    # Strip all leading/trailing whitespace.
-    rows = [[item.strip() for item in row] for row in rows]
+@dataclass
+class Normalization:
+    """
+    How the rows of a table are normalized, as decided from a sample of them.
+    """
 
-    # Remove any rows that only have blank values.
-    rows = [row for row in rows if any(row)]
+    length: int
+    keep_columns: typing.Optional[typing.List[int]]
+
+    def transform(self, row):
+        row = normalize_length(row, self.length)
+        if self.keep_columns is not None:
+            row = [row[idx] for idx in self.keep_columns]
+        return row
+
+
+def iter_stripped_rows(rows):
+    """
+    Strip all leading/trailing whitespace from each row, and skip any rows
+    that only have blank values.
+    """
+    for row in rows:
+        row = [item.strip() for item in row]
+        if any(row):
+            yield row
+
+
+def determine_normalization(sample):
+    """
+    Decide how to normalize a table from a sample of its stripped, non-blank
+    rows. Returns the normalization, and the index of the sample row that the
+    table starts from.
+    """
+    # In a single pass, count the row lengths, and find which columns
+    # have any non-blank values.
+    length_counter = Counter()
+    populated_columns = set()
+    for row in sample:
+        length_counter[len(row)] += 1
+        populated_columns.update([idx for idx, item in enumerate(row) if item])
 
     # Normalize so that all rows have the same length.
     # To determine the best column length, we pick the most common case.
-    length = len(rows[0])
-    length_counter = Counter([len(row) for row in rows])
-    most_common_lengths = length_counter.most_common()
-    if len(most_common_lengths) > 1:
-        length, count = most_common_lengths[0]
-        rows = [normalize_length(row, length) for row in rows]
+    length, count = length_counter.most_common(1)[0]
 
     # Strip out any columns that only have blank values.
-    blank_columns = set([idx for idx in range(length)])
-    for row in rows:
-        for idx, item in enumerate(row):
-            # If a column has a non-empty value, then remove it from the
-            # 'blank_columns' set.
-            if idx in blank_columns and item:
-                blank_columns.remove(idx)
-                if not blank_columns:
-                    # We can skip out early if there's nothing left in our
-                    # blank columns set.
-                    break
-
-    if blank_columns:
-        rows = [
-            [item for idx, item in enumerate(row) if idx not in blank_columns]
-            for row in rows
-        ]
+    keep_columns = [idx for idx in range(length) if idx in populated_columns]
+    if len(keep_columns) == length:
+        keep_columns = None
+    normalization = Normalization(length=length, keep_columns=keep_columns)
 
     # Start from the first completely populated row.
-    starting_idx = 0
-    for idx, row in enumerate(rows):
-        if all([item for item in row]):
-            starting_idx = idx
-            break
+    for idx, row in enumerate(sample):
+        if all(normalization.transform(row)):
+            return normalization, idx
+    return normalization, 0
+
 
-    return rows[starting_idx:]
+def iter_normalized_rows(rows, sample_size=NORMALIZE_SAMPLE_SIZE):
+    """
+    Normalize a stream of rows, yielding each row as it is transformed.
+
+    How to normalize the table is decided from a sample of the first non-blank
+    rows. The rest of the rows are then streamed through the same
+    transformation, so that arbitrarily large files never need to be held in
+    memory. For tables no longer than the sample, this is exactly equivalent
+    to normalizing the whole table at once.
+    """
+    rows = iter_stripped_rows(rows)
+    sample = list(itertools.islice(rows, sample_size))
+    if not sample:
+        return
+
+    normalization, starting_idx = determine_normalization(sample)
+    for row in itertools.chain(sample[starting_idx:], rows):
+        yield normalization.transform(row)
+
+
+def normalize_table(rows):
+    return list(iter_normalized_rows(rows, sample_size=max(len(rows), 1)))
 
 
 def determine_column_identities(rows):
     return [slugify(name, to_lower=True) for name in rows[0]]
 
 
+def get_field(datatype):
+    if datatype == "integer":
+        return typesystem.Integer(allow_null=True)
+    elif datatype == "float":
+        return typesystem.Float(allow_null=True)
+    elif datatype == "boolean":
+        return typesystem.Boolean(allow_null=True)
+    elif datatype == "date":
+        return typesystem.Date(allow_null=True)
+    return typesystem.String(allow_blank=True)
+
+
+def get_schema(identities, column_types):
+    fields = {
+        identity: get_field(datatype)
+        for identity, datatype in zip(identities, column_types)
+    }
+    return type("Schema", (typesystem.Schema,), fields)
+
+
+INTEGER_REGEX = re.compile(r"[-+]?\d+")
+FLOAT_REGEX = re.compile(r"[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d{1,2})?")
+DATE_REGEX = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+def is_boolean(value):
+    return value.lower() in ("true", "false")
+
+
+def is_date(value):
+    if DATE_REGEX.fullmatch(value) is None:
+        return False
+    try:
+        datetime.date.fromisoformat(value)
+    except ValueError:
+        return False
+    return True
+
+
+# Cheap checks for whether a non-blank string value fits each column type.
+# These are stricter than the corresponding typesystem fields, so any value
+# that passes will also validate.
+TYPE_CHECKS = {
+    "boolean": is_boolean,
+    "integer": INTEGER_REGEX.fullmatch,
+    "float": FLOAT_REGEX.fullmatch,
+    "date": is_date,
+}
+
+# The types that a column may be widened to when some values don't fit its
+# current type, from most to least specific. Columns start out with a type
+# of `None`, until they have any non-blank values.
+WIDER_TYPES = {
+    None: ["boolean", "integer", "float", "date", "string"],
+    "boolean": ["string"],
+    "integer": ["float", "string"],
+    "float": ["string"],
+    "date": ["string"],
+}
+
+# The number of rows that column types are checked against at a time.
+TYPE_CHUNK_SIZE = 10000
+
+
+def determine_column_type(values, datatype=None):
+    """
+    Return the most specific type that fits all the given values, as well as
+    all the values previously seen for the column, which fit `datatype`.
+    """
+    values = [value for value in values if value]
+    if not values or datatype == "string":
+        return datatype
+    if datatype is not None and all(map(TYPE_CHECKS[datatype], values)):
+        return datatype
+    for candidate in WIDER_TYPES[datatype]:
+        if candidate == "string" or all(map(TYPE_CHECKS[candidate], values)):
+            return candidate
+
+
+def determine_chunk_types(column_types, rows):
+    """
+    Return the column types, widened as needed to fit a chunk of rows.
+    """
+    if not rows:
+        return column_types
+    columns = zip(*rows)
+    return [
+        determine_column_type(values, datatype)
+        for values, datatype in zip(columns, column_types)
+    ]
+
+
+def merge_column_type(datatype, other):
+    """
+    Return the most specific type that fits all the values fitting either of
+    two types, such as when combining the types determined for two chunks.
+    """
+    if other is None or other == datatype:
+        return datatype
+    elif datatype is None:
+        return other
+    elif other in WIDER_TYPES.get(datatype, []):
+        return other
+    elif datatype in WIDER_TYPES.get(other, []):
+        return datatype
+    return "string"
+
+
+def merge_column_types(column_types, other_types):
+    return [
+        merge_column_type(datatype, other)
+        for datatype, other in zip(column_types, other_types)
+    ]
+
+
 def determine_column_types(rows):
-    identities = determine_column_identities(rows)
-
-    candidate_types = [("integer", typesystem.Integer(allow_null=True))]
-    column_types = []
-    fields = {}
-    for idx, identity in enumerate(identities):
-        column = [row[idx] for row in rows[1:] if row[idx]]
-
-        for name, candidate in candidate_types:
-            list_validator = typesystem.Array(items=candidate)
-            validated, errors = list_validator.validate_or_error(column)
-            if not errors:
-                column_types.append(name)
-                fields[identity] = candidate
-                break
-        else:
-            column_types.append("string")
-            fields[identity] = candidate = typesystem.String(allow_blank=True)
+    """
+    Determine the most specific type that fits all the non-blank values in
+    each column. Accepts any iterable of rows, with the header row first.
+
+    Types are decided from an initial chunk of rows, and each following chunk
+    only needs to be checked against the types decided so far, which is
+    cheap in the common case that they all fit.
+    """
+    rows = iter(rows)
+    identities = determine_column_identities([next(rows)])
+
+    column_types = [None for identity in identities]
+    chunk = list(itertools.islice(rows, TYPE_CHUNK_SIZE))
+    while chunk:
+        column_types = determine_chunk_types(column_types, chunk)
+        chunk = list(itertools.islice(rows, TYPE_CHUNK_SIZE))
 
-    schema = type("Schema", (typesystem.Schema,), fields)
+    column_types = [datatype or "string" for datatype in column_types]
+    schema = get_schema(identities, column_types)
     return column_types, schema
+
+
+def detect_encoding(sample: bytes) -> str:
+    """
+    Determine the encoding of a file, given a sample from the start of it.
+
+    UTF-8 is by far the most common case, and is cheap to validate, so we try
+    that first and only fall back to the much slower `chardet` if it fails.
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    try:
+        # An incremental decoder allows for the sample ending part way
+        # through a multi-byte character.
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+    except UnicodeDecodeError:
+        return chardet.detect(sample)["encoding"]
+    return "utf-8"
+
+
+@contextlib.contextmanager
+def open_upload(path: str) -> typing.Iterator[typing.BinaryIO]:
+    """
+    Open an uploaded file for reading, decompressing it as it is read if it
+    is gzipped, or if it is a zip archive, in which case the first CSV file
+    in the archive is used. Compressed files are detected by their content,
+    rather than their file name.
+    """
+    with open(path, "rb") as input_file:
+        magic = input_file.read(4)
+        input_file.seek(0)
+        if magic.startswith(b"\x1f\x8b"):
+            with gzip.GzipFile(fileobj=input_file) as gzip_file:
+                yield gzip_file
+        elif magic in (b"PK\x03\x04", b"PK\x05\x06"):
+            with zipfile.ZipFile(input_file) as archive:
+                names = [
+                    info.filename for info in archive.infolist() if not info.is_dir()
+                ]
+                names.sort(key=lambda name: not name.lower().endswith(".csv"))
+                if not names:
+                    yield io.BytesIO(b"")
+                    return
+                with archive.open(names[0]) as member:
+                    yield member
+        else:
+            yield input_file
+
+
+def open_text(
+    input_file: typing.BinaryIO, errors: str = "strict"
+) -> typing.Tuple[typing.TextIO, str]:
+    """
+    Return a text file that decodes a binary file incrementally, along with
+    its encoding, which is detected from a sample at the start of the file.
+    """
+    sample = input_file.read(ENCODING_SAMPLE_SIZE)
+    input_file.seek(0)
+    encoding = detect_encoding(sample)
+    text_file = io.TextIOWrapper(
+        input_file, encoding=encoding, errors=errors, newline=""
+    )
+    return text_file, encoding
+
+
+def get_decode_error(encoding: str, line_num: int) -> ValueError:
+    return ValueError(
+        f"The uploaded file isn't valid {encoding} text, after line {line_num}. "
+        "Save it as UTF-8 and upload it again."
+    )
+
+
+def read_csv(
+    input_file: typing.BinaryIO, errors: str = "strict"
+) -> typing.Iterator[typing.List[str]]:
+    """
+    Return a CSV reader for a binary file, which is decoded incrementally.
+
+    If any bytes later in the file can't be decoded with the encoding detected
+    from the start of it, a `ValueError` is raised rather than corrupting the
+    text, unless `errors` says otherwise.
+    """
+    text_file, encoding = open_text(input_file, errors=errors)
+    reader = csv.reader(text_file)
+    try:
+        yield from reader
+    except UnicodeDecodeError:
+        raise get_decode_error(encoding, reader.line_num) from None
+
+
+def iter_csv_blocks(input_file: typing.BinaryIO) -> typing.Iterator[str]:
+    """
+    Read a CSV file as blocks of text, each of which ends on a row boundary,
+    so that the blocks can be parsed independently, in the process pool.
+
+    Finding the row boundaries only needs a regular expression, rather than
+    parsing the rows. The first block has at least `NORMALIZE_SAMPLE_SIZE`
+    lines, if the file does, so that the table's normalization can be decided
+    from it. The file is decoded strictly, as with `read_csv`.
+    """
+    text_file, encoding = open_text(input_file)
+    min_lines = NORMALIZE_SAMPLE_SIZE
+    line_num = 0
+    pending = ""
+    while True:
+        try:
+            text = text_file.read(CSV_BLOCK_SIZE)
+        except UnicodeDecodeError:
+            raise get_decode_error(encoding, line_num) from None
+        if not text:
+            break
+        line_num += text.count("\n")
+        pending += text
+        if min_lines and pending.count("\n") < min_lines:
+            continue
+        end = CSV_ROWS_PATTERN.match(pending).end()
+        if end:
+            yield pending[:end]
+            pending = pending[end:]
+            min_lines = 0
+    if pending:
+        yield pending
+
+
+def parse_csv_block(text: str) -> typing.List[typing.List[str]]:
+    """
+    Parse a block of CSV text, returning its stripped, non-blank rows.
+    """
+    return list(iter_stripped_rows(csv.reader(io.StringIO(text, newline=""))))
+
+
+def determine_csv_header(
+    text: str,
+) -> typing.Tuple[typing.Optional[Normalization], typing.List[str], int]:
+    """
+    Decide how to normalize a CSV file from its first block. Returns the
+    normalization, the header row, and the number of rows in the block up to
+    and including the header. The header is empty if the block has no rows.
+    """
+    sample = parse_csv_block(text)[:NORMALIZE_SAMPLE_SIZE]
+    if not sample:
+        return None, [], 0
+    normalization, starting_idx = determine_normalization(sample)
+    return (
+        normalization,
+        normalization.transform(sample[starting_idx]),
+        starting_idx + 1,
+    )
+
+
+def process_csv_block(
+    func: typing.Callable,
+    args: tuple,
+    normalization: Normalization,
+    skip: int,
+    text: str,
+) -> typing.Tuple[int, int, typing.Any]:
+    """
+    Parse and normalize a block of CSV text, skipping its first `skip` rows,
+    and call `func(*args, rows)` with the rest. Runs in the process pool, and
+    returns the number of rows skipped, the number of rows remaining, and the
+    result.
+    """
+    rows = parse_csv_block(text)
+    skipped = min(skip, len(rows))
+    rows = [normalization.transform(row) for row in rows[skipped:]]
+    return skipped, len(rows), func(*args, rows)
+
+
+def validate_rows(
+    layout: TableLayout, rows: typing.List[typing.List[str]]
+) -> typing.Tuple[typing.List[dict], typing.List[str], typing.List[tuple]]:
+    """
+    Validate a chunk of normalized rows against the table layout, returning
+    the validated data, and the text to search against for each valid row.
+
+    Any invalid rows are skipped, and returned as a list of errors, each of
+    which is an `(index, text)` pair.
+    """
+    validator = RowValidator(get_schema(layout.identities, layout.types))
+    validated_data = []
+    search_texts = []
+    errors = []
+    for idx, row in enumerate(rows):
+        value, error = validator.validate_or_error(dict(zip(layout.identities, row)))
+        if error:
+            errors += [
+                (idx, f"{message.index[0]}: {message.text}")
+                for message in error.messages()
+            ]
+        else:
+            validated_data.append(value)
+            search_texts.append(" ".join(row))
+    return validated_data, search_texts, errors
+
+
+def preview_csv_file(path: str) -> TablePreview:
+    """
+    Determine the columns of an uploaded CSV file, and its first few rows,
+    from a bounded prefix of the file.
+    """
+    with open_upload(path) as input_file:
+        prefix = input_file.read(PREVIEW_SIZE + 1)
+
+    is_truncated = len(prefix) > PREVIEW_SIZE
+    if is_truncated:
+        # Drop the final line, which is most likely incomplete.
+        prefix = prefix[: prefix.rfind(b"\n", 0, PREVIEW_SIZE) + 1]
+
+    # The preview is only shown to the user, so undecodable bytes are simply
+    # replaced. The import itself fails on them.
+    rows = normalize_table(list(read_csv(io.BytesIO(prefix), errors="replace")))
+    if not rows:
+        return TablePreview(
+            names=[], identities=[], types=[], rows=[], is_truncated=is_truncated
+        )
+
+    column_types, schema = determine_column_types(rows)
+    return TablePreview(
+        names=rows[0],
+        identities=determine_column_identities(rows),
+        types=column_types,
+        rows=rows[1 : PREVIEW_ROWS + 1],
+        is_truncated=is_truncated,
+    )
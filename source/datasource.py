@@ -1,17 +1,209 @@
 from starlette.exceptions import HTTPException
-from source.resources import database, url_for
+from source.resources import database, query_cache, url_for
+from source.response_cache import response_cache
 from source import tables
-from sqlalchemy.sql import select
+from source.statements import Statement
+from source.validation import RowValidator
+from sqlalchemy.sql import bindparam, select
 import datetime
+import hashlib
+import json
+import sqlalchemy
 import typesystem
 import uuid
 
 
+# The `row` columns populated by `TableDataSource.bulk_create`, in the order
+# that records are passed to Postgres' COPY protocol.
+ROW_COPY_COLUMNS = [
+    "created_at",
+    "uuid",
+    "table",
+    "data",
+    "search_text",
+    "key",
+    "content_hash",
+]
+
+# Insert many rows at once, from arrays of column values, updating any existing
+# rows with the same key. Rows whose content is unchanged are left untouched.
+ROW_UPSERT_QUERY = """
+INSERT INTO "row" (created_at, uuid, "table", data, search_text, key, content_hash)
+SELECT $1, upload.uuid, $2, upload.data::json, upload.search_text, upload.key,
+    upload.content_hash
+FROM unnest($3::text[], $4::text[], $5::text[], $6::text[], $7::text[])
+    AS upload(uuid, data, search_text, key, content_hash)
+ON CONFLICT ("table", key) DO UPDATE
+SET data = excluded.data,
+    search_text = excluded.search_text,
+    content_hash = excluded.content_hash
+WHERE "row".content_hash IS DISTINCT FROM excluded.content_hash
+"""
+
+ROW_HASHES_QUERY = """
+SELECT key, content_hash FROM "row" WHERE "table" = $1 AND key = ANY($2::text[])
+"""
+
+# The keys of the rows seen during an upload are recorded in a temporary
+# table, so that any rows missing from the upload can be deleted at the end.
+UPLOAD_KEYS_CREATE_QUERY = """
+CREATE TEMPORARY TABLE IF NOT EXISTS upload_key (key text PRIMARY KEY)
+"""
+UPLOAD_KEYS_CLEAR_QUERY = "TRUNCATE upload_key"
+UPLOAD_KEYS_INSERT_QUERY = """
+INSERT INTO upload_key (key) SELECT unnest($1::text[]) ON CONFLICT DO NOTHING
+"""
+UPLOAD_KEYS_DELETE_MISSING_QUERY = """
+DELETE FROM "row"
+WHERE "table" = $1 AND key IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM upload_key WHERE upload_key.key = "row".key)
+"""
+UPLOAD_KEYS_DROP_QUERY = "DROP TABLE IF EXISTS upload_key"
+
+# The queries run on most requests are compiled once, with their parameters
+# bound on each call.
+TABLE_STATEMENT = Statement(
+    tables.table.select()
+    .select_from(tables.table.join(tables.users))
+    .where(tables.users.c.username == bindparam("username"))
+    .where(tables.table.c.identity == bindparam("identity"))
+    .where(tables.table.c.deleted_at.is_(None))
+)
+TABLE_VERSION_STATEMENT = Statement(
+    select(
+        [
+            tables.table.c.pk,
+            tables.table.c.version,
+            tables.table.c.created_at,
+            tables.table.c.updated_at,
+        ]
+    )
+    .select_from(tables.table.join(tables.users))
+    .where(tables.users.c.username == bindparam("username"))
+    .where(tables.table.c.identity == bindparam("identity"))
+    .where(tables.table.c.deleted_at.is_(None))
+)
+COLUMNS_STATEMENT = Statement(
+    tables.column.select()
+    .where(tables.column.c.table == bindparam("table_pk"))
+    .order_by(tables.column.c.position)
+)
+ROW_INSERT_STATEMENT = Statement(
+    tables.row.insert().returning(tables.row.c.pk),
+    column_keys=[
+        "created_at",
+        "uuid",
+        "table",
+        "data",
+        "search_text",
+        "key",
+        "content_hash",
+    ],
+)
+
+
+def filter_rows(query, search, uuid):
+    """
+    Restrict a query to the rows of a table, and optionally to the rows
+    matching a search pattern, or to the row with a given uuid.
+    """
+    query = query.where(tables.row.c.table == bindparam("table_pk"))
+    if search:
+        query = query.where(tables.row.c.search_text.ilike(bindparam("search")))
+    if uuid:
+        query = query.where(tables.row.c.uuid == bindparam("uuid"))
+    return query
+
+
+# Row queries, by whether they are filtered by a search term and by uuid.
+ROW_FILTERS = [(search, uuid) for search in (False, True) for uuid in (False, True)]
+ROW_COUNT_STATEMENTS = {
+    filters: Statement(filter_rows(tables.row.count(), *filters))
+    for filters in ROW_FILTERS
+}
+ROW_SELECT_STATEMENTS = {
+    filters: Statement(
+        filter_rows(tables.row.select(), *filters).order_by(
+            tables.row.c.created_at, tables.row.c.pk
+        )
+    )
+    for filters in ROW_FILTERS
+}
+
+# A rough estimate of the memory used by each cached row, in addition to the
+# length of its text, for bounding the size of the query cache.
+CACHED_ROW_OVERHEAD = 512
+
+
+def get_row_key(key_column, values):
+    """
+    Return the key of a row, as text, or `None` if the table has no key
+    column, or the row has no value for it.
+
+    This matches the `data ->> key_column` text of the stored row data.
+    """
+    if key_column is None:
+        return None
+    value = values.get(key_column)
+    if value is None or value == "":
+        return None
+    elif isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def get_key_expression(key_column):
+    """
+    Return the SQL expression for the key of a stored row, which matches
+    `get_row_key` for the row data.
+    """
+    return sqlalchemy.func.nullif(tables.row.c.data[key_column].as_string(), "")
+
+
+def get_search_text(values):
+    return " ".join([item for item in values.values() if isinstance(item, str)])
+
+
+def get_content_hash(values):
+    """
+    Return a hash of the row data, which is used to detect changed rows
+    without comparing the data itself.
+    """
+    content = json.dumps(values, sort_keys=True, separators=(",", ":"))
+    return hashlib.md5(content.encode("utf-8")).hexdigest()
+
+
+def get_sort_key(value):
+    """
+    Return a key for ordering the values of a column, which may be a mix of
+    types while the column's datatype is being changed. Missing values sort
+    first, then numbers, then anything else, ordered by its text.
+    """
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, str(value))
+
+
+class StoredDate(typesystem.Date):
+    """
+    Dates are stored in the row data as ISO formatted strings, rather than
+    as `datetime.date` instances, so allow either when serializing.
+    """
+
+    def serialize(self, obj):
+        if isinstance(obj, str):
+            return obj
+        return super().serialize(obj)
+
+
 async def load_datasources():
     query = (
         select([tables.table] + [tables.users.c.username])
         .select_from(tables.table.join(tables.users))
         .order_by(tables.table.c.created_at.desc())
+        .where(tables.table.c.deleted_at.is_(None))
     )
     records = await database.fetch_all(query)
     return [
@@ -21,36 +213,90 @@ async def load_datasources():
     ]
 
 
-async def load_datasources_for_user(user):
-    username = user["username"]
+async def load_datasources_for_user(username):
     query = (
         tables.table.select()
+        .select_from(tables.table.join(tables.users))
         .order_by(tables.table.c.created_at.desc())
-        .where(tables.table.c.user_id == user["pk"])
+        .where(tables.users.c.username == username)
+        .where(tables.table.c.deleted_at.is_(None))
     )
     records = await database.fetch_all(query)
     return [TableDataSource(username, table) for table in records if table["identity"]]
 
 
 async def load_datasource_or_404(username, table_identity):
+    table = await TABLE_STATEMENT.fetch_one(username=username, identity=table_identity)
+    if table is None:
+        raise HTTPException(status_code=404)
+
+    columns = await COLUMNS_STATEMENT.fetch_all(table_pk=table["pk"])
+    return TableDataSource(username, table, columns)
+
+
+async def load_table_version(username, table_identity):
+    """
+    Load just the primary key and write version of a table, and the times
+    that it was created and last updated, or `None` if there is no such table.
+
+    This is enough to answer conditional requests, without loading the
+    columns or running any queries against the rows.
+    """
+    return await TABLE_VERSION_STATEMENT.fetch_one(
+        username=username, identity=table_identity
+    )
+
+
+async def bump_table_version(table_pk):
+    """
+    Record that a table's rows or columns have changed, so that any cached
+    responses or query results for the table are no longer used.
+
+    Returns the new version.
+    """
     query = (
-        tables.table.select()
-        .select_from(tables.table.join(tables.users))
-        .where(tables.users.c.username == username)
-        .where(tables.table.c.identity == table_identity)
+        tables.table.update()
+        .where(tables.table.c.pk == table_pk)
+        .values(version=tables.table.c.version + 1, updated_at=datetime.datetime.now())
+        .returning(tables.table.c.version)
     )
+    version = await database.fetch_val(query)
+    await response_cache.invalidate(table_pk)
+    return version
 
-    table = await database.fetch_one(query)
-    if table is None:
-        raise HTTPException(status_code=404)
 
+async def has_duplicate_keys(table_pk, key_column):
+    """
+    Determine if any rows in a table have the same value for a column, in
+    which case it can't be used as the key column.
+    """
+    key = get_key_expression(key_column)
     query = (
-        tables.column.select()
-        .where(tables.column.c.table == table["pk"])
-        .order_by(tables.column.c.position)
+        select([key])
+        .where(tables.row.c.table == table_pk)
+        .where(key.isnot(None))
+        .group_by(key)
+        .having(sqlalchemy.func.count() > 1)
+        .limit(1)
     )
-    columns = await database.fetch_all(query)
-    return TableDataSource(username, table, columns)
+    return await database.fetch_one(query) is not None
+
+
+async def load_datasource_for_table(table_pk):
+    """
+    Load a table by its primary key, or return `None` if it has been deleted.
+    """
+    query = (
+        select([tables.table] + [tables.users.c.username])
+        .select_from(tables.table.join(tables.users))
+        .where(tables.table.c.pk == table_pk)
+        .where(tables.table.c.deleted_at.is_(None))
+    )
+    table = await database.fetch_one(query)
+    if table is None:
+        return None
+    columns = await COLUMNS_STATEMENT.fetch_all(table_pk=table["pk"])
+    return TableDataSource(table["username"], table, columns)
 
 
 class TableDataSource:
@@ -60,11 +306,12 @@ class TableDataSource:
         self.username = username
         self.table = table
         self.columns = columns
+        self.key_column = table["key_column"]
         self.query_limit = None
         self.query_offset = None
         self.uuid_filter = None
         self.search_term = None
-        self.sort_func = None
+        self.sort_column = None
         self.sort_reverse = False
 
         if columns is not None:
@@ -78,7 +325,16 @@ class TableDataSource:
                     fields[column["identity"]] = typesystem.Integer(
                         title=column["name"]
                     )
+                elif column["datatype"] == "float":
+                    fields[column["identity"]] = typesystem.Float(title=column["name"])
+                elif column["datatype"] == "boolean":
+                    fields[column["identity"]] = typesystem.Boolean(
+                        title=column["name"]
+                    )
+                elif column["datatype"] == "date":
+                    fields[column["identity"]] = StoredDate(title=column["name"])
             self.schema = type("Schema", (typesystem.Schema,), fields)
+            self.validator = RowValidator(self.schema)
 
     def limit(self, limit):
         self.query_limit = limit
@@ -93,65 +349,245 @@ class TableDataSource:
         return self
 
     def order_by(self, column, reverse):
-        self.sort_func = lambda row: row["data"][column]
+        self.sort_column = column
         self.sort_reverse = reverse
         return self
 
-    def apply_query_filters(self, query):
-        query = query.where(tables.row.c.table == self.table["pk"])
+    def get_query_filters(self):
+        """
+        Return which filters apply to the rows, and the parameters for the
+        row statements.
+        """
+        filters = (self.search_term is not None, self.uuid_filter is not None)
+        params = {"table_pk": self.table["pk"]}
         if self.search_term is not None:
-            query = query.where(
-                tables.row.c.search_text.ilike("%" + self.search_term + "%")
-            )
+            params["search"] = "%" + self.search_term + "%"
         if self.uuid_filter is not None:
-            query = query.where(tables.row.c.uuid == self.uuid_filter)
-        return query
+            params["uuid"] = self.uuid_filter
+        return filters, params
 
     def filter(self, uuid=None):
         self.uuid_filter = uuid
         return self
 
+    def get_cache_key(self, method):
+        """
+        Identify the results of a query method, for the query cache.
+
+        The table's write version is part of the key, so that results are no
+        longer used once the table has changed.
+        """
+        key = (
+            self.table["pk"],
+            self.table["version"],
+            method,
+            self.search_term,
+            self.uuid_filter,
+        )
+        if method == "count":
+            return key
+        return key + (
+            self.sort_column,
+            self.sort_reverse,
+            self.query_offset,
+            self.query_limit,
+        )
+
     async def count(self):
-        query = tables.row.count()
-        query = self.apply_query_filters(query)
-        return await database.fetch_val(query)
+        cache_key = self.get_cache_key("count")
+        count = query_cache.get(cache_key)
+        if count is None:
+            filters, params = self.get_query_filters()
+            count = await ROW_COUNT_STATEMENTS[filters].fetch_val(**params)
+            query_cache.set(cache_key, count, size=CACHED_ROW_OVERHEAD)
+        return count
 
     async def all(self):
-        query = tables.row.select()
-        query = self.apply_query_filters(query)
-        query = query.order_by(tables.row.c.created_at)
-        rows = await database.fetch_all(query)
-        if self.sort_func is not None:
-            rows = sorted(rows, key=self.sort_func, reverse=self.sort_reverse)
+        cache_key = self.get_cache_key("all")
+        rows = query_cache.get(cache_key)
+        if rows is None:
+            rows = await self.fetch_rows()
+            size = sum(CACHED_ROW_OVERHEAD + len(row["search_text"]) for row in rows)
+            query_cache.set(cache_key, rows, size=size)
+        return [RowDataItem(self.username, self.table, row) for row in rows]
+
+    async def fetch_rows(self):
+        filters, params = self.get_query_filters()
+        rows = await ROW_SELECT_STATEMENTS[filters].fetch_all(**params)
+        if self.sort_column is not None:
+            rows = sorted(
+                rows,
+                key=lambda row: get_sort_key(row["data"].get(self.sort_column)),
+                reverse=self.sort_reverse,
+            )
         if self.query_offset is not None and self.query_limit is not None:
             rows = rows[self.query_offset : self.query_offset + self.query_limit]
-        return [RowDataItem(self.username, self.table, row) for row in rows]
+        return rows
 
     async def get(self):
-        query = tables.row.select()
-        query = self.apply_query_filters(query)
-        row = await database.fetch_one(query)
+        filters, params = self.get_query_filters()
+        row = await ROW_SELECT_STATEMENTS[filters].fetch_one(**params)
         if row is None:
             return
         return RowDataItem(self.username, self.table, row)
 
+    def get_key(self, values):
+        return get_row_key(self.key_column, values)
+
+    async def has_key_conflict(self, values, exclude_uuid=None):
+        """
+        Determine if another row in the table already has the same key.
+        """
+        key = self.get_key(values)
+        if key is None:
+            return False
+        query = (
+            select([tables.row.c.pk])
+            .where(tables.row.c.table == self.table["pk"])
+            .where(tables.row.c.key == key)
+        )
+        if exclude_uuid is not None:
+            query = query.where(tables.row.c.uuid != exclude_uuid)
+        return await database.fetch_one(query) is not None
+
     async def create(self, values):
         insert_values = {
             "created_at": datetime.datetime.now(),
             "uuid": str(uuid.uuid4()),
             "table": self.table["pk"],
             "data": values,
-            "search_text": " ".join(
-                [item for item in values.values() if isinstance(item, str)]
-            ),
+            "search_text": get_search_text(values),
+            "key": self.get_key(values),
+            "content_hash": get_content_hash(values),
         }
-        query = tables.row.insert()
-        return await database.execute(query, values=insert_values)
+        pk = await ROW_INSERT_STATEMENT.fetch_val(**insert_values)
+        await self.bump_version()
+        return pk
+
+    async def bulk_create(self, values, search_texts=None):
+        """
+        Insert many rows at once, using Postgres' binary COPY protocol rather
+        than issuing a separate INSERT statement for each row.
+        """
+        if search_texts is None:
+            search_texts = [get_search_text(value) for value in values]
+
+        created_at = datetime.datetime.now()
+        records = [
+            (
+                created_at,
+                str(uuid.uuid4()),
+                self.table["pk"],
+                json.dumps(value),
+                search_text,
+                self.get_key(value),
+                get_content_hash(value),
+            )
+            for value, search_text in zip(values, search_texts)
+        ]
+
+        async with database.connection() as connection:
+            await connection.raw_connection.copy_records_to_table(
+                tables.row.name, records=records, columns=ROW_COPY_COLUMNS
+            )
+        await self.bump_version()
+
+    async def bulk_upsert(self, values, search_texts, track_keys=False):
+        """
+        Merge many rows into a table with a key column.
+
+        The content hashes of any existing rows with the same keys are
+        compared in bulk, so that only new or changed rows are written. If a
+        key is repeated then the last of those rows is used.
+
+        Returns a summary of the number of rows that were `inserted`,
+        `updated`, or left `unchanged`. If `track_keys` is set then the keys
+        are also recorded, for `delete_missing_rows()`.
+        """
+        records = {}
+        for value, search_text in zip(values, search_texts):
+            row_uuid = str(uuid.uuid4())
+            key = self.get_key(value)
+            records[row_uuid if key is None else key] = (
+                row_uuid,
+                json.dumps(value),
+                search_text,
+                key,
+                get_content_hash(value),
+            )
+
+        keys = [record[3] for record in records.values() if record[3] is not None]
+        async with database.connection() as connection:
+            existing = await connection.raw_connection.fetch(
+                ROW_HASHES_QUERY, self.table["pk"], keys
+            )
+        existing_hashes = {row["key"]: row["content_hash"] for row in existing}
+
+        summary = {"inserted": 0, "updated": 0, "unchanged": 0}
+        changed_records = []
+        for record in records.values():
+            key, content_hash = record[3], record[4]
+            if key not in existing_hashes:
+                summary["inserted"] += 1
+            elif existing_hashes[key] != content_hash:
+                summary["updated"] += 1
+            else:
+                summary["unchanged"] += 1
+                continue
+            changed_records.append(record)
+
+        async with database.connection() as connection:
+            if changed_records:
+                await connection.raw_connection.execute(
+                    ROW_UPSERT_QUERY,
+                    datetime.datetime.now(),
+                    self.table["pk"],
+                    *zip(*changed_records),
+                )
+            if track_keys:
+                await connection.raw_connection.execute(UPLOAD_KEYS_INSERT_QUERY, keys)
+        if changed_records:
+            await self.bump_version()
+        return summary
+
+    async def start_tracking_keys(self):
+        """
+        Start recording the keys of upserted rows. Must be called within the
+        same connection as the upserts.
+        """
+        async with database.connection() as connection:
+            await connection.raw_connection.execute(UPLOAD_KEYS_CREATE_QUERY)
+            await connection.raw_connection.execute(UPLOAD_KEYS_CLEAR_QUERY)
+
+    async def delete_missing_rows(self):
+        """
+        Delete any rows with a key that was not recorded while tracking keys,
+        returning the number of deleted rows.
+        """
+        async with database.connection() as connection:
+            status = await connection.raw_connection.execute(
+                UPLOAD_KEYS_DELETE_MISSING_QUERY, self.table["pk"]
+            )
+        await self.stop_tracking_keys()
+        deleted = int(status.split()[-1])
+        if deleted:
+            await self.bump_version()
+        return deleted
+
+    async def stop_tracking_keys(self):
+        async with database.connection() as connection:
+            await connection.raw_connection.execute(UPLOAD_KEYS_DROP_QUERY)
+
+    async def bump_version(self):
+        """
+        Bump the table's write version after a change, keeping track of the
+        new version so that later queries see the change.
+        """
+        version = await bump_table_version(self.table["pk"])
+        self.table = dict(self.table, version=version)
 
     def validate(self, data):
-        record, errors = self.schema.validate_or_error(data)
-        validated_data = dict(record) if record is not None else None
-        return validated_data, errors
+        return self.validator.validate_or_error(data)
 
 
 class RowDataItem:
@@ -189,12 +625,14 @@ class RowDataItem:
         query = tables.row.update().where(tables.row.c.uuid == self.row["uuid"])
         update_values = {
             "data": values,
-            "search_text": " ".join(
-                [item for item in values.values() if isinstance(item, str)]
-            ),
+            "search_text": get_search_text(values),
+            "key": get_row_key(self.table["key_column"], values),
+            "content_hash": get_content_hash(values),
         }
-        return await database.execute(query, values=update_values)
+        await database.execute(query, values=update_values)
+        await bump_table_version(self.table["pk"])
 
     async def delete(self):
         query = tables.row.delete().where(tables.row.c.uuid == self.row["uuid"])
-        return await database.execute(query)
+        await database.execute(query)
+        await bump_table_version(self.table["pk"])
@@ -1,37 +1,69 @@
 from starlette.exceptions import HTTPException
 from starlette.responses import RedirectResponse, Response, JSONResponse
-from source import ordering, pagination, search, tables
-from source.resources import database, templates
+from source import (
+    conditional,
+    importer,
+    jobs,
+    ordering,
+    pagination,
+    search,
+    settings,
+    tables,
+)
+from source.resources import (
+    database,
+    gather_queries,
+    run_in_process,
+    run_single_flight,
+    templates,
+)
 from source.datasource import (
+    bump_table_version,
+    has_duplicate_keys,
     load_datasources,
     load_datasources_for_user,
     load_datasource_or_404,
+    load_table_version,
 )
 from source.negotiation import negotiate
-from source.csv_utils import (
-    normalize_table,
-    determine_column_types,
-    determine_column_identities,
+from source.response_cache import response_cache
+from source.uploads import (
+    claim_upload,
+    create_chunked_upload,
+    load_chunked_upload_or_404,
+    load_upload_path_or_404,
+    spool_upload,
 )
 from slugify import slugify
-from sqlalchemy import func, select
-import chardet
 import csv
 import datetime
+import functools
 import io
 import json
 import math
+import os
 import typesystem
-import uuid
 
 
 class NewTableSchema(typesystem.Schema):
     name = typesystem.String(max_length=100)
 
 
+class NewChunkedUploadSchema(typesystem.Schema):
+    size = typesystem.Integer(minimum=0, maximum=settings.MAX_CHUNKED_UPLOAD_SIZE)
+
+
+DATATYPES = ["string", "integer", "float", "boolean", "date"]
+
+
 class NewColumnSchema(typesystem.Schema):
     name = typesystem.String(max_length=100)
-    datatype = typesystem.Choice(choices=["string", "integer"])
+    datatype = typesystem.Choice(choices=DATATYPES)
+
+
+class RetypeColumnSchema(typesystem.Schema):
+    datatype = typesystem.Choice(choices=DATATYPES)
+    force = typesystem.Boolean(default=False)
 
 
 def check_can_edit(request, username):
@@ -41,14 +73,58 @@ def check_can_edit(request, username):
     return can_edit
 
 
+def versioned(endpoint):
+    """
+    Serve GET requests for a table, from users who can't edit it, using the
+    table's write version.
+
+    The response carries `ETag` and `Last-Modified` headers, and a request
+    with a matching `If-None-Match` is answered with 304 after a single
+    lookup of the version, before any queries are run against the rows.
+    Otherwise responses for anonymous users may be served from the shared
+    response cache.
+
+    Pages for users who can edit the table are always rendered, since these
+    also report the progress of background jobs, which doesn't change the
+    table's write version.
+    """
+
+    @functools.wraps(endpoint)
+    async def wrapper(request):
+        username = request.path_params["username"]
+        table_id = request.path_params["table_id"]
+        if request.method != "GET" or request.session.get("username") == username:
+            return await endpoint(request)
+
+        table = await load_table_version(username, table_id)
+        if table is None:
+            raise HTTPException(status_code=404)
+        headers = conditional.get_headers(request, table)
+        if conditional.is_not_modified(request, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+
+        async def render():
+            response = await endpoint(request)
+            response.headers.update(headers)
+            return response
+
+        # Pages for logged in users include their username, so only the
+        # responses for anonymous users are shared.
+        if request.session:
+            return await render()
+        return await response_cache.fetch(table["pk"], headers["ETag"], render)
+
+    return wrapper
+
+
 async def dashboard(request):
     datasources = await load_datasources()
+    counts = await gather_queries(*[datasource.count for datasource in datasources])
 
     rows = []
-    for datasource in datasources:
+    for datasource, count in zip(datasources, counts):
         text = datasource.name
         url = datasource.url
-        count = await datasource.count()
         rows.append(
             {"owner": datasource.username, "text": text, "url": url, "count": count}
         )
@@ -66,17 +142,18 @@ async def profile(request):
     can_edit = check_can_edit(request, username)
 
     query = tables.users.select().where(tables.users.c.username == username)
-    profile_user = await database.fetch_one(query)
+    profile_user, datasources = await gather_queries(
+        lambda: database.fetch_one(query), lambda: load_datasources_for_user(username)
+    )
     if profile_user is None:
         raise HTTPException(status_code=404)
 
-    datasources = await load_datasources_for_user(profile_user)
+    counts = await gather_queries(*[datasource.count for datasource in datasources])
 
     rows = []
-    for datasource in datasources:
+    for datasource, count in zip(datasources, counts):
         text = datasource.name
         url = datasource.url
-        count = await datasource.count()
         rows.append({"text": text, "url": url, "count": count})
 
     if request.method == "POST":
@@ -88,6 +165,7 @@ async def profile(request):
                 tables.table.select()
                 .where(tables.table.c.user_id == profile_user["pk"])
                 .where(tables.table.c.identity == identity)
+                .where(tables.table.c.deleted_at.is_(None))
             )
             table = await database.fetch_one(query)
             if table is not None:
@@ -120,6 +198,7 @@ async def profile(request):
     return templates.TemplateResponse(template, context, status_code=status_code)
 
 
+@versioned
 async def table(request):
     PAGE_SIZE = 10
 
@@ -139,11 +218,15 @@ async def table(request):
     # Filter by any search term
     datasource = datasource.search(search_term)
 
-    # Determine pagination info
-    count = await datasource.count()
-    total_pages = max(math.ceil(count / PAGE_SIZE), 1)
-    current_page = max(min(current_page, total_pages), 1)
-    offset = (current_page - 1) * PAGE_SIZE
+    # Identical requests that arrive at the same time, such as when a link to
+    # the table is shared, run each query once between them.
+    flight_key = (
+        "table",
+        request.url.path,
+        request.url.query,
+        can_edit,
+        datasource.table["version"],
+    )
 
     # Perform column ordering
     if order_column is not None:
@@ -152,7 +235,7 @@ async def table(request):
     # Export
     export = request.query_params.get("export")
     if export == "json":
-        queryset = await datasource.all()
+        queryset = await run_single_flight(flight_key + ("all",), datasource.all)
         data = [
             {
                 key: field.serialize(item.get(key))
@@ -166,7 +249,7 @@ async def table(request):
     elif export == "csv":
         output = io.StringIO()
         writer = csv.writer(output)
-        queryset = await datasource.all()
+        queryset = await run_single_flight(flight_key + ("all",), datasource.all)
 
         headers = [field.title for field in datasource.schema.fields.values()]
         writer.writerow(headers)
@@ -178,9 +261,25 @@ async def table(request):
         headers = {"Content-Disposition": f'attachment; filename="{table_id}.csv"'}
         return Response(content, headers=headers)
 
-    #  Perform pagination
-    datasource = datasource.offset(offset).limit(PAGE_SIZE)
-    queryset = await datasource.all()
+    # Count the rows while loading the requested page, which only needs to
+    # be loaded again if the count shows that the page is out of range. The
+    # count and the page are loaded together, so that they always agree.
+    def load_page(offset):
+        page_datasource = datasource.offset(offset).limit(PAGE_SIZE)
+        return run_single_flight(
+            flight_key + ("page", offset),
+            lambda: gather_queries(datasource.count, page_datasource.all),
+        )
+
+    offset = max(current_page - 1, 0) * PAGE_SIZE
+    count, queryset = await load_page(offset)
+
+    # Perform pagination
+    total_pages = max(math.ceil(count / PAGE_SIZE), 1)
+    current_page = max(min(current_page, total_pages), 1)
+    if (current_page - 1) * PAGE_SIZE != offset:
+        offset = (current_page - 1) * PAGE_SIZE
+        count, queryset = await load_page(offset)
 
     # Get pagination and column controls to render on the page
     column_controls = ordering.get_column_controls(
@@ -196,6 +295,8 @@ async def table(request):
     if request.method == "POST":
         form_values = await request.form()
         validated_data, form_errors = datasource.validate(form_values)
+        if not form_errors and await datasource.has_key_conflict(validated_data):
+            form_errors = {datasource.key_column: "A row with this key already exists."}
         if not form_errors:
             await datasource.create(values=validated_data)
             return RedirectResponse(url=request.url, status_code=303)
@@ -225,6 +326,12 @@ async def table(request):
             return JSONResponse(data, headers={"Access-Control-Allow-Origin": "*"})
         json_data = json.dumps(data, indent=4)
 
+    # Report the progress of any background jobs, such as uploads.
+    if can_edit:
+        table_jobs = await jobs.load_jobs_for_table(datasource.table["pk"])
+    else:
+        table_jobs = []
+
     # Render the page
     template = "table.html"
     context = {
@@ -245,6 +352,7 @@ async def table(request):
         "form_errors": form_errors,
         "form_values": form_values,
         "can_edit": can_edit,
+        "jobs": table_jobs,
     }
     return templates.TemplateResponse(template, context, status_code=status_code)
 
@@ -255,34 +363,48 @@ async def columns(request):
     can_edit = check_can_edit(request, username)
     datasource = await load_datasource_or_404(username, table_id)
 
+    key_errors = None
     if request.method == "POST":
         form_values = await request.form()
-        validated_data, form_errors = NewColumnSchema.validate_or_error(form_values)
-        if not form_errors:
-            identity = slugify(validated_data["name"], separator="_", to_lower=True)
-            query = (
-                tables.column.select()
-                .where(tables.column.c.table == datasource.table["pk"])
-                .where(tables.column.c.identity == identity)
-            )
-            column = await database.fetch_one(query)
-            if column is not None:
-                form_errors = {"name": "A column with this name already exists."}
-
-        if not form_errors:
-            position = (
-                1 if not datasource.columns else datasource.columns[-1]["position"] + 1
+        if form_values.get("action") == "set-key":
+            key_errors = await update_key_column(
+                datasource, form_values.get("key_column") or None
             )
-            insert_data = dict(validated_data)
-            insert_data["table"] = datasource.table["pk"]
-            insert_data["created_at"] = datetime.datetime.now()
-            insert_data["identity"] = slugify(
-                insert_data["name"], separator="_", to_lower=True
-            )
-            insert_data["position"] = position
-            query = tables.column.insert()
-            await database.execute(query, values=insert_data)
-            return RedirectResponse(url=request.url, status_code=303)
+            if not key_errors:
+                url = request.url_for("table", username=username, table_id=table_id)
+                return RedirectResponse(url=url, status_code=303)
+            form_values = None
+            form_errors = None
+        else:
+            validated_data, form_errors = NewColumnSchema.validate_or_error(form_values)
+            if not form_errors:
+                identity = slugify(validated_data["name"], separator="_", to_lower=True)
+                query = (
+                    tables.column.select()
+                    .where(tables.column.c.table == datasource.table["pk"])
+                    .where(tables.column.c.identity == identity)
+                )
+                column = await database.fetch_one(query)
+                if column is not None:
+                    form_errors = {"name": "A column with this name already exists."}
+
+            if not form_errors:
+                position = (
+                    1
+                    if not datasource.columns
+                    else datasource.columns[-1]["position"] + 1
+                )
+                insert_data = dict(validated_data)
+                insert_data["table"] = datasource.table["pk"]
+                insert_data["created_at"] = datetime.datetime.now()
+                insert_data["identity"] = slugify(
+                    insert_data["name"], separator="_", to_lower=True
+                )
+                insert_data["position"] = position
+                query = tables.column.insert()
+                await database.execute(query, values=insert_data)
+                await bump_table_version(datasource.table["pk"])
+                return RedirectResponse(url=request.url, status_code=303)
         status_code = 400
     else:
         form_values = None
@@ -298,6 +420,8 @@ async def columns(request):
         "table_name": datasource.name,
         "table_url": datasource.url,
         "columns": datasource.columns,
+        "key_column": datasource.key_column,
+        "key_errors": key_errors,
         "form_errors": form_errors,
         "form_values": form_values,
         "can_edit": can_edit,
@@ -305,22 +429,39 @@ async def columns(request):
     return templates.TemplateResponse(template, context, status_code=status_code)
 
 
+async def update_key_column(datasource, key_column):
+    """
+    Declare the column that uploads are merged on, returning any errors.
+
+    The keys of the existing rows are updated in the background, and the
+    column only becomes the key once they all have been.
+    """
+    if key_column is not None and key_column not in datasource.schema.fields:
+        return {"key_column": "Select a valid column."}
+    if key_column is not None and await has_duplicate_keys(
+        datasource.table["pk"], key_column
+    ):
+        return {"key_column": "This column contains duplicate values."}
+    params = {"column": key_column}
+    await jobs.enqueue("set_key_column", table=datasource.table["pk"], params=params)
+    return None
+
+
 async def delete_table(request):
     username = request.path_params["username"]
     table_id = request.path_params["table_id"]
     can_edit = check_can_edit(request, username)
     datasource = await load_datasource_or_404(username, table_id)
 
-    query = tables.column.delete().where(
-        tables.column.c.table == datasource.table["pk"]
+    # The table is hidden immediately, and its rows are then removed in the
+    # background, since deleting a large table can take a long time.
+    query = (
+        tables.table.update()
+        .where(tables.table.c.pk == datasource.table["pk"])
+        .values(deleted_at=datetime.datetime.now())
     )
     await database.execute(query)
-
-    query = tables.row.delete().where(tables.row.c.table == datasource.table["pk"])
-    await database.execute(query)
-
-    query = tables.table.delete().where(tables.table.c.pk == datasource.table["pk"])
-    await database.execute(query)
+    await jobs.enqueue("purge", table=datasource.table["pk"], params={})
 
     url = request.url_for("profile", username=username)
     return RedirectResponse(url=url, status_code=303)
@@ -333,53 +474,122 @@ async def upload(request):
     datasource = await load_datasource_or_404(username, table_id)
 
     form = await request.form()
-    data = await form["upload-file"].read()
-    encoding = chardet.detect(data)["encoding"]
-    lines = data.decode(encoding).splitlines()
-    rows = normalize_table([row for row in csv.reader(lines)])
-    column_identities = determine_column_identities(rows)
-    column_types, schema = determine_column_types(rows)
-    unvalidated_data = [dict(zip(column_identities, row)) for row in rows[1:]]
-    validated_data = [
-        dict(instance)
-        for instance in typesystem.Array(
-            items=typesystem.Reference(to=schema)
-        ).validate(unvalidated_data, strict=False)
-    ]
-
-    column_insert_values = [
-        {
-            "created_at": datetime.datetime.now(),
-            "name": name,
-            "identity": column_identities[idx],
-            "datatype": column_types[idx],
-            "table": datasource.table["pk"],
-            "position": idx + 1,
-        }
-        for idx, name in enumerate(rows[0])
-    ]
-
-    query = tables.column.insert()
-    await database.execute_many(query, column_insert_values)
-
-    row_insert_values = [
-        {
-            "created_at": datetime.datetime.now(),
-            "uuid": str(uuid.uuid4()),
-            "table": datasource.table["pk"],
-            "data": validated_data[idx],
-            "search_text": " ".join(row),
-        }
-        for idx, row in enumerate(rows[1:])
-    ]
-
-    query = tables.row.insert()
-    await database.execute_many(query, row_insert_values)
+    token = await spool_upload(
+        form["upload-file"], owner=username, table_pk=datasource.table["pk"]
+    )
 
-    url = request.url_for("table", username=username, table_id=table_id)
+    url = request.url_for(
+        "upload-preview", username=username, table_id=table_id, token=token
+    )
     return RedirectResponse(url=url, status_code=303)
 
 
+async def chunked_uploads(request):
+    """
+    Start an upload that will be sent as a series of chunks.
+    """
+    username = request.path_params["username"]
+    table_id = request.path_params["table_id"]
+    can_edit = check_can_edit(request, username)
+    datasource = await load_datasource_or_404(username, table_id)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON.")
+    validated_data, errors = NewChunkedUploadSchema.validate_or_error(data)
+    if errors:
+        return JSONResponse(dict(errors), status_code=400)
+
+    upload = create_chunked_upload(
+        username, datasource.table["pk"], validated_data.size
+    )
+    return JSONResponse(upload.serialize(), status_code=201)
+
+
+async def chunked_upload(request):
+    """
+    Report which chunks of an upload have been received, so that it may be
+    resumed, or complete the upload once all the chunks have been received.
+    """
+    username = request.path_params["username"]
+    table_id = request.path_params["table_id"]
+    token = request.path_params["token"]
+    can_edit = check_can_edit(request, username)
+    if not can_edit:
+        raise HTTPException(status_code=403)
+    datasource = await load_datasource_or_404(username, table_id)
+    upload = load_chunked_upload_or_404(token, username, datasource.table["pk"])
+
+    if request.method == "POST":
+        await upload.assemble()
+        url = request.url_for(
+            "upload-preview", username=username, table_id=table_id, token=token
+        )
+        return JSONResponse({"preview_url": url})
+
+    return JSONResponse(upload.serialize())
+
+
+async def upload_chunk(request):
+    username = request.path_params["username"]
+    table_id = request.path_params["table_id"]
+    token = request.path_params["token"]
+    index = request.path_params["index"]
+    can_edit = check_can_edit(request, username)
+    datasource = await load_datasource_or_404(username, table_id)
+    upload = load_chunked_upload_or_404(token, username, datasource.table["pk"])
+
+    checksum = request.headers.get("X-Checksum-SHA256")
+    if checksum is None:
+        raise HTTPException(status_code=400, detail="Missing checksum.")
+    await upload.save_chunk(index, request.stream(), checksum)
+    return JSONResponse(upload.serialize())
+
+
+async def upload_preview(request):
+    username = request.path_params["username"]
+    table_id = request.path_params["table_id"]
+    token = request.path_params["token"]
+    can_edit = check_can_edit(request, username)
+    if not can_edit:
+        raise HTTPException(status_code=403)
+    datasource = await load_datasource_or_404(username, table_id)
+
+    if request.method == "POST":
+        # The upload has already been spooled, so confirming the import
+        # doesn't need to transfer the file again. If the form is submitted
+        # more than once then the upload has already been claimed, and the
+        # later submissions just redirect.
+        form = await request.form()
+        path = claim_upload(token, username, datasource.table["pk"])
+        if path is not None and form.get("action") == "cancel":
+            os.remove(path)
+        elif path is not None:
+            params = {"path": path, "delete_missing": "delete_missing" in form}
+            await jobs.enqueue("import", table=datasource.table["pk"], params=params)
+        url = request.url_for("table", username=username, table_id=table_id)
+        return RedirectResponse(url=url, status_code=303)
+
+    path = load_upload_path_or_404(token, username, datasource.table["pk"])
+    preview = await run_in_process(importer.preview_upload, path)
+
+    template = "upload.html"
+    context = {
+        "request": request,
+        "owner": username,
+        "table_id": table_id,
+        "table_name": datasource.name,
+        "table_url": datasource.url,
+        "token": token,
+        "key_column": datasource.key_column,
+        "preview": preview,
+        "preview_columns": list(zip(preview.names, preview.identities, preview.types)),
+        "can_edit": can_edit,
+    }
+    return templates.TemplateResponse(template, context)
+
+
 async def delete_column(request):
     username = request.path_params["username"]
     table_id = request.path_params["table_id"]
@@ -397,24 +607,69 @@ async def delete_column(request):
     )
     await database.execute(query)
 
-    # Perform a column count.
-    query = (
-        select([func.count()])
-        .select_from(tables.column)
-        .where(tables.row.c.table == datasource.table["pk"])
-    )
-    column_count = await database.fetch_val(query)
-
-    # If the final column in a table has been deleted, then we should drop
-    # all the data in the table.
-    if column_count == 0:
-        query = tables.row.delete().where(tables.row.c.table == datasource.table["pk"])
+    # Rows can no longer be merged on a deleted key column.
+    is_key = column_id == datasource.key_column
+    if is_key:
+        query = (
+            tables.table.update()
+            .where(tables.table.c.pk == datasource.table["pk"])
+            .values(key_column=None)
+        )
         await database.execute(query)
+    await bump_table_version(datasource.table["pk"])
+
+    # The column's values, and the keys of a key column, are removed from
+    # the rows in the background, or all the rows are deleted if this was the
+    # final column.
+    params = {"column": column_id, "key": is_key}
+    await jobs.enqueue("drop_column", table=datasource.table["pk"], params=params)
 
     url = request.url_for("columns", username=username, table_id=table_id)
     return RedirectResponse(url=url, status_code=303)
 
 
+async def retype_column(request):
+    username = request.path_params["username"]
+    table_id = request.path_params["table_id"]
+    column_id = request.path_params["column_id"]
+    can_edit = check_can_edit(request, username)
+    datasource = await load_datasource_or_404(username, table_id)
+    if column_id not in datasource.schema.fields:
+        raise HTTPException(status_code=404)
+    if column_id == datasource.key_column:
+        raise HTTPException(status_code=400)
+
+    form = await request.form()
+    validated_data, form_errors = RetypeColumnSchema.validate_or_error(form)
+    if form_errors:
+        raise HTTPException(status_code=400)
+
+    # The existing values are checked and converted in the background, and
+    # the column only takes on the new datatype once they all have been.
+    params = {
+        "column": column_id,
+        "datatype": validated_data["datatype"],
+        "force": validated_data["force"],
+    }
+    await jobs.enqueue("retype_column", table=datasource.table["pk"], params=params)
+
+    url = request.url_for("table", username=username, table_id=table_id)
+    return RedirectResponse(url=url, status_code=303)
+
+
+async def job(request):
+    username = request.path_params["username"]
+    table_id = request.path_params["table_id"]
+    job_id = request.path_params["job_id"]
+    can_edit = check_can_edit(request, username)
+    if not can_edit:
+        raise HTTPException(status_code=403)
+    datasource = await load_datasource_or_404(username, table_id)
+    job = await jobs.load_job_or_404(datasource.table["pk"], job_id)
+    return JSONResponse(job.serialize())
+
+
+@versioned
 async def detail(request):
     username = request.path_params["username"]
     table_id = request.path_params["table_id"]
@@ -429,6 +684,10 @@ async def detail(request):
     if request.method == "POST":
         form_values = await request.form()
         validated_data, form_errors = datasource.validate(form_values)
+        if not form_errors and await datasource.has_key_conflict(
+            validated_data, exclude_uuid=item.uuid
+        ):
+            form_errors = {datasource.key_column: "A row with this key already exists."}
         if not form_errors:
             await item.update(values=validated_data)
             return RedirectResponse(url=request.url, status_code=303)
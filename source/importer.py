@@ -0,0 +1,373 @@
+"""
+Import uploaded files into a table. Runs as a background job.
+
+Imports make two passes over the uploaded file. The first determines the
+column layout, and the second validates and inserts the rows, so that the
+file is never held in memory all at once.
+
+In both passes the rows are processed in chunks, which are farmed out to the
+process pool, with several chunks in flight at once. The results for each
+chunk are then merged back together. CSV files are only split into blocks of
+whole rows in a thread, and parsed in the process pool, so that parsing large
+files doesn't compete with the event loop.
+
+Uploads may either be CSV, or JSON containing a list of objects, or newline
+delimited JSON. For JSON uploads the column names are taken from the object
+keys, in the order that they first appear.
+
+Tables that declare a key column merge uploaded rows into any existing row
+with the same key, rather than adding a new row, so that a dataset can be
+refreshed by uploading it again. Each row stores a hash of its content, so
+only new or changed rows are written, and rows that are missing from the
+upload may optionally be deleted. The job records a summary of the changes.
+"""
+from starlette.concurrency import run_in_threadpool
+from source import tables
+from source.csv_utils import (
+    TableLayout,
+    determine_chunk_types,
+    determine_column_identities,
+    determine_csv_header,
+    iter_csv_blocks,
+    merge_column_types,
+    open_upload,
+    preview_csv_file,
+    process_csv_block,
+    validate_rows,
+)
+from source.json_utils import (
+    determine_record_types,
+    get_layout,
+    is_json_file,
+    iter_json_records,
+    merge_record_types,
+    preview_json_file,
+    validate_records,
+)
+from source.datasource import load_datasource_for_table
+from source.resources import database, process_pool_size, run_in_process
+from sqlalchemy import select
+import asyncio
+import collections
+import datetime
+import itertools
+import os
+
+
+CHUNK_SIZE = 5000
+
+# Only report the first few invalid rows, rather than flooding the job.
+MAX_REPORTED_ERRORS = 20
+
+DELETE_SKIPPED_MESSAGE = (
+    "Rows missing from the upload were not deleted, because some rows were invalid."
+)
+
+TABLE_DELETED_MESSAGE = "The table was deleted before the upload was imported."
+
+
+async def import_upload(job):
+    path = job.params["path"]
+    try:
+        datasource = await load_datasource_for_table(job.table)
+        if datasource is None:
+            raise ValueError(TABLE_DELETED_MESSAGE)
+
+        layout = await scan_upload(path)
+        await job.update(rows_total=layout.row_count)
+
+        # Uploads into a table that already has columns reuse those columns,
+        # with their existing types, and add any new ones after them.
+        existing_columns = {column["identity"]: column for column in datasource.columns}
+        layout.types = [
+            existing_columns[identity]["datatype"]
+            if identity in existing_columns
+            else datatype
+            for identity, datatype in zip(layout.identities, layout.types)
+        ]
+        if (
+            datasource.key_column is not None
+            and datasource.key_column not in layout.identities
+        ):
+            name = existing_columns[datasource.key_column]["name"]
+            raise ValueError(
+                f'The uploaded file does not contain the key column "{name}".'
+            )
+
+        position = max([column["position"] for column in datasource.columns] + [0])
+        column_insert_values = []
+        for name, identity, datatype in zip(
+            layout.names, layout.identities, layout.types
+        ):
+            if identity in existing_columns:
+                continue
+            position += 1
+            column_insert_values.append(
+                {
+                    "created_at": datetime.datetime.now(),
+                    "name": name,
+                    "identity": identity,
+                    "datatype": datatype,
+                    "table": datasource.table["pk"],
+                    "position": position,
+                }
+            )
+
+        query = tables.column.insert()
+        await database.execute_many(query, column_insert_values)
+
+        is_keyed = datasource.key_column is not None
+        delete_missing = is_keyed and job.params.get("delete_missing", False)
+        summary = None
+        if is_keyed:
+            summary = {"inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+
+        # The keys seen are tracked in a temporary table, so the import must
+        # use a single connection throughout.
+        async with database.connection():
+            if delete_missing:
+                await datasource.start_tracking_keys()
+
+            with open_upload(path) as input_file:
+                # An import that is run again, after its worker stopped,
+                # skips the rows that it had already added. Imports into a
+                # keyed table merge rows on their keys, so they simply start
+                # again.
+                if is_keyed:
+                    rows_processed = 0
+                    errors = []
+                else:
+                    rows_processed = job.rows_processed
+                    errors = list(job.errors)
+
+                if is_json_file(input_file):
+                    records = iter_json_records(input_file)
+                    await run_in_threadpool(skip_rows, records, rows_processed)
+                    chunks = map_chunks(validate_records, records, layout)
+                else:
+                    blocks, normalization, header, skip = await read_csv_header(
+                        input_file
+                    )
+                    chunks = map_csv_blocks(
+                        validate_rows,
+                        blocks,
+                        normalization,
+                        skip + rows_processed,
+                        layout,
+                    )
+
+                async for size, result in chunks:
+                    data, search_texts, chunk_errors = result
+                    await check_table_exists(job.table)
+                    errors += [
+                        f"Row {rows_processed + idx + 1}, {text}"
+                        for idx, text in chunk_errors
+                    ]
+                    rows_processed += size
+                    # The job's progress is recorded along with the rows, so
+                    # that it always agrees with the rows that were added.
+                    async with database.transaction():
+                        if is_keyed:
+                            chunk_summary = await datasource.bulk_upsert(
+                                data,
+                                search_texts=search_texts,
+                                track_keys=delete_missing,
+                            )
+                            for name, count in chunk_summary.items():
+                                summary[name] += count
+                        else:
+                            await datasource.bulk_create(
+                                data, search_texts=search_texts
+                            )
+                        await job.update(
+                            rows_processed=rows_processed,
+                            errors=errors[:MAX_REPORTED_ERRORS],
+                            summary=summary,
+                        )
+
+            # Any invalid rows are missing from the upload, so deleting the
+            # missing rows would delete them too.
+            if delete_missing and not errors:
+                summary["deleted"] = await datasource.delete_missing_rows()
+                await job.update(summary=summary)
+            elif delete_missing:
+                await datasource.stop_tracking_keys()
+                await job.update(
+                    errors=errors[:MAX_REPORTED_ERRORS] + [DELETE_SKIPPED_MESSAGE]
+                )
+    except asyncio.CancelledError:
+        # The job is run again later, so keep the upload until then.
+        raise
+    except Exception:
+        discard_upload(path)
+        raise
+    discard_upload(path)
+
+
+def discard_upload(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def skip_rows(rows, count):
+    collections.deque(itertools.islice(rows, count), maxlen=0)
+
+
+async def check_table_exists(table_pk):
+    """
+    Stop importing into a table that has been deleted since the import
+    started, rather than adding rows that will only be purged.
+    """
+    query = (
+        select([tables.table.c.pk])
+        .where(tables.table.c.pk == table_pk)
+        .where(tables.table.c.deleted_at.is_(None))
+    )
+    if await database.fetch_one(query) is None:
+        raise ValueError(TABLE_DELETED_MESSAGE)
+
+
+async def scan_upload(path):
+    """
+    Make a first pass over an uploaded file, to determine its columns.
+
+    The column types are decided from an initial chunk of rows, which the
+    remaining chunks are then checked against in parallel.
+    """
+    with open_upload(path) as input_file:
+        if is_json_file(input_file):
+            return await scan_json_upload(input_file)
+
+        blocks, normalization, header, skip = await read_csv_header(input_file)
+        if not header:
+            raise ValueError("The uploaded file does not contain any data.")
+
+        initial_types = [None for name in header]
+        skipped, row_count, sample_types = await run_in_process(
+            process_csv_block,
+            determine_chunk_types,
+            (initial_types,),
+            normalization,
+            skip,
+            next(blocks),
+        )
+
+        column_types = sample_types
+        async for size, chunk_types in map_csv_blocks(
+            determine_chunk_types, blocks, normalization, 0, sample_types
+        ):
+            column_types = merge_column_types(column_types, chunk_types)
+            row_count += size
+
+    return TableLayout(
+        names=header,
+        identities=determine_column_identities([header]),
+        types=[datatype or "string" for datatype in column_types],
+        row_count=row_count,
+    )
+
+
+async def scan_json_upload(input_file):
+    """
+    Make a first pass over an uploaded JSON file, to determine the set of
+    object keys, and the types of their values.
+    """
+    records = iter_json_records(input_file)
+    names, column_types, row_count = [], [], 0
+    async for size, (chunk_names, chunk_types) in map_chunks(
+        determine_record_types, records
+    ):
+        names, column_types = merge_record_types(
+            names, column_types, chunk_names, chunk_types
+        )
+        row_count += size
+
+    if not names:
+        raise ValueError("The uploaded file does not contain any data.")
+    return get_layout(names, column_types, row_count)
+
+
+def preview_upload(path):
+    """
+    Preview an uploaded file, which may either be CSV or JSON.
+    """
+    with open_upload(path) as input_file:
+        is_json = is_json_file(input_file)
+    if is_json:
+        return preview_json_file(path)
+    return preview_csv_file(path)
+
+
+def read_chunk(rows):
+    return list(itertools.islice(rows, CHUNK_SIZE))
+
+
+async def map_chunks(func, rows, *args):
+    """
+    Read the rows in chunks, and call `func(*args, chunk)` for each chunk in
+    the process pool, yielding `(len(chunk), result)` pairs in order.
+
+    Reading the rows is run in a thread, so that it doesn't block the event
+    loop, and there may be as many chunks in flight as there are processes.
+    """
+    in_flight = collections.deque()
+    try:
+        chunk = await run_in_threadpool(read_chunk, rows)
+        while chunk or in_flight:
+            if chunk:
+                future = asyncio.ensure_future(run_in_process(func, *args, chunk))
+                in_flight.append((len(chunk), future))
+                chunk = await run_in_threadpool(read_chunk, rows)
+            if not chunk or len(in_flight) >= process_pool_size:
+                size, future = in_flight.popleft()
+                yield size, await future
+    finally:
+        for size, future in in_flight:
+            future.cancel()
+
+
+async def read_csv_header(input_file):
+    """
+    Read the first block of a CSV file, and decide how its rows are
+    normalized, in the process pool. Returns an iterator of all the blocks,
+    starting from the first, along with the normalization, the header row,
+    and the number of rows up to and including the header.
+    """
+    blocks = iter_csv_blocks(input_file)
+    first_block = await run_in_threadpool(next, blocks, "")
+    normalization, header, skip = await run_in_process(
+        determine_csv_header, first_block
+    )
+    return itertools.chain([first_block], blocks), normalization, header, skip
+
+
+async def map_csv_blocks(func, blocks, normalization, skip, *args):
+    """
+    Parse and normalize each block of a CSV file in the process pool, skipping
+    the first `skip` rows, and call `func(*args, rows)` there with the rows of
+    each block, yielding `(len(rows), result)` pairs in order.
+
+    As with `map_chunks`, there may be as many blocks in flight as there are
+    processes, except while rows are being skipped, since the number of rows
+    in a block is only known once it has been parsed.
+    """
+    in_flight = collections.deque()
+    try:
+        block = await run_in_threadpool(next, blocks, None)
+        while block is not None or in_flight:
+            if block is not None and not (skip and in_flight):
+                future = asyncio.ensure_future(
+                    run_in_process(
+                        process_csv_block, func, args, normalization, skip, block
+                    )
+                )
+                in_flight.append(future)
+                block = await run_in_threadpool(next, blocks, None)
+            if block is None or skip or len(in_flight) >= process_pool_size:
+                skipped, size, result = await in_flight.popleft()
+                skip -= skipped
+                if size:
+                    yield size, result
+    finally:
+        for future in in_flight:
+            future.cancel()
@@ -0,0 +1,384 @@
+"""
+Background jobs, such as importing uploaded files, or purging deleted tables.
+
+Each job is recorded as a row in the `job` table, which holds its status and
+progress. Workers pick up pending jobs from a queue, which is a Redis list if
+`REDIS_URL` is configured, or the `job` table itself otherwise.
+
+Run a standalone worker process with `python -m source.jobs`. Workers also
+regularly remove any spooled uploads that were abandoned.
+
+Running jobs record a regular heartbeat. If a worker is shut down, then its
+job is put back to be run again, and if a worker dies without doing so, then
+its job is claimed again once the heartbeat is stale.
+"""
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from source import importer, maintenance, settings, tables, uploads
+from source.resources import create_redis, database
+from source.response_cache import response_cache
+from sqlalchemy.sql import and_, or_, select
+import asyncio
+import contextvars
+import datetime
+import logging
+import math
+import time
+
+
+logger = logging.getLogger("source.jobs")
+
+ACTIVE_STATUSES = ["pending", "running"]
+
+HANDLERS = {
+    "import": importer.import_upload,
+    "purge": maintenance.purge_table,
+    "drop_column": maintenance.drop_column,
+    "retype_column": maintenance.retype_column,
+    "set_key_column": maintenance.set_key_column,
+}
+
+
+class Job:
+    def __init__(self, record):
+        self.pk = record["pk"]
+        self.kind = record["kind"]
+        self.table = record["table"]
+        self.params = record["params"]
+        self.status = record["status"]
+        self.created_at = record["created_at"]
+        self.started_at = record["started_at"]
+        self.finished_at = record["finished_at"]
+        self.updated_at = record["updated_at"]
+        self.rows_processed = record["rows_processed"]
+        self.rows_total = record["rows_total"]
+        self.errors = record["errors"]
+        self.summary = record["summary"]
+
+    @property
+    def is_active(self):
+        return self.status in ACTIVE_STATUSES
+
+    @property
+    def percent_complete(self):
+        if self.status == "complete":
+            return 100
+        if not self.rows_total:
+            return 0
+        return math.floor(100 * self.rows_processed / self.rows_total)
+
+    @property
+    def eta(self):
+        """
+        An estimate of the number of seconds until the job completes,
+        based on the rate that rows have been processed so far.
+        """
+        if self.status != "running" or not self.rows_total or not self.rows_processed:
+            return None
+        elapsed = (datetime.datetime.now() - self.started_at).total_seconds()
+        remaining = self.rows_total - self.rows_processed
+        return math.ceil(elapsed / self.rows_processed * remaining)
+
+    def serialize(self):
+        return {
+            "kind": self.kind,
+            "status": self.status,
+            "rows_processed": self.rows_processed,
+            "rows_total": self.rows_total,
+            "percent_complete": self.percent_complete,
+            "eta": self.eta,
+            "errors": self.errors,
+            "summary": self.summary,
+        }
+
+    async def update(self, **values):
+        query = tables.job.update().where(tables.job.c.pk == self.pk)
+        await database.execute(query, values=values)
+        for key, value in values.items():
+            setattr(self, key, value)
+
+
+async def enqueue(kind, table, params):
+    """
+    Create a new pending job, and add it to the queue.
+    """
+    values = {
+        "created_at": datetime.datetime.now(),
+        "kind": kind,
+        "status": "pending",
+        "table": table,
+        "params": params,
+        "rows_processed": 0,
+        "rows_total": None,
+        "errors": [],
+        "summary": None,
+    }
+    query = tables.job.insert()
+    pk = await database.execute(query, values=values)
+    await queue.put(pk)
+
+    query = tables.job.select().where(tables.job.c.pk == pk)
+    record = await database.fetch_one(query)
+    return Job(record)
+
+
+async def load_jobs_for_table(table_pk):
+    """
+    Return any pending or running jobs for the table, plus the most recent
+    job if it failed, completed with errors, or has a summary of the changes
+    it made, so that they can be displayed.
+    """
+    query = (
+        tables.job.select()
+        .where(tables.job.c.table == table_pk)
+        .where(tables.job.c.status.in_(ACTIVE_STATUSES))
+        .order_by(tables.job.c.pk)
+    )
+    records = await database.fetch_all(query)
+    jobs = [Job(record) for record in records]
+
+    query = (
+        tables.job.select()
+        .where(tables.job.c.table == table_pk)
+        .order_by(tables.job.c.pk.desc())
+        .limit(1)
+    )
+    latest = await database.fetch_one(query)
+    if (
+        latest is not None
+        and latest["status"] not in ACTIVE_STATUSES
+        and (latest["errors"] or latest["summary"])
+    ):
+        jobs.append(Job(latest))
+    return jobs
+
+
+async def load_job_or_404(table_pk, job_pk):
+    query = (
+        tables.job.select()
+        .where(tables.job.c.table == table_pk)
+        .where(tables.job.c.pk == job_pk)
+    )
+    record = await database.fetch_one(query)
+    if record is None:
+        raise HTTPException(status_code=404)
+    return Job(record)
+
+
+async def claim_job(pk=None):
+    """
+    Mark a pending job as running, and return it.
+
+    If no primary key is given, then claim the oldest pending job. Running
+    jobs with a stale heartbeat may also be claimed, since their worker has
+    stopped. Locked rows are skipped, so that concurrent workers never claim
+    the same job.
+    """
+    now = datetime.datetime.now()
+    stale_at = now - datetime.timedelta(seconds=settings.JOB_STALE_TIMEOUT)
+    candidates = (
+        select([tables.job.c.pk])
+        .where(
+            or_(
+                tables.job.c.status == "pending",
+                and_(
+                    tables.job.c.status == "running",
+                    or_(
+                        tables.job.c.updated_at.is_(None),
+                        tables.job.c.updated_at < stale_at,
+                    ),
+                ),
+            )
+        )
+        .order_by(tables.job.c.pk)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    if pk is not None:
+        candidates = candidates.where(tables.job.c.pk == pk)
+
+    query = (
+        tables.job.update()
+        .where(tables.job.c.pk == candidates.as_scalar())
+        .values(status="running", started_at=now, updated_at=now)
+        .returning(*tables.job.columns)
+    )
+    record = await database.fetch_one(query)
+    return None if record is None else Job(record)
+
+
+async def keep_alive(job):
+    """
+    Record a heartbeat for a running job, until cancelled.
+    """
+    query = (
+        tables.job.update()
+        .where(tables.job.c.pk == job.pk)
+        .where(tables.job.c.status == "running")
+    )
+    while True:
+        await asyncio.sleep(settings.JOB_HEARTBEAT_INTERVAL)
+        await database.execute(query, values={"updated_at": datetime.datetime.now()})
+
+
+async def run_job(job):
+    # The heartbeat runs in a context of its own, so that it doesn't share a
+    # connection, or any transaction, with the job.
+    heartbeat = contextvars.Context().run(asyncio.ensure_future, keep_alive(job))
+    try:
+        handler = HANDLERS[job.kind]
+        await handler(job)
+    except asyncio.CancelledError:
+        # The worker is shutting down, so put the job back to be run again.
+        logger.warning("Job %d was interrupted, and will be run again.", job.pk)
+        await job.update(status="pending")
+        await queue.put(job.pk)
+        raise
+    except Exception as exc:
+        logger.exception("Job %d failed.", job.pk)
+        await job.update(
+            status="failed",
+            finished_at=datetime.datetime.now(),
+            errors=job.errors + [str(exc)],
+        )
+    else:
+        await job.update(status="complete", finished_at=datetime.datetime.now())
+    finally:
+        heartbeat.cancel()
+
+
+async def run_pending_jobs():
+    """
+    Run jobs until there are none left pending. Returns the number of jobs run.
+    """
+    count = 0
+    job = await claim_job()
+    while job is not None:
+        await run_job(job)
+        count += 1
+        job = await claim_job()
+    return count
+
+
+class DatabaseQueue:
+    """
+    Uses the `job` table itself as the queue, polling for pending jobs.
+    """
+
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def put(self, job_pk):
+        pass
+
+    async def get(self):
+        job = await claim_job()
+        if job is None:
+            await asyncio.sleep(self.poll_interval)
+        return job
+
+
+class RedisQueue:  # pragma: nocover
+    """
+    Pushes job primary keys onto a Redis list, which workers block on,
+    so that jobs are picked up as soon as they are enqueued.
+
+    The `job` table is still the source of truth, so workers also sweep it
+    for pending jobs whenever the list has been idle for a while.
+    """
+
+    key = "hostedapi:jobs"
+    sweep_interval = 30
+
+    def __init__(self):
+        self.pool = None
+        self.blocking_connection = None
+
+    async def connect(self):
+        self.pool = await create_redis("Pool", poolsize=2)
+
+    async def disconnect(self):
+        self.pool.close()
+        if self.blocking_connection is not None:
+            self.blocking_connection.close()
+
+    async def put(self, job_pk):
+        await self.pool.lpush(self.key, [str(job_pk)])
+
+    async def get(self):
+        import asyncio_redis
+
+        if self.blocking_connection is None:
+            self.blocking_connection = await create_redis("Connection")
+        try:
+            reply = await self.blocking_connection.brpop(
+                [self.key], timeout=self.sweep_interval
+            )
+        except asyncio_redis.exceptions.TimeoutError:
+            return await claim_job()
+        return await claim_job(pk=int(reply.value))
+
+
+if settings.REDIS_URL:  # pragma: nocover
+    queue = RedisQueue()
+else:
+    queue = DatabaseQueue(poll_interval=settings.JOB_POLL_INTERVAL)
+
+
+async def run_worker():  # pragma: nocover
+    swept_at = None
+    while True:
+        now = time.monotonic()
+        if swept_at is None or now - swept_at >= settings.UPLOAD_SWEEP_INTERVAL:
+            swept_at = now
+            try:
+                await run_in_threadpool(uploads.expire_uploads, settings.UPLOAD_EXPIRY)
+            except Exception:
+                logger.exception("Failed to expire uploads.")
+        job = await queue.get()
+        if job is not None:
+            await run_job(job)
+
+
+worker_task = None
+
+
+async def startup():
+    global worker_task
+
+    await queue.connect()
+    if settings.RUN_WORKER:
+        worker_task = asyncio.ensure_future(run_worker())
+
+
+async def shutdown():
+    global worker_task
+
+    if worker_task is not None:
+        # Wait for any running job to be put back, before disconnecting.
+        worker_task.cancel()
+        await asyncio.wait([worker_task])
+        worker_task = None
+    await queue.disconnect()
+
+
+async def main():  # pragma: nocover
+    await database.connect()
+    await response_cache.connect()
+    await queue.connect()
+    try:
+        await run_worker()
+    finally:
+        await queue.disconnect()
+        await response_cache.disconnect()
+        await database.disconnect()
+
+
+if __name__ == "__main__":  # pragma: nocover
+    asyncio.run(main())
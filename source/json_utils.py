@@ -0,0 +1,253 @@
+"""
+Import JSON uploads, either as a single array of objects, or as newline
+delimited JSON, with one object per line.
+
+Objects are parsed incrementally, so that only a single object needs to be
+held in memory at a time. Columns are determined from the object keys, and
+their types from the JSON values, using the same set of types, and the same
+rules for combining them, as CSV uploads.
+"""
+from source.csv_utils import (
+    PREVIEW_ROWS,
+    TableLayout,
+    TablePreview,
+    determine_column_identities,
+    get_schema,
+    is_date,
+    merge_column_type,
+    open_upload,
+)
+from source.validation import RowValidator
+import io
+import json
+import typing
+
+
+# The number of characters read from a JSON array at a time.
+READ_SIZE = 64 * 1024
+
+# Parse errors within this many characters of the end of the text read so far
+# may be due to an incomplete value, such as a partly read escape sequence.
+INCOMPLETE_SIZE = 16
+
+# The number of objects at the start of a file that are parsed to preview it.
+PREVIEW_RECORDS = 1000
+
+
+def is_json_file(input_file: typing.BinaryIO) -> bool:
+    """
+    Determine if an uploaded file contains JSON, rather than CSV, from its
+    first non-whitespace character.
+    """
+    sample = input_file.read(1024)
+    input_file.seek(0)
+    if sample.startswith(b"\xef\xbb\xbf"):
+        sample = sample[3:]
+    return sample.lstrip()[:1] in (b"[", b"{")
+
+
+def iter_json_array(text_file: typing.TextIO) -> typing.Iterator[typing.Any]:
+    """
+    Parse the items of a JSON array incrementally, reading the text in
+    fixed size chunks.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    idx = 0
+    is_eof = False
+    expected = "["
+    is_value_allowed = False
+
+    while True:
+        while idx < len(buffer) and buffer[idx].isspace():
+            idx += 1
+        if idx == len(buffer):
+            if is_eof:
+                raise ValueError("The uploaded file is not a valid JSON array.")
+            buffer = text_file.read(READ_SIZE)
+            idx = 0
+            is_eof = not buffer
+            continue
+
+        char = buffer[idx]
+        if char in expected:
+            idx += 1
+            if char == "]":
+                return
+            expected = "]" if char == "[" else ""
+            is_value_allowed = True
+            continue
+        elif not is_value_allowed:
+            raise ValueError("The uploaded file is not a valid JSON array.")
+
+        try:
+            value, end = decoder.raw_decode(buffer, idx)
+        except json.JSONDecodeError as err:
+            # The value may just continue into the next chunk of text, if
+            # the error is in an unterminated string, or close to the end of
+            # the buffer, such as in a partly read literal. Any other error
+            # is raised straight away, rather than reading the rest of the
+            # file into the buffer.
+            if err.pos < len(buffer) - INCOMPLETE_SIZE and not err.msg.startswith(
+                "Unterminated string"
+            ):
+                raise ValueError("The uploaded file is not a valid JSON array.")
+            end = None
+
+        # A value that ends with the buffer may be incomplete, such as a
+        # number that continues into the next chunk of text.
+        if end is None or (end == len(buffer) and not is_eof):
+            if is_eof:
+                raise ValueError("The uploaded file is not a valid JSON array.")
+            more = text_file.read(READ_SIZE)
+            buffer = buffer[idx:] + more
+            idx = 0
+            is_eof = not more
+            continue
+
+        yield value
+        idx = end
+        expected = ",]"
+        is_value_allowed = False
+
+
+def iter_json_records(input_file: typing.BinaryIO) -> typing.Iterator[dict]:
+    """
+    Parse the objects in an uploaded JSON or newline delimited JSON file.
+    """
+    text_file = io.TextIOWrapper(input_file, encoding="utf-8-sig")
+    prefix = ""
+    while not prefix.strip():
+        text = text_file.read(READ_SIZE)
+        if not text:
+            break
+        prefix += text
+    is_array = prefix.lstrip().startswith("[")
+    text_file.seek(0)
+
+    if is_array:
+        records = iter_json_array(text_file)
+    else:
+        records = (json.loads(line) for line in text_file if line.strip())
+
+    for idx, record in enumerate(records):
+        if not isinstance(record, dict):
+            raise ValueError(f"Item {idx + 1} in the uploaded file is not an object.")
+        yield record
+
+
+def get_value_type(value):
+    if value is None or value == "":
+        return None
+    elif isinstance(value, bool):
+        return "boolean"
+    elif isinstance(value, int):
+        return "integer"
+    elif isinstance(value, float):
+        return "float"
+    elif isinstance(value, str) and is_date(value):
+        return "date"
+    return "string"
+
+
+def determine_record_types(
+    records: typing.List[dict],
+) -> typing.Tuple[typing.List[str], typing.List[typing.Optional[str]]]:
+    """
+    Determine the column names, in the order they first appear, and the most
+    specific type that fits all the values for each, for a chunk of objects.
+    """
+    types = {}
+    for record in records:
+        for key, value in record.items():
+            types[key] = merge_column_type(types.get(key), get_value_type(value))
+    return list(types.keys()), list(types.values())
+
+
+def merge_record_types(names, column_types, other_names, other_types):
+    types = dict(zip(names, column_types))
+    for name, datatype in zip(other_names, other_types):
+        types[name] = merge_column_type(types.get(name), datatype)
+    return list(types.keys()), list(types.values())
+
+
+def get_text(value):
+    if value is None:
+        return ""
+    elif isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def validate_records(
+    layout: TableLayout, records: typing.List[dict]
+) -> typing.Tuple[typing.List[dict], typing.List[str], typing.List[tuple]]:
+    """
+    Validate a chunk of objects against the table layout, returning the
+    validated data, the text to search against for each valid object, and
+    a list of `(index, text)` errors for any invalid objects.
+    """
+    validator = RowValidator(get_schema(layout.identities, layout.types))
+    validated_data = []
+    search_texts = []
+    errors = []
+    for idx, record in enumerate(records):
+        values = [record.get(name) for name in layout.names]
+        data = {
+            identity: get_text(value) if datatype == "string" else value
+            for identity, datatype, value in zip(
+                layout.identities, layout.types, values
+            )
+        }
+        value, error = validator.validate_or_error(data)
+        if error:
+            errors += [
+                (idx, f"{message.index[0]}: {message.text}")
+                for message in error.messages()
+            ]
+        else:
+            validated_data.append(value)
+            search_texts.append(" ".join(get_text(value) for value in values))
+    return validated_data, search_texts, errors
+
+
+def get_layout(names, column_types, row_count):
+    return TableLayout(
+        names=names,
+        identities=determine_column_identities([names]),
+        types=[datatype or "string" for datatype in column_types],
+        row_count=row_count,
+    )
+
+
+def preview_json_file(path: str) -> TablePreview:
+    """
+    Determine the columns of an uploaded JSON file, and its first few rows,
+    from a bounded number of objects at the start of the file.
+    """
+    records = []
+    is_truncated = False
+    with open_upload(path) as input_file:
+        try:
+            for record in iter_json_records(input_file):
+                if len(records) >= PREVIEW_RECORDS:
+                    is_truncated = True
+                    break
+                records.append(record)
+        except ValueError:
+            # Invalid JSON is reported when the file is imported, so just
+            # preview the objects before the error.
+            is_truncated = True
+
+    names, column_types = determine_record_types(records)
+    layout = get_layout(names, column_types, len(records))
+    return TablePreview(
+        names=layout.names,
+        identities=layout.identities,
+        types=layout.types,
+        rows=[
+            [get_text(record.get(name)) for name in names]
+            for record in records[:PREVIEW_ROWS]
+        ],
+        is_truncated=is_truncated,
+    )
@@ -0,0 +1,369 @@
+"""
+Background jobs that remove or rewrite the stored data for a table, such as
+purging a deleted table, removing the values of a deleted column, converting
+the values of a column to a new datatype, or changing the key column.
+
+These may touch millions of rows, so rather than running a single long
+statement, which would hold locks and generate WAL for its whole duration,
+the rows are processed in bounded batches. Each batch is a short statement of
+its own, and the job pauses between batches so that foreground requests
+aren't starved of database resources.
+
+The `row` table holds the rows for every table, and isn't partitioned, so a
+deleted table's rows can't simply be dropped as a partition.
+"""
+from typesystem import ValidationError
+from source import settings, tables
+from source.csv_utils import get_field
+from source.datasource import (
+    bump_table_version,
+    get_content_hash,
+    get_key_expression,
+    get_search_text,
+    has_duplicate_keys,
+)
+from source.json_utils import get_text
+from source.resources import database
+from source.validation import compile_field
+from sqlalchemy import func, select
+import asyncio
+import json
+
+
+# Rewrite a batch of rows at once, from arrays of column values.
+ROW_REWRITE_QUERY = """
+UPDATE "row"
+SET data = batch.data::json,
+    search_text = batch.search_text,
+    content_hash = batch.content_hash
+FROM unnest($1::integer[], $2::text[], $3::text[], $4::text[])
+    AS batch(pk, data, search_text, content_hash)
+WHERE "row".pk = batch.pk
+"""
+
+
+async def throttle():
+    await asyncio.sleep(settings.MAINTENANCE_BATCH_DELAY)
+
+
+async def count_rows(table_pk):
+    query = (
+        select([func.count()])
+        .select_from(tables.row)
+        .where(tables.row.c.table == table_pk)
+    )
+    return await database.fetch_val(query)
+
+
+async def delete_rows(job):
+    """
+    Delete all the rows in the job's table, in batches.
+    """
+    await job.update(rows_total=await count_rows(job.table))
+
+    rows_processed = 0
+    while True:
+        batch = (
+            select([tables.row.c.pk])
+            .where(tables.row.c.table == job.table)
+            .limit(settings.MAINTENANCE_BATCH_SIZE)
+        )
+        query = (
+            tables.row.delete()
+            .where(tables.row.c.pk.in_(batch))
+            .returning(tables.row.c.pk)
+        )
+        deleted = len(await database.fetch_all(query))
+        if deleted:
+            await bump_table_version(job.table)
+        rows_processed += deleted
+        await job.update(rows_processed=rows_processed)
+        if deleted < settings.MAINTENANCE_BATCH_SIZE:
+            break
+        await throttle()
+
+
+async def purge_table(job):
+    """
+    Remove a table that has been marked as deleted, and all of its rows.
+    """
+    await delete_rows(job)
+
+    async with database.transaction():
+        query = tables.column.delete().where(tables.column.c.table == job.table)
+        await database.execute(query)
+        query = tables.table.delete().where(tables.table.c.pk == job.table)
+        await database.execute(query)
+
+
+async def column_exists(table_pk, identity):
+    query = (
+        select([tables.column.c.pk])
+        .where(tables.column.c.table == table_pk)
+        .where(tables.column.c.identity == identity)
+    )
+    return await database.fetch_one(query) is not None
+
+
+async def process_row_batches(table_pk, process, lock=True):
+    """
+    Call `process(rows)` with the rows of a table in batches, in primary key
+    order, stopping early if it returns `False`.
+
+    Each batch is fetched and processed within its own transaction, and
+    unless `lock` is false the rows are locked while they are processed, so
+    that concurrent edits to those rows aren't lost.
+    """
+    last_pk = 0
+    while True:
+        async with database.transaction():
+            query = (
+                select([tables.row.c.pk, tables.row.c.data])
+                .where(tables.row.c.table == table_pk)
+                .where(tables.row.c.pk > last_pk)
+                .order_by(tables.row.c.pk)
+                .limit(settings.MAINTENANCE_BATCH_SIZE)
+            )
+            if lock:
+                query = query.with_for_update()
+            rows = await database.fetch_all(query)
+            if await process(rows) is False:
+                break
+        if len(rows) < settings.MAINTENANCE_BATCH_SIZE:
+            break
+        last_pk = rows[-1]["pk"]
+        await throttle()
+
+
+async def rewrite_rows(table_pk, rows, transform):
+    """
+    Store `transform(data)` for each of the rows, skipping any rows where it
+    returns `None`, to indicate that the data is unchanged.
+    """
+    records = []
+    for row in rows:
+        data = transform(row["data"])
+        if data is not None:
+            records.append(
+                (
+                    row["pk"],
+                    json.dumps(data),
+                    get_search_text(data),
+                    get_content_hash(data),
+                )
+            )
+    if records:
+        async with database.connection() as connection:
+            await connection.raw_connection.execute(ROW_REWRITE_QUERY, *zip(*records))
+        await bump_table_version(table_pk)
+
+
+async def update_keys(rows, key):
+    """
+    Set the key of each of the rows to the SQL expression `key`, or clear it
+    if `key` is `None`, leaving any rows that already have that key untouched.
+    """
+    if rows:
+        query = (
+            tables.row.update()
+            .where(tables.row.c.pk.in_([row["pk"] for row in rows]))
+            .where(tables.row.c.key.is_distinct_from(key))
+            .values(key=key)
+        )
+        await database.execute(query)
+
+
+async def drop_column(job):
+    """
+    Remove the values for a deleted column from the stored row data, and
+    clear the row keys if it was the key column.
+
+    If the last column in the table has been deleted, then the rows are
+    deleted instead.
+    """
+    identity = job.params["column"]
+    query = (
+        select([func.count()])
+        .select_from(tables.column)
+        .where(tables.column.c.table == job.table)
+    )
+    if await database.fetch_val(query) == 0:
+        await delete_rows(job)
+        return
+
+    def remove_value(data):
+        if identity not in data:
+            return None
+        return {key: value for key, value in data.items() if key != identity}
+
+    rows_processed = 0
+
+    async def process(rows):
+        nonlocal rows_processed
+        # Stop if a new column has since been created with the same name,
+        # rather than removing its values.
+        if await column_exists(job.table, identity):
+            return False
+        await rewrite_rows(job.table, rows, remove_value)
+        if job.params.get("key"):
+            await update_keys(rows, None)
+        rows_processed += len(rows)
+        await job.update(rows_processed=rows_processed)
+
+    await job.update(rows_total=await count_rows(job.table))
+    await process_row_batches(job.table, process)
+
+
+def get_converter(datatype):
+    """
+    Return a function that converts a stored value to the given datatype,
+    raising a `ValidationError` if it can't be converted.
+
+    Values are converted from their text, as if they had been entered or
+    uploaded into a column of that type, except that numbers with a
+    fractional part can't be converted to integers, rather than being
+    silently truncated.
+    """
+    field = get_field(datatype)
+    validate = compile_field(field)
+
+    def convert(value):
+        text = get_text(value)
+        converted = validate(text)
+        if (
+            datatype == "integer"
+            and converted is not None
+            and not float(text).is_integer()
+        ):
+            raise field.validation_error("integer")
+        return converted
+
+    return convert
+
+
+async def retype_column(job):
+    """
+    Change the datatype of a column, converting its existing values.
+
+    First all the values are checked, and the job fails with a count of the
+    values that can't be converted, unless the `force` option is set, in
+    which case those values are cleared. The values are then converted in
+    batches, before the column's datatype is switched over in a single
+    statement. Finally any rows that were edited, with the old datatype,
+    while the conversion was running are converted with a second pass.
+    """
+    identity = job.params["column"]
+    datatype = job.params["datatype"]
+    convert = get_converter(datatype)
+    row_count = await count_rows(job.table)
+    await job.update(rows_total=row_count * (2 if job.params["force"] else 3))
+    rows_processed = 0
+    failed_count = 0
+    examples = []
+
+    async def check_rows(rows):
+        nonlocal rows_processed, failed_count
+        for row in rows:
+            value = row["data"].get(identity)
+            try:
+                convert(value)
+            except ValidationError:
+                failed_count += 1
+                if len(examples) < 3 and value not in examples:
+                    examples.append(value)
+        rows_processed += len(rows)
+        await job.update(rows_processed=rows_processed)
+
+    def convert_value(data):
+        if identity not in data:
+            return None
+        try:
+            value = convert(data[identity])
+        except ValidationError:
+            value = None
+        if value == data[identity] and type(value) is type(data[identity]):
+            return None
+        return dict(data, **{identity: value})
+
+    async def convert_rows(rows):
+        nonlocal rows_processed
+        await rewrite_rows(job.table, rows, convert_value)
+        rows_processed += len(rows)
+        await job.update(rows_processed=rows_processed)
+
+    if not job.params["force"]:
+        await process_row_batches(job.table, check_rows, lock=False)
+        if failed_count:
+            examples_text = " and ".join(json.dumps(value) for value in examples)
+            raise ValueError(
+                f"{failed_count} values can't be converted to {datatype}, "
+                f"such as {examples_text}."
+            )
+
+    await process_row_batches(job.table, convert_rows)
+
+    query = (
+        tables.column.update()
+        .where(tables.column.c.table == job.table)
+        .where(tables.column.c.identity == identity)
+        .values(datatype=datatype)
+    )
+    await database.execute(query)
+    await bump_table_version(job.table)
+
+    await process_row_batches(job.table, convert_rows)
+
+
+async def set_key_column(job):
+    """
+    Change the column that identifies each row, updating the keys of the
+    existing rows, or clear the key column if it is `None`.
+
+    The table has no key column while the keys are updated, so that uploads
+    aren't merged on keys that are only partly updated. The old keys are
+    cleared in batches, then the new keys are set in batches, before the
+    table takes on its new key column in a single statement. Finally any rows
+    that were created or edited while the keys were updated are given keys
+    with a second pass.
+    """
+    identity = job.params["column"]
+    if identity is not None and await has_duplicate_keys(job.table, identity):
+        raise ValueError("The column contains duplicate values.")
+    row_count = await count_rows(job.table)
+    await job.update(rows_total=row_count * (1 if identity is None else 3))
+    rows_processed = 0
+
+    async def update_table(key_column):
+        query = (
+            tables.table.update()
+            .where(tables.table.c.pk == job.table)
+            .values(key_column=key_column)
+        )
+        await database.execute(query)
+        await bump_table_version(job.table)
+
+    async def clear_keys(rows):
+        nonlocal rows_processed
+        await update_keys(rows, None)
+        rows_processed += len(rows)
+        await job.update(rows_processed=rows_processed)
+
+    async def set_keys(rows):
+        nonlocal rows_processed
+        await update_keys(rows, get_key_expression(identity))
+        rows_processed += len(rows)
+        await job.update(rows_processed=rows_processed)
+
+    await update_table(None)
+    await process_row_batches(job.table, clear_keys)
+    if identity is None:
+        return
+
+    await process_row_batches(job.table, set_keys)
+    # The column may have been deleted while the keys were being set, in
+    # which case the table is left without a key column.
+    if not await column_exists(job.table, identity):
+        await process_row_batches(job.table, clear_keys)
+        raise ValueError("The column has been deleted.")
+    await update_table(identity)
+    await process_row_batches(job.table, set_keys)
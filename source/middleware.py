@@ -0,0 +1,114 @@
+import contextlib
+import re
+import time
+
+
+SNAPSHOT_BEGIN_QUERY = "BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY"
+WRITTEN_AT_SESSION_KEY = "written_at"
+
+
+class DatabaseMiddleware:
+    """
+    Runs each request on a single pooled database connection, rather than
+    acquiring and releasing a connection for every query.
+
+    Requests with a read only method also run within a single read only
+    REPEATABLE READ transaction, so that every query sees the same snapshot,
+    and for example the row count always agrees with the page of rows.
+
+    If the database has read replicas then read only requests are routed to
+    them, falling back to the primary if a replica fails. Requests from a
+    session that has written within the last `write_window` seconds read
+    from the primary instead, so that they see their own changes despite
+    any replication lag.
+
+    Paths that don't use the database, or that write to it on GET requests,
+    such as the OAuth callback, may be excluded, in which case each query
+    acquires its own connection from the primary as usual. Paths may also be
+    excluded by regular expression, such as uploads, which would otherwise
+    hold a connection while their request body is slowly received.
+
+    If the connection is already within a transaction, as it is when the
+    database is configured with `force_rollback`, then requests run within
+    that transaction instead.
+    """
+
+    def __init__(
+        self,
+        app,
+        database,
+        read_only_methods=("GET", "HEAD"),
+        exclude_paths=(),
+        exclude_patterns=(),
+        write_window=5,
+    ):
+        self.app = app
+        self.database = database
+        self.read_only_methods = read_only_methods
+        self.exclude_paths = exclude_paths
+        self.exclude_patterns = [re.compile(pattern) for pattern in exclude_patterns]
+        self.write_window = write_window
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.is_excluded(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        if scope["method"] not in self.read_only_methods:
+            async with self.database.connection():
+                await self.app(scope, receive, self.track_writes(scope, send))
+            return
+
+        replica = None
+        if not self.wrote_recently(scope):
+            replica = await self.database.choose_replica()
+
+        async with contextlib.AsyncExitStack() as stack:
+            if replica is not None:
+                try:
+                    await self.begin_snapshot(stack, replica)
+                except Exception:
+                    # Read from the primary instead, until the replica has
+                    # been checked again.
+                    self.database.replica_failed(replica)
+                    await stack.aclose()
+                    replica = None
+            if replica is None:
+                await self.begin_snapshot(stack, None)
+            await self.app(scope, receive, send)
+
+    def is_excluded(self, path):
+        return path.startswith(tuple(self.exclude_paths)) or any(
+            pattern.fullmatch(path) for pattern in self.exclude_patterns
+        )
+
+    async def begin_snapshot(self, stack, replica):
+        stack.enter_context(self.database.route(replica))
+        connection = await stack.enter_async_context(self.database.connection())
+        raw_connection = connection.raw_connection
+        if not raw_connection.is_in_transaction():
+            await raw_connection.execute(SNAPSHOT_BEGIN_QUERY)
+            # Nothing can have been written, so the snapshot is always
+            # released by rolling back.
+            stack.push_async_callback(raw_connection.execute, "ROLLBACK")
+
+    def track_writes(self, scope, send):
+        """
+        Record the time of successful write requests in the session, if there
+        are any read replicas for later requests to avoid.
+        """
+        session = scope.get("session")
+        if session is None or not self.database.replicas:
+            return send
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                session[WRITTEN_AT_SESSION_KEY] = time.time()
+            await send(message)
+
+        return send_wrapper
+
+    def wrote_recently(self, scope):
+        session = scope.get("session") or {}
+        written_at = session.get(WRITTEN_AT_SESSION_KEY)
+        return written_at is not None and time.time() - written_at < self.write_window
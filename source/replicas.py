@@ -0,0 +1,118 @@
+"""
+Routing of read only requests to read replicas of the database.
+
+Queries run on the primary database, unless they're made within
+`database.route(replica)`, which `DatabaseMiddleware` uses for read only
+requests. Each of these requests reads from the next healthy replica in
+turn, or from the primary if there are no healthy replicas.
+
+A replica that fails is skipped until `retry_interval` seconds have passed,
+and it has been checked again.
+"""
+import asyncio
+import contextlib
+import contextvars
+import databases
+import logging
+import time
+
+
+logger = logging.getLogger("source.replicas")
+
+# Checking a replica gives up after this many seconds, so that requests don't
+# wait for an unreachable replica for long.
+CHECK_TIMEOUT = 2
+
+
+class ReplicatedDatabase(databases.Database):
+    def __init__(self, url, replica_urls=(), retry_interval=10, **options):
+        super().__init__(url, **options)
+        self.replicas = [
+            databases.Database(replica_url) for replica_url in replica_urls
+        ]
+        self.retry_interval = retry_interval
+        self.failed_at = {}
+        self.next_index = 0
+        self.routed_replica = contextvars.ContextVar("routed_replica", default=None)
+        self.replica_connection = contextvars.ContextVar(
+            "replica_connection", default=None
+        )
+
+    async def connect(self):
+        await super().connect()
+        for replica in self.replicas:
+            await self.check_replica(replica)
+
+    async def disconnect(self):
+        for replica in self.replicas:
+            if replica.is_connected:
+                await replica.disconnect()
+        await super().disconnect()
+
+    def connection(self):
+        replica = self.routed_replica.get()
+        if replica is None:
+            return super().connection()
+        connection = self.replica_connection.get()
+        if connection is None:
+            # Each routed block has a connection of its own, rather than
+            # sharing one with any earlier blocks in the same context, which
+            # may have failed to acquire it.
+            connection = contextvars.Context().run(replica.connection)
+            self.replica_connection.set(connection)
+        return connection
+
+    @contextlib.contextmanager
+    def route(self, replica):
+        """
+        Run any queries within the block on the given replica, or on the
+        primary if `replica` is `None`.
+        """
+        replica_token = self.routed_replica.set(replica)
+        connection_token = self.replica_connection.set(None)
+        try:
+            yield
+        finally:
+            self.replica_connection.reset(connection_token)
+            self.routed_replica.reset(replica_token)
+
+    async def choose_replica(self):
+        """
+        Return the next healthy replica, in turn, or `None` if there are none.
+        """
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self.next_index]
+            self.next_index = (self.next_index + 1) % len(self.replicas)
+            failed_at = self.failed_at.get(replica)
+            if failed_at is None:
+                return replica
+            if time.monotonic() - failed_at >= self.retry_interval:
+                # Restart the interval, so that other requests don't check
+                # the replica at the same time.
+                self.replica_failed(replica)
+                if await self.check_replica(replica):
+                    return replica
+        return None
+
+    async def check_replica(self, replica):
+        """
+        Connect to a replica if needed, and check that it answers queries,
+        recording whether it is healthy.
+        """
+        try:
+            if not replica.is_connected:
+                await asyncio.wait_for(replica.connect(), CHECK_TIMEOUT)
+            await asyncio.wait_for(replica.fetch_one("SELECT 1"), CHECK_TIMEOUT)
+        except Exception:
+            logger.warning(
+                "Replica %s is unavailable.",
+                replica.url.obscure_password,
+                exc_info=True,
+            )
+            self.replica_failed(replica)
+            return False
+        self.failed_at.pop(replica, None)
+        return True
+
+    def replica_failed(self, replica):
+        self.failed_at[replica] = time.monotonic()
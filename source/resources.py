@@ -1,8 +1,17 @@
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 from source import settings
-import databases
+from source.cache import LRUCache, SingleFlight
+from source.middleware import SNAPSHOT_BEGIN_QUERY
+from source.replicas import ReplicatedDatabase
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
 import httpx
+import os
+import urllib.parse
 
 
 templates = Jinja2Templates(directory="templates")
@@ -10,12 +19,176 @@ statics = StaticFiles(directory="statics")
 
 
 if settings.TESTING:
-    database = databases.Database(settings.TEST_DATABASE_URL, force_rollback=True)
+    database = ReplicatedDatabase(settings.TEST_DATABASE_URL, force_rollback=True)
 else:  # pragma: nocover
-    database = databases.Database(settings.DATABASE_URL)
+    database = ReplicatedDatabase(
+        settings.DATABASE_URL,
+        replica_urls=settings.DATABASE_REPLICA_URLS,
+        retry_interval=settings.REPLICA_RETRY_INTERVAL,
+    )
+
+
+query_cache = LRUCache(max_size=settings.QUERY_CACHE_SIZE)
+single_flight = SingleFlight()
+
+
+# CPU bound work, such as parsing uploaded files, is run in a pool of worker
+# processes so that it does not block the event loop.
+process_pool_size = settings.PROCESS_POOL_SIZE or os.cpu_count() or 1
+process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=process_pool_size)
+
+
+async def run_in_process(func, *args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(process_pool, functools.partial(func, *args))
+
+
+# Spare connections are only used for a batch of queries, or for a single
+# flight, if the pool can provide them within this many seconds.
+SPARE_CONNECTION_TIMEOUT = 0.05
+
+# The result of a single flight that couldn't get a spare connection.
+NO_SPARE_CONNECTION = object()
+
+
+async def gather_queries(*funcs, database=database):
+    """
+    Run independent read queries concurrently, returning their results in
+    order. Each of `funcs` is called to make one of the queries.
+
+    The queries are spread across the request's own connection and up to
+    `QUERY_BATCH_CONNECTIONS` spare connections from the pool. Requests
+    already hold a connection each, so spare connections are only used if
+    they are available straight away, rather than waiting for other requests
+    that may in turn be waiting for spare connections. Any queries without a
+    connection of their own run in turn on the request's connection.
+
+    If the request is running within a snapshot then the spare connections
+    import it, so all the queries still see the same data. Writes made
+    earlier in an open transaction aren't visible to other connections, so
+    this mustn't be used after writing within a transaction.
+    """
+    async with database.connection() as connection:
+        async with contextlib.AsyncExitStack() as stack:
+            contexts = [contextvars.copy_context()]
+            snapshot = None
+            for _ in range(min(len(funcs) - 1, settings.QUERY_BATCH_CONNECTIONS)):
+                # Queries run on the connection for the current context, so
+                # each spare connection belongs to a new context, routed to
+                # the same replica, if any.
+                context = contextvars.Context()
+                context.run(database.routed_replica.set, database.routed_replica.get())
+                spare = context.run(database.connection)
+                if spare is connection:
+                    # Every query shares a single connection, such as when
+                    # the database is configured with `force_rollback`.
+                    break
+                try:
+                    await asyncio.wait_for(
+                        stack.enter_async_context(spare), SPARE_CONNECTION_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    break
+                if connection.raw_connection.is_in_transaction():
+                    if snapshot is None:
+                        snapshot = await connection.raw_connection.fetchval(
+                            "SELECT pg_export_snapshot()"
+                        )
+                    await spare.raw_connection.execute(SNAPSHOT_BEGIN_QUERY)
+                    stack.push_async_callback(spare.raw_connection.execute, "ROLLBACK")
+                    await spare.raw_connection.execute(
+                        f"SET TRANSACTION SNAPSHOT '{snapshot}'"
+                    )
+                contexts.append(context)
+
+            async def run_in_turn(funcs):
+                return [await func() for func in funcs]
+
+            # Every task is awaited before the spare connections are released.
+            tasks = [
+                context.run(
+                    asyncio.ensure_future, run_in_turn(funcs[index :: len(contexts)])
+                )
+                for index, context in enumerate(contexts)
+            ]
+            task_results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = [None] * len(funcs)
+    for index, task_result in enumerate(task_results):
+        if isinstance(task_result, BaseException):
+            raise task_result
+        results[index :: len(contexts)] = task_result
+    return results
 
 
 def url_for(*args, **kwargs):
     from source.app import app
 
     return app.url_path_for(*args, **kwargs)
+
+
+async def create_redis(cls="Connection", **kwargs):  # pragma: nocover
+    """
+    Create an `asyncio_redis` connection, or pool, for `REDIS_URL`.
+    """
+    # Imported lazily, so that Redis is only required if it is configured.
+    import asyncio_redis
+
+    url = urllib.parse.urlsplit(settings.REDIS_URL)
+    return await getattr(asyncio_redis, cls).create(
+        host=url.hostname,
+        port=url.port or 6379,
+        password=url.password,
+        db=int(url.path.lstrip("/") or 0),
+        **kwargs,
+    )
+
+
+async def run_single_flight(key, func, database=database):
+    """
+    Run `func` once for any concurrent calls with the same key, sharing its
+    result between them.
+
+    The call runs on a spare connection of its own, routed to the same
+    replica as the current request, rather than on the first caller's
+    connection, which is released once that caller's request finishes. If
+    the first caller is running within a snapshot then the spare connection
+    imports it, so that all the queries made by `func` see the same data as
+    the rest of the request. If the pool can't provide a spare connection
+    straight away, then each caller runs `func` on its own connection instead.
+    """
+    context = contextvars.Context()
+    context.run(database.routed_replica.set, database.routed_replica.get())
+    spare = context.run(database.connection)
+
+    snapshot = None
+    if key not in single_flight.calls:
+        async with database.connection() as connection:
+            if (
+                spare is not connection
+                and connection.raw_connection.is_in_transaction()
+            ):
+                snapshot = await connection.raw_connection.fetchval(
+                    "SELECT pg_export_snapshot()"
+                )
+
+    async def call():
+        async with contextlib.AsyncExitStack() as stack:
+            try:
+                await asyncio.wait_for(
+                    stack.enter_async_context(spare), SPARE_CONNECTION_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                return NO_SPARE_CONNECTION
+            if snapshot is not None:
+                await spare.raw_connection.execute(SNAPSHOT_BEGIN_QUERY)
+                stack.push_async_callback(spare.raw_connection.execute, "ROLLBACK")
+                await spare.raw_connection.execute(
+                    f"SET TRANSACTION SNAPSHOT '{snapshot}'"
+                )
+            return await func()
+
+    result = await single_flight.run(key, call, context=context)
+    if result is NO_SPARE_CONNECTION:
+        result = await func()
+    return result
@@ -0,0 +1,218 @@
+"""
+A cache of rendered table responses, shared between processes.
+
+Responses are cached in Redis if `REDIS_URL` is configured, so that they are
+shared between all the web processes, or in memory otherwise, which is
+intended for tests and local development.
+
+Entries are keyed by the response's ETag, which is derived from the table's
+write version and the request URL, and expire after `RESPONSE_CACHE_TTL`
+seconds. When a response isn't cached, the first process to request it
+renders it while holding a short lived lock, and any others wait for the
+result to be cached rather than rendering it themselves.
+
+When a table changes, its cached responses are deleted, and the change is
+published to every process, so that they also drop their in-process query
+results for the table.
+"""
+from source import settings
+from source.resources import create_redis, query_cache
+from starlette.responses import Response
+import asyncio
+import collections
+import json
+import logging
+import time
+
+
+logger = logging.getLogger("source.response_cache")
+
+KEY_PREFIX = "hostedapi:responses"
+INVALIDATE_CHANNEL = "hostedapi:invalidate"
+
+# The lock is held for at most this many seconds, in case the process that is
+# rendering the response dies before releasing it.
+LOCK_TIMEOUT = 10
+LOCK_POLL_INTERVAL = 0.05
+
+
+def dump_response(response):
+    return json.dumps(
+        {
+            "status_code": response.status_code,
+            "headers": [
+                (key.decode("latin-1"), value.decode("latin-1"))
+                for key, value in response.raw_headers
+            ],
+            "body": response.body.decode("utf-8"),
+        }
+    )
+
+
+def load_response(content):
+    data = json.loads(content)
+    response = Response(data["body"], status_code=data["status_code"])
+    response.raw_headers = [
+        (key.encode("latin-1"), value.encode("latin-1"))
+        for key, value in data["headers"]
+    ]
+    return response
+
+
+class MemoryBackend:
+    """
+    Holds the cache in the memory of the current process.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.table_keys = collections.defaultdict(set)
+
+    async def connect(self, on_invalidate):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def get(self, key):
+        value, expires_at = self.values.get(key, (None, 0))
+        if time.monotonic() >= expires_at:
+            return None
+        return value
+
+    async def set(self, key, value, ttl, only_if_missing=False):
+        if only_if_missing and await self.get(key) is not None:
+            return False
+        self.values[key] = (value, time.monotonic() + ttl)
+        return True
+
+    async def delete(self, keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    async def track(self, table_pk, key, ttl):
+        self.table_keys[table_pk].add(key)
+
+    async def invalidate(self, table_pk):
+        await self.delete(self.table_keys.pop(table_pk, set()))
+
+
+class RedisBackend:  # pragma: nocover
+    """
+    Holds the cache in Redis, and publishes invalidations to every process
+    over Redis pub/sub.
+    """
+
+    def __init__(self):
+        self.pool = None
+        self.subscription = None
+        self.listener = None
+
+    async def connect(self, on_invalidate):
+        self.pool = await create_redis("Pool", poolsize=4)
+        self.subscription = await create_redis("Connection")
+        subscriber = await self.subscription.start_subscribe()
+        await subscriber.subscribe([INVALIDATE_CHANNEL])
+        self.listener = asyncio.ensure_future(self.listen(subscriber, on_invalidate))
+
+    async def listen(self, subscriber, on_invalidate):
+        while True:
+            reply = await subscriber.next_published()
+            try:
+                on_invalidate(int(reply.value))
+            except Exception:
+                logger.exception("Invalidation %r failed.", reply.value)
+
+    async def disconnect(self):
+        self.listener.cancel()
+        self.subscription.close()
+        self.pool.close()
+
+    async def get(self, key):
+        return await self.pool.get(key)
+
+    async def set(self, key, value, ttl, only_if_missing=False):
+        reply = await self.pool.set(
+            key, value, expire=ttl, only_if_not_exists=only_if_missing
+        )
+        return reply is not None
+
+    async def delete(self, keys):
+        if keys:
+            await self.pool.delete(list(keys))
+
+    async def track(self, table_pk, key, ttl):
+        tracking_key = f"{KEY_PREFIX}:tables:{table_pk}"
+        await self.pool.sadd(tracking_key, [key])
+        await self.pool.expire(tracking_key, ttl)
+
+    async def invalidate(self, table_pk):
+        tracking_key = f"{KEY_PREFIX}:tables:{table_pk}"
+        reply = await self.pool.smembers(tracking_key)
+        keys = await reply.asset()
+        await self.delete(keys | {tracking_key})
+        await self.pool.publish(INVALIDATE_CHANNEL, str(table_pk))
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def connect(self):
+        await self.backend.connect(on_invalidate=self.evict_query_results)
+
+    async def disconnect(self):
+        await self.backend.disconnect()
+
+    def evict_query_results(self, table_pk):
+        query_cache.evict(lambda key: key[0] == table_pk)
+
+    async def fetch(self, table_pk, etag, render):
+        """
+        Return the cached response for a table with the given ETag, or call
+        `render()` to create it, caching it if it is successful.
+        """
+        ttl = settings.RESPONSE_CACHE_TTL
+        if not ttl:
+            return await render()
+
+        key = f"{KEY_PREFIX}:{table_pk}:{etag}"
+        content = await self.backend.get(key)
+        if content is not None:
+            return load_response(content)
+
+        lock_key = f"{key}:lock"
+        if not await self.backend.set(
+            lock_key, "1", LOCK_TIMEOUT, only_if_missing=True
+        ):
+            # Another process is rendering the response, so wait for it to be
+            # cached, or for the lock to be released without caching it.
+            while await self.backend.get(lock_key) is not None:
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+                content = await self.backend.get(key)
+                if content is not None:
+                    return load_response(content)
+            return await render()
+
+        try:
+            response = await render()
+            if response.status_code == 200:
+                await self.backend.set(key, dump_response(response), ttl)
+                await self.backend.track(table_pk, key, ttl)
+        finally:
+            await self.backend.delete([lock_key])
+        return response
+
+    async def invalidate(self, table_pk):
+        """
+        Drop the cached responses and query results for a table that has
+        changed.
+        """
+        self.evict_query_results(table_pk)
+        await self.backend.invalidate(table_pk)
+
+
+if settings.REDIS_URL:  # pragma: nocover
+    response_cache = ResponseCache(RedisBackend())
+else:
+    response_cache = ResponseCache(MemoryBackend())
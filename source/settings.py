@@ -1,6 +1,9 @@
 from starlette.config import Config
+from starlette.datastructures import CommaSeparatedStrings
 import databases
+import os
 import sentry_sdk
+import tempfile
 
 config = Config()
 
@@ -20,6 +23,76 @@ if DATABASE_URL.dialect == "postgres":
 
 TEST_DATABASE_URL = DATABASE_URL.replace(database="test_" + DATABASE_URL.database)
 
+# Read only requests are spread across any read replicas of the database,
+# given as a comma separated list of URLs. Requests from a session that has
+# written within the last `REPLICA_WRITE_WINDOW` seconds read from the primary,
+# and a replica that fails is skipped for `REPLICA_RETRY_INTERVAL` seconds.
+DATABASE_REPLICA_URLS = config(
+    "DATABASE_REPLICA_URLS", cast=CommaSeparatedStrings, default=""
+)
+REPLICA_WRITE_WINDOW = config("REPLICA_WRITE_WINDOW", cast=float, default=5.0)
+REPLICA_RETRY_INTERVAL = config("REPLICA_RETRY_INTERVAL", cast=float, default=10.0)
+
+# The number of worker processes used for CPU bound work, such as parsing
+# uploaded files. Defaults to the number of CPUs on the machine.
+PROCESS_POOL_SIZE = config("PROCESS_POOL_SIZE", cast=int, default=None)
+
+# Independent queries within a request, such as the row counts on the
+# dashboard, are spread across at most this many pooled connections in
+# addition to the request's own connection.
+QUERY_BATCH_CONNECTIONS = config("QUERY_BATCH_CONNECTIONS", cast=int, default=3)
+
+# Background jobs, such as importing uploaded files, are queued in Redis if
+# `REDIS_URL` is set, or in the database otherwise.
+# By default each web process also runs a worker. Set `RUN_WORKER=false` to
+# only process jobs with a separate `python -m source.jobs` worker process,
+# which must be able to read the spooled uploads in `UPLOAD_DIR`.
+REDIS_URL = config("REDIS_URL", cast=str, default="")
+RUN_WORKER = config("RUN_WORKER", cast=bool, default=not TESTING)
+JOB_POLL_INTERVAL = config("JOB_POLL_INTERVAL", cast=float, default=1.0)
+
+# Running jobs record a heartbeat every `JOB_HEARTBEAT_INTERVAL` seconds. A
+# job whose heartbeat is older than `JOB_STALE_TIMEOUT` seconds, because its
+# worker was stopped or crashed, is claimed again by another worker.
+JOB_HEARTBEAT_INTERVAL = config("JOB_HEARTBEAT_INTERVAL", cast=float, default=30.0)
+JOB_STALE_TIMEOUT = config("JOB_STALE_TIMEOUT", cast=float, default=300.0)
+
+# Jobs that remove or rewrite large amounts of stored data, such as purging a
+# deleted table, work through the rows in batches of this size, and sleep for
+# this many seconds between batches to limit their impact on other requests.
+MAINTENANCE_BATCH_SIZE = config("MAINTENANCE_BATCH_SIZE", cast=int, default=10000)
+MAINTENANCE_BATCH_DELAY = config("MAINTENANCE_BATCH_DELAY", cast=float, default=0.1)
+
+# The results of table queries are cached in each process, up to roughly this
+# many bytes. Set `QUERY_CACHE_SIZE=0` to disable the cache.
+QUERY_CACHE_SIZE = config("QUERY_CACHE_SIZE", cast=int, default=64 * 1024 * 1024)
+
+# Rendered table pages and API responses for anonymous users are cached for
+# this many seconds, and shared between processes through Redis. Defaults to
+# 60 seconds if `REDIS_URL` is set, and disabled otherwise.
+RESPONSE_CACHE_TTL = config(
+    "RESPONSE_CACHE_TTL", cast=int, default=60 if REDIS_URL else 0
+)
+
+# Uploaded files are spooled to disk here until they have been imported.
+UPLOAD_DIR = config(
+    "UPLOAD_DIR",
+    cast=str,
+    default=os.path.join(tempfile.gettempdir(), "hostedapi-uploads"),
+)
+
+# Files that are uploaded in a series of chunks may be at most this many bytes.
+MAX_CHUNKED_UPLOAD_SIZE = config(
+    "MAX_CHUNKED_UPLOAD_SIZE", cast=int, default=1024 * 1024 * 1024
+)
+
+# Uploads that are never imported or discarded, including chunked uploads that
+# are never completed, are removed by the workers once they haven't changed
+# for `UPLOAD_EXPIRY` seconds. Workers check for them every
+# `UPLOAD_SWEEP_INTERVAL` seconds.
+UPLOAD_EXPIRY = config("UPLOAD_EXPIRY", cast=float, default=24 * 60 * 60.0)
+UPLOAD_SWEEP_INTERVAL = config("UPLOAD_SWEEP_INTERVAL", cast=float, default=60 * 60.0)
+
 
 # GitHub API
 GITHUB_CLIENT_ID = config("GITHUB_CLIENT_ID", cast=str, default="")
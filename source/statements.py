@@ -0,0 +1,73 @@
+"""
+Queries that are compiled to SQL once, rather than on every call.
+
+Building SQLAlchemy expressions and compiling them is a significant part of
+the CPU time spent on each request, even though the hot queries have the
+same few shapes every time, and only their parameters differ.
+
+A `Statement` compiles a query with named `bindparam()` placeholders when it
+is created, and then just binds the parameters each time it is run. Since
+the SQL text is always the same, asyncpg's per-connection statement cache
+maps each statement to a prepared statement on the server, so it is only
+parsed and planned once per connection.
+
+This relies on a few private attributes of SQLAlchemy's compiled queries and
+of `databases` connections, which the pinned versions of those packages
+provide. `tests/test_statements.py` checks that they are still there, so
+upgrading either package fails loudly rather than at runtime.
+"""
+from databases.backends.postgres import Record
+from source.resources import database
+from sqlalchemy.dialects.postgresql import pypostgresql
+
+
+# Compile queries the same way as `databases` does.
+dialect = pypostgresql.dialect(paramstyle="pyformat")
+dialect.implicit_returning = True
+dialect.supports_native_enum = True
+
+
+class Statement:
+    def __init__(self, query, column_keys=None):
+        """
+        Compile a query, with its parameters given by `bindparam()`, or for
+        INSERT and UPDATE statements by `column_keys`.
+        """
+        compiled = query.compile(dialect=dialect, column_keys=column_keys)
+        self.names = sorted(compiled.params)
+        placeholders = {name: f"${idx}" for idx, name in enumerate(self.names, start=1)}
+        self.sql = compiled.string % placeholders
+        self.processors = [compiled._bind_processors.get(name) for name in self.names]
+        self.result_columns = compiled._result_columns
+
+    def get_args(self, params):
+        """
+        Return the positional arguments for the statement, given the values
+        of its named parameters.
+        """
+        values = [params[name] for name in self.names]
+        return [
+            value if processor is None else processor(value)
+            for value, processor in zip(values, self.processors)
+        ]
+
+    async def run(self, method, params):
+        async with database.connection() as connection:
+            # Queries through `databases` are serialized on each connection,
+            # which may be shared by concurrent tasks, so hold the same lock.
+            async with connection._query_lock:
+                run_query = getattr(connection.raw_connection, method)
+                return await run_query(self.sql, *self.get_args(params))
+
+    async def fetch_all(self, **params):
+        rows = await self.run("fetch", params)
+        return [Record(row, self.result_columns, dialect) for row in rows]
+
+    async def fetch_one(self, **params):
+        row = await self.run("fetchrow", params)
+        if row is None:
+            return None
+        return Record(row, self.result_columns, dialect)
+
+    async def fetch_val(self, **params):
+        return await self.run("fetchval", params)
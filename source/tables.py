@@ -24,6 +24,12 @@ table = sqlalchemy.Table(
     sqlalchemy.Column("identity", sqlalchemy.String, index=True),
     sqlalchemy.Column("name", sqlalchemy.String),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.pk")),
+    sqlalchemy.Column("key_column", sqlalchemy.String, nullable=True),
+    sqlalchemy.Column("deleted_at", sqlalchemy.DateTime, nullable=True),
+    sqlalchemy.Column(
+        "version", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    sqlalchemy.Column("updated_at", sqlalchemy.DateTime, nullable=True),
 )
 
 
@@ -49,6 +55,9 @@ row = sqlalchemy.Table(
     sqlalchemy.Column("table", sqlalchemy.Integer, index=True),
     sqlalchemy.Column("data", sqlalchemy.JSON),
     sqlalchemy.Column("search_text", sqlalchemy.String),
+    sqlalchemy.Column("key", sqlalchemy.String, nullable=True),
+    sqlalchemy.Column("content_hash", sqlalchemy.String, nullable=True),
+    sqlalchemy.Index("ix_row_table_key", "table", "key", unique=True),
 )
 
 
@@ -64,3 +73,22 @@ users = sqlalchemy.Table(
     sqlalchemy.Column("name", sqlalchemy.String),
     sqlalchemy.Column("avatar_url", sqlalchemy.String),
 )
+
+
+job = sqlalchemy.Table(
+    "job",
+    metadata,
+    sqlalchemy.Column("pk", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("created_at", sqlalchemy.DateTime, index=True),
+    sqlalchemy.Column("started_at", sqlalchemy.DateTime),
+    sqlalchemy.Column("finished_at", sqlalchemy.DateTime),
+    sqlalchemy.Column("updated_at", sqlalchemy.DateTime, nullable=True),
+    sqlalchemy.Column("kind", sqlalchemy.String),
+    sqlalchemy.Column("status", sqlalchemy.String, index=True),
+    sqlalchemy.Column("table", sqlalchemy.Integer, index=True),
+    sqlalchemy.Column("params", sqlalchemy.JSON),
+    sqlalchemy.Column("rows_processed", sqlalchemy.Integer),
+    sqlalchemy.Column("rows_total", sqlalchemy.Integer),
+    sqlalchemy.Column("errors", sqlalchemy.JSON),
+    sqlalchemy.Column("summary", sqlalchemy.JSON, nullable=True),
+)
@@ -0,0 +1,267 @@
+"""
+Uploaded files are spooled into `UPLOAD_DIR`, and identified by a token.
+
+Small files are uploaded in a single request. Large files may instead be
+uploaded as a series of chunks, each with a SHA-256 checksum, so that an
+upload that fails part way through can be resumed from the chunks that have
+already been received. Once all the chunks are present they are joined into
+a single spooled file, exactly as if it had been uploaded in one go.
+
+Each upload belongs to the user and table that it was started for, and can
+only be previewed or imported for that table. Uploads that are abandoned,
+rather than being imported or discarded, are expired by the job workers.
+"""
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from source import settings
+import aiofiles
+import hashlib
+import json
+import math
+import os
+import shutil
+import time
+import typing
+import uuid
+
+
+CHUNK_SIZE = 64 * 1024
+
+# The size of each chunk, for uploads that are sent in a series of chunks.
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+
+
+def get_upload_path(token: str) -> str:
+    return os.path.join(settings.UPLOAD_DIR, token)
+
+
+def get_owner_path(token: str) -> str:
+    return get_upload_path(token) + ".owner.json"
+
+
+def save_upload_owner(token: str, owner: str, table_pk: int) -> None:
+    with open(get_owner_path(token), "w") as output:
+        json.dump({"owner": owner, "table": table_pk}, output)
+
+
+def is_upload_owner(token: str, owner: str, table_pk: int) -> bool:
+    """
+    Determine if a spooled upload belongs to the given user and table.
+    """
+    try:
+        with open(get_owner_path(token)) as owner_file:
+            return json.load(owner_file) == {"owner": owner, "table": table_pk}
+    except FileNotFoundError:
+        return False
+
+
+async def spool_upload(upload_file, owner: str, table_pk: int) -> str:
+    """
+    Copy an uploaded file into `UPLOAD_DIR` in fixed size chunks,
+    returning a token that identifies the upload.
+    """
+    os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+    token = str(uuid.uuid4())
+    save_upload_owner(token, owner, table_pk)
+    async with aiofiles.open(get_upload_path(token), "wb") as output:
+        while True:
+            chunk = await upload_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            await output.write(chunk)
+    return token
+
+
+def check_token_or_404(token: str) -> None:
+    """
+    Tokens are always UUIDs, which ensures that they can't refer to any
+    other files.
+    """
+    try:
+        is_valid = str(uuid.UUID(token)) == token
+    except ValueError:
+        is_valid = False
+    if not is_valid:
+        raise HTTPException(status_code=404)
+
+
+def load_upload_path_or_404(token: str, owner: str, table_pk: int) -> str:
+    """
+    Return the path of a previously spooled upload.
+    """
+    check_token_or_404(token)
+    path = get_upload_path(token)
+    if not is_upload_owner(token, owner, table_pk) or not os.path.exists(path):
+        raise HTTPException(status_code=404)
+    return path
+
+
+def claim_upload(token: str, owner: str, table_pk: int) -> typing.Optional[str]:
+    """
+    Take a previously spooled upload, so that it can only be imported or
+    discarded once, even if the request is repeated.
+
+    The upload is atomically moved to a path that no token refers to, which
+    is returned, or `None` if the upload has already been claimed.
+    """
+    check_token_or_404(token)
+    owner_path = get_owner_path(token)
+    if os.path.exists(owner_path) and not is_upload_owner(token, owner, table_pk):
+        raise HTTPException(status_code=404)
+    path = get_upload_path(token)
+    claimed_path = f"{path}.claimed"
+    try:
+        os.rename(path, claimed_path)
+    except FileNotFoundError:
+        return None
+    # The owner is only removed once the upload has been moved, so it is
+    # always checked while the upload can still be claimed.
+    os.remove(owner_path)
+    return claimed_path
+
+
+def expire_uploads(max_age: float) -> None:
+    """
+    Remove any spooled uploads, and their owners, along with the parts of any
+    chunked uploads that were never completed, that haven't changed for
+    `max_age` seconds. Claimed uploads are left to the jobs importing them.
+    """
+    if not os.path.isdir(settings.UPLOAD_DIR):
+        return
+    expires_at = time.time() - max_age
+    for entry in os.scandir(settings.UPLOAD_DIR):
+        if entry.name.endswith(".claimed"):
+            continue
+        try:
+            if entry.stat().st_mtime >= expires_at:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            # The upload was claimed, or removed by another worker.
+            pass
+
+
+class ChunkedUpload:
+    def __init__(self, token, owner, table, size, chunk_size):
+        self.token = token
+        self.owner = owner
+        self.table = table
+        self.size = size
+        self.chunk_size = chunk_size
+        self.parts_dir = get_upload_path(token) + ".parts"
+
+    @property
+    def chunk_count(self):
+        return max(math.ceil(self.size / self.chunk_size), 1)
+
+    @property
+    def received_chunks(self):
+        return sorted(
+            int(name) for name in os.listdir(self.parts_dir) if name.isdigit()
+        )
+
+    @property
+    def is_complete(self):
+        return len(self.received_chunks) == self.chunk_count
+
+    def get_chunk_path(self, index):
+        return os.path.join(self.parts_dir, str(index))
+
+    def get_chunk_length(self, index):
+        if index < self.chunk_count - 1:
+            return self.chunk_size
+        return self.size - self.chunk_size * (self.chunk_count - 1)
+
+    def serialize(self):
+        return {
+            "token": self.token,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "chunk_count": self.chunk_count,
+            "received_chunks": self.received_chunks,
+        }
+
+    async def save_chunk(self, index, stream, checksum):
+        """
+        Spool a single chunk to disk, from an async iterator of bytes.
+
+        The chunk is only kept if its length and checksum are as expected,
+        so any chunks that are present can always be trusted.
+        """
+        if index >= self.chunk_count:
+            raise HTTPException(status_code=404)
+
+        length = 0
+        digest = hashlib.sha256()
+        path = self.get_chunk_path(index)
+        temp_path = f"{path}.{uuid.uuid4()}"
+        try:
+            async with aiofiles.open(temp_path, "wb") as output:
+                async for data in stream:
+                    length += len(data)
+                    if length > self.chunk_size:
+                        raise HTTPException(status_code=400, detail="Chunk too large.")
+                    digest.update(data)
+                    await output.write(data)
+
+            if length != self.get_chunk_length(index):
+                raise HTTPException(status_code=400, detail="Incorrect chunk length.")
+            if digest.hexdigest() != checksum.lower():
+                raise HTTPException(status_code=400, detail="Checksum mismatch.")
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    async def assemble(self):
+        """
+        Join all the chunks into a single spooled file, returning its path.
+        """
+        if not self.is_complete:
+            raise HTTPException(status_code=400, detail="Upload is incomplete.")
+        path = get_upload_path(self.token)
+        save_upload_owner(self.token, self.owner, self.table)
+        await run_in_threadpool(self.join_chunks, path)
+        return path
+
+    def join_chunks(self, path):
+        temp_path = f"{path}.assembling"
+        with open(temp_path, "wb") as output:
+            for index in range(self.chunk_count):
+                with open(self.get_chunk_path(index), "rb") as chunk:
+                    shutil.copyfileobj(chunk, output, CHUNK_SIZE)
+        os.replace(temp_path, path)
+        shutil.rmtree(self.parts_dir)
+
+
+def create_chunked_upload(owner: str, table_pk: int, size: int) -> ChunkedUpload:
+    token = str(uuid.uuid4())
+    upload = ChunkedUpload(token, owner, table_pk, size, UPLOAD_CHUNK_SIZE)
+    os.makedirs(upload.parts_dir)
+    manifest = {
+        "owner": owner,
+        "table": table_pk,
+        "size": size,
+        "chunk_size": upload.chunk_size,
+    }
+    with open(os.path.join(upload.parts_dir, "manifest.json"), "w") as output:
+        json.dump(manifest, output)
+    return upload
+
+
+def load_chunked_upload_or_404(token: str, owner: str, table_pk: int) -> ChunkedUpload:
+    check_token_or_404(token)
+    manifest_path = os.path.join(get_upload_path(token) + ".parts", "manifest.json")
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404)
+    if manifest["owner"] != owner or manifest["table"] != table_pk:
+        raise HTTPException(status_code=404)
+    return ChunkedUpload(
+        token, owner, table_pk, manifest["size"], manifest["chunk_size"]
+    )
@@ -0,0 +1,199 @@
+"""
+Fast validation of table rows.
+
+Validating a row with `typesystem` runs through a good deal of generic
+machinery for each value. Table schemas only ever use a handful of field
+types, so we instead compile a validator for each schema, with a function
+specialised to each field's options. These return exactly the same values and
+error messages as `typesystem` does, and fall back to it for any fields that
+aren't handled here.
+"""
+from typesystem.base import Message, ValidationError, ValidationResult
+from typesystem.fields import FORMATS
+import decimal
+import math
+import typesystem
+
+
+def compile_string(field):
+    allow_null = field.allow_null
+    allow_blank = field.allow_blank
+    trim_whitespace = field.trim_whitespace
+    max_length = field.max_length
+    format = FORMATS.get(field.format)
+
+    def validate(value):
+        if value is None and allow_null:
+            return None
+        elif value is None and allow_blank:
+            return ""
+        elif value is None:
+            raise field.validation_error("null")
+        elif format is not None and format.is_native_type(value):
+            return field.serialize(value)
+        elif not isinstance(value, str):
+            raise field.validation_error("type")
+
+        value = value.replace("\0", "")
+        if trim_whitespace:
+            value = value.strip()
+
+        if not value and not allow_blank:
+            if allow_null:
+                return None
+            raise field.validation_error("blank")
+
+        if max_length is not None and len(value) > max_length:
+            raise field.validation_error("max_length")
+
+        if format is not None:
+            return field.serialize(format.validate(value))
+        return value
+
+    return validate
+
+
+def compile_number(field):
+    allow_null = field.allow_null
+    numeric_type = field.numeric_type
+
+    def validate(value):
+        if value is None and allow_null:
+            return None
+        elif value == "" and allow_null:
+            return None
+        elif value is None:
+            raise field.validation_error("null")
+        elif isinstance(value, bool):
+            raise field.validation_error("type")
+        elif (
+            numeric_type is int and isinstance(value, float) and not value.is_integer()
+        ):
+            raise field.validation_error("integer")
+
+        try:
+            # Plain numeric strings are by far the most common case, so try
+            # casting directly, before the more lenient parsing of a decimal.
+            value = numeric_type(value)
+        except (TypeError, ValueError):
+            if not isinstance(value, str):
+                raise field.validation_error("type")
+            try:
+                value = numeric_type(decimal.Decimal(value))
+            except (TypeError, ValueError, decimal.InvalidOperation):
+                raise field.validation_error("type")
+
+        if not math.isfinite(value):
+            raise field.validation_error("finite")
+        return value
+
+    return validate
+
+
+def compile_boolean(field):
+    allow_null = field.allow_null
+    coerce_values = field.coerce_values
+    coerce_null_values = field.coerce_null_values
+
+    def validate(value):
+        if value is None and allow_null:
+            return None
+        elif value is None:
+            raise field.validation_error("null")
+        elif isinstance(value, bool):
+            return value
+
+        if isinstance(value, str):
+            value = value.lower()
+        if allow_null and value in coerce_null_values:
+            return None
+        try:
+            return coerce_values[value]
+        except (KeyError, TypeError):
+            raise field.validation_error("type")
+
+    return validate
+
+
+def compile_field(field):
+    """
+    Return a function that validates and serializes a single value for the
+    field, raising a `ValidationError` if it is invalid.
+    """
+    # Only fields that use the standard `validate` methods, and don't have
+    # any of the less common options set, can be compiled.
+    field_class = type(field)
+    if (
+        field_class.validate is typesystem.String.validate
+        and field.min_length is None
+        and field.pattern is None
+        and field.format in (None, "date")
+    ):
+        return compile_string(field)
+    elif (
+        field_class.validate is typesystem.Number.validate
+        and field.numeric_type in (int, float)
+        and field.minimum is None
+        and field.maximum is None
+        and field.exclusive_minimum is None
+        and field.exclusive_maximum is None
+        and field.precision is None
+        and field.multiple_of is None
+    ):
+        return compile_number(field)
+    elif field_class.validate is typesystem.Boolean.validate:
+        return compile_boolean(field)
+
+    def validate(value):
+        return field.serialize(field.validate(value))
+
+    return validate
+
+
+class RowValidator:
+    """
+    Validates rows against a `typesystem.Schema` class, returning the
+    serialized data, as `dict(Schema.validate(row))` would.
+    """
+
+    def __init__(self, schema):
+        self.fields = []
+        for key, field in schema.fields.items():
+            if field.has_default():
+                default = field.serialize(field.get_default_value())
+                required = False
+            else:
+                default = None
+                required = True
+            self.fields.append((key, compile_field(field), required, default))
+        self.required_text = typesystem.Object.errors["required"]
+
+    def validate(self, data):
+        validated = {}
+        required_messages = []
+        error_messages = []
+        for key, validate_field, required, default in self.fields:
+            if key not in data:
+                if required:
+                    message = Message(
+                        text=self.required_text, code="required", index=[key]
+                    )
+                    required_messages.append(message)
+                else:
+                    validated[key] = default
+                continue
+            try:
+                validated[key] = validate_field(data[key])
+            except ValidationError as error:
+                error_messages += error.messages(add_prefix=key)
+
+        if required_messages or error_messages:
+            raise ValidationError(messages=required_messages + error_messages)
+        return validated
+
+    def validate_or_error(self, data):
+        try:
+            value = self.validate(data)
+        except ValidationError as error:
+            return ValidationResult(value=None, error=error)
+        return ValidationResult(value=value, error=None)
@@ -1,13 +1,28 @@
-from source import tables
+from source import (
+    csv_utils,
+    importer,
+    jobs,
+    maintenance,
+    settings,
+    tables,
+    uploads,
+)
 from source.app import app
-from source.resources import database
+from source.datasource import TableDataSource, load_datasource_or_404
+from source.resources import database, query_cache
 from starlette.datastructures import URL
 from sqlalchemy import func, select
 from tests.client import TestClient
+import asyncio
 import datetime
+import gzip
+import hashlib
+import io
 import pytest
 import json
+import os
 import tempfile
+import time
 import uuid
 
 
@@ -532,10 +547,353 @@ async def test_complete_column_delete(client):
         response = await client.post(url, allow_redirects=False)
         assert response.is_redirect
 
+    await jobs.run_pending_jobs()
     row_count = await database.fetch_val(query)
     assert row_count == 0
 
 
+@pytest.mark.asyncio
+async def test_column_delete_removes_values(client, monkeypatch):
+    """
+    Deleting a column removes its values from the stored rows, in batches.
+    """
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_SIZE", 3)
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_DELAY", 0)
+
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    # Rows that are missing the column are left alone.
+    query = tables.row.insert()
+    values = {
+        "created_at": datetime.datetime.now(),
+        "uuid": str(uuid.uuid4()),
+        "table": table["pk"],
+        "data": {"constituency": "Hove"},
+        "search_text": "Hove",
+    }
+    await database.execute(query, values)
+
+    url = app.url_path_for(
+        "delete-column",
+        username=user["username"],
+        table_id=table["identity"],
+        column_id="party",
+    )
+    await client.post(url)
+
+    url = app.url_path_for(
+        "table", username=user["username"], table_id=table["identity"]
+    )
+    response = await client.get(url)
+    assert response.context["jobs"][0].kind == "drop_column"
+
+    assert await jobs.run_pending_jobs() == 1
+    query = tables.row.select().where(tables.row.c.table == table["pk"])
+    for row in await database.fetch_all(query):
+        assert "party" not in row["data"]
+        assert "Green" not in row["search_text"]
+
+    query = tables.job.select().where(tables.job.c.table == table["pk"])
+    job = await database.fetch_one(query)
+    assert job["status"] == "complete"
+    assert job["rows_processed"] == job["rows_total"] == len(rows) + 1
+
+
+@pytest.mark.asyncio
+async def test_column_delete_and_recreate(client):
+    """
+    Values are kept if a column with the same name is created again before
+    the old values have been removed.
+    """
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    url = app.url_path_for(
+        "delete-column",
+        username=user["username"],
+        table_id=table["identity"],
+        column_id="party",
+    )
+    await client.post(url)
+
+    url = app.url_path_for(
+        "columns", username=user["username"], table_id=table["identity"]
+    )
+    await client.post(url, data={"name": "party", "datatype": "string"})
+
+    assert await jobs.run_pending_jobs() == 1
+    query = tables.row.select().where(tables.row.c.table == table["pk"])
+    for row in await database.fetch_all(query):
+        assert "party" in row["data"]
+
+
+@pytest.mark.asyncio
+async def test_column_retype(client, monkeypatch):
+    """
+    Changing the datatype of a column converts its values in batches.
+    """
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_SIZE", 3)
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_DELAY", 0)
+
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    # Rows that are missing the column are left alone.
+    query = tables.row.insert()
+    values = {
+        "created_at": datetime.datetime.now(),
+        "uuid": str(uuid.uuid4()),
+        "table": table["pk"],
+        "data": {"constituency": "Hove"},
+        "search_text": "Hove",
+    }
+    await database.execute(query, values)
+
+    url = app.url_path_for(
+        "retype-column",
+        username=user["username"],
+        table_id=table["identity"],
+        column_id="votes",
+    )
+    response = await client.post(
+        url, data={"datatype": "string"}, allow_redirects=False
+    )
+    assert response.is_redirect
+
+    url = app.url_path_for(
+        "table", username=user["username"], table_id=table["identity"]
+    )
+    response = await client.get(url)
+    assert response.context["jobs"][0].kind == "retype_column"
+
+    assert await jobs.run_pending_jobs() == 1
+    query = (
+        tables.row.select()
+        .where(tables.row.c.table == table["pk"])
+        .order_by(tables.row.c.pk)
+    )
+    votes = [row["data"].get("votes") for row in await database.fetch_all(query)]
+    assert sorted(votes[:-1]) == sorted(str(row["data"]["votes"]) for row in rows)
+    assert votes[-1] is None
+
+    query = (
+        select([tables.column.c.datatype])
+        .where(tables.column.c.table == table["pk"])
+        .where(tables.column.c.identity == "votes")
+    )
+    assert await database.fetch_val(query) == "string"
+
+    query = tables.job.select().where(tables.job.c.table == table["pk"])
+    job = await database.fetch_one(query)
+    assert job["status"] == "complete"
+    assert job["rows_processed"] == job["rows_total"] == (len(rows) + 1) * 3
+
+
+@pytest.mark.asyncio
+async def test_column_retype_ordering(client, monkeypatch):
+    """
+    A table can be ordered by a column while its values are being converted,
+    and so are a mix of types.
+    """
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_SIZE", 2)
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_DELAY", 0)
+
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    # A row that is missing the column.
+    query = tables.row.insert()
+    values = {
+        "created_at": datetime.datetime.now(),
+        "uuid": str(uuid.uuid4()),
+        "table": table["pk"],
+        "data": {"constituency": "Hove"},
+        "search_text": "Hove",
+    }
+    await database.execute(query, values)
+
+    table_url = app.url_path_for(
+        "table", username=user["username"], table_id=table["identity"]
+    )
+    responses = []
+
+    async def throttle():
+        if not responses:
+            responses.append(await client.get(table_url + "?order=votes"))
+
+    monkeypatch.setattr(maintenance, "throttle", throttle)
+
+    url = app.url_path_for(
+        "retype-column",
+        username=user["username"],
+        table_id=table["identity"],
+        column_id="votes",
+    )
+    await client.post(url, data={"datatype": "string", "force": "on"})
+    assert await jobs.run_pending_jobs() == 1
+
+    # The first batch had been converted when the table was fetched.
+    response = responses[0]
+    assert response.status_code == 200
+    votes = [item.get("votes") for item in response.context["queryset"]]
+    assert len(set(type(value) for value in votes)) == 3
+    assert votes[0] is None
+    numbers = [value for value in votes if isinstance(value, int)]
+    text = [value for value in votes if isinstance(value, str)]
+    assert votes[1:] == sorted(numbers) + sorted(text)
+
+
+@pytest.mark.asyncio
+async def test_column_retype_invalid_values(client, monkeypatch):
+    """
+    Changing the datatype of a column fails without changing anything if some
+    values can't be converted, unless the conversion is forced.
+    """
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_SIZE", 3)
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_DELAY", 0)
+
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    retype_url = app.url_path_for(
+        "retype-column",
+        username=user["username"],
+        table_id=table["identity"],
+        column_id="party",
+    )
+    await client.post(retype_url, data={"datatype": "integer"})
+    assert await jobs.run_pending_jobs() == 1
+
+    url = app.url_path_for(
+        "table", username=user["username"], table_id=table["identity"]
+    )
+    response = await client.get(url)
+    job = response.context["jobs"][0]
+    assert job.status == "failed"
+    assert job.errors == [
+        '7 values can\'t be converted to integer, such as "Green" and "Labour" '
+        'and "Conservative".'
+    ]
+    assert retype_url in response.text
+
+    query = tables.row.select().where(tables.row.c.table == table["pk"])
+    for row in await database.fetch_all(query):
+        assert isinstance(row["data"]["party"], str)
+
+    query = (
+        select([tables.column.c.datatype])
+        .where(tables.column.c.table == table["pk"])
+        .where(tables.column.c.identity == "party")
+    )
+    assert await database.fetch_val(query) == "string"
+
+    await client.post(retype_url, data={"datatype": "integer", "force": "on"})
+    assert await jobs.run_pending_jobs() == 1
+
+    query = tables.row.select().where(tables.row.c.table == table["pk"])
+    for row in await database.fetch_all(query):
+        assert row["data"]["party"] is None
+
+    query = (
+        select([tables.column.c.datatype])
+        .where(tables.column.c.table == table["pk"])
+        .where(tables.column.c.identity == "party")
+    )
+    assert await database.fetch_val(query) == "integer"
+
+
+@pytest.mark.asyncio
+async def test_column_retype_fractional_values(client):
+    """
+    Numbers with a fractional part can't be converted to integers, rather
+    than being truncated.
+    """
+    user = await create_user()
+    client.login(user)
+
+    url = app.url_path_for("profile", username=user["username"])
+    await client.post(url, data={"name": "new table"})
+    csv_file = io.BytesIO(b"name,score\ntom,1\nlucy,2.5\nrose,3.9\nbob,4.0\n")
+    await upload_and_import(client, user, "new-table", csv_file)
+    assert await jobs.run_pending_jobs() == 1
+
+    retype_url = app.url_path_for(
+        "retype-column",
+        username=user["username"],
+        table_id="new-table",
+        column_id="score",
+    )
+    await client.post(retype_url, data={"datatype": "integer"})
+    assert await jobs.run_pending_jobs() == 1
+
+    url = app.url_path_for("table", username=user["username"], table_id="new-table")
+    response = await client.get(url)
+    job = response.context["jobs"][0]
+    assert job.status == "failed"
+    assert job.errors == [
+        "2 values can't be converted to integer, such as 2.5 and 3.9."
+    ]
+
+    await client.post(retype_url, data={"datatype": "integer", "force": "on"})
+    assert await jobs.run_pending_jobs() == 1
+
+    response = await client.get(url, headers={"Accept": "application/json"})
+    assert [row["score"] for row in response.json()] == [1, None, None, 4]
+
+
+@pytest.mark.asyncio
+async def test_column_retype_rejected(client):
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    url = app.url_path_for(
+        "retype-column",
+        username=user["username"],
+        table_id=table["identity"],
+        column_id="votes",
+    )
+    response = await client.post(url, data={"datatype": "money"})
+    assert response.status_code == 400
+
+    url = app.url_path_for(
+        "retype-column",
+        username=user["username"],
+        table_id=table["identity"],
+        column_id="missing",
+    )
+    response = await client.post(url, data={"datatype": "string"})
+    assert response.status_code == 404
+
+    # The key column can't be retyped, since that would change its keys.
+    url = app.url_path_for(
+        "columns", username=user["username"], table_id=table["identity"]
+    )
+    await client.post(url, data={"action": "set-key", "key_column": "surname"})
+    assert await jobs.run_pending_jobs() == 1
+    url = app.url_path_for(
+        "retype-column",
+        username=user["username"],
+        table_id=table["identity"],
+        column_id="surname",
+    )
+    response = await client.post(url, data={"datatype": "integer"})
+    assert response.status_code == 400
+
+    query = (
+        select([func.count()])
+        .select_from(tables.job)
+        .where(tables.job.c.kind == "retype_column")
+    )
+    assert await database.fetch_val(query) == 0
+
+
 @pytest.mark.asyncio
 async def test_table_delete(client):
     """
@@ -546,63 +904,1204 @@ async def test_table_delete(client):
     client.login(user)
 
     url = app.url_path_for(
-        "delete-table", username=user["username"], table_id=table["identity"]
+        "delete-table", username=user["username"], table_id=table["identity"]
+    )
+    response = await client.post(url, allow_redirects=False)
+    expected_redirect = app.url_path_for("profile", username=user["username"])
+
+    assert response.is_redirect
+    assert URL(response.headers["location"]).path == expected_redirect
+
+
+@pytest.mark.asyncio
+async def test_table_delete_purges_rows(client, monkeypatch):
+    """
+    Deleted tables are hidden immediately, and then purged in batches.
+    """
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_SIZE", 3)
+    monkeypatch.setattr(settings, "MAINTENANCE_BATCH_DELAY", 0)
+
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    url = app.url_path_for(
+        "delete-table", username=user["username"], table_id=table["identity"]
+    )
+    await client.post(url)
+
+    url = app.url_path_for(
+        "table", username=user["username"], table_id=table["identity"]
+    )
+    response = await client.get(url)
+    assert response.status_code == 404
+    url = app.url_path_for("profile", username=user["username"])
+    response = await client.get(url)
+    assert response.context["rows"] == []
+
+    # The table name may be reused straight away.
+    response = await client.post(url, data={"name": table["name"]})
+    assert len(response.context["rows"]) == 1
+
+    query = select([func.count()]).where(tables.row.c.table == table["pk"])
+    assert await database.fetch_val(query) == len(rows)
+
+    assert await jobs.run_pending_jobs() == 1
+    assert await database.fetch_val(query) == 0
+    query = select([func.count()]).where(tables.column.c.table == table["pk"])
+    assert await database.fetch_val(query) == 0
+    query = tables.table.select().where(tables.table.c.pk == table["pk"])
+    assert await database.fetch_one(query) is None
+
+    query = tables.job.select().where(tables.job.c.table == table["pk"])
+    job = await database.fetch_one(query)
+    assert job["status"] == "complete"
+    assert job["rows_processed"] == job["rows_total"] == len(rows)
+
+
+@pytest.mark.asyncio
+async def test_delete(client):
+    """
+    Test row delete.
+    """
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    url = app.url_path_for(
+        "delete-row",
+        username=user["username"],
+        table_id=table["identity"],
+        row_uuid=rows[0]["uuid"],
+    )
+    response = await client.post(url, allow_redirects=False)
+    expected_redirect = app.url_path_for(
+        "table", username=user["username"], table_id=table["identity"]
+    )
+
+    assert response.is_redirect
+    assert URL(response.headers["location"]).path == expected_redirect
+
+
+async def upload_and_import(client, user, table_id, csv_file, delete_missing=False):
+    """
+    Upload a file, and confirm the import from the preview page.
+    """
+    url = app.url_path_for("upload", username=user["username"], table_id=table_id)
+    files = {"upload-file": ("upload.csv", csv_file)}
+    response = await client.post(url, files=files, allow_redirects=False)
+    preview_url = URL(response.headers["location"]).path
+    data = {"action": "import"}
+    if delete_missing:
+        data["delete_missing"] = "on"
+    await client.post(preview_url, data=data)
+
+
+@pytest.mark.asyncio
+async def test_upload(client, mock_csv):
+    user = await create_user()
+    client.login(user)
+    csv_file = open(mock_csv.name, "r")
+
+    url = app.url_path_for("profile", username=user["username"])
+    data = {"name": "new table"}
+    response = await client.post(url, data=data, allow_redirects=False)
+    expected_redirect = url
+
+    assert response.is_redirect
+    assert URL(response.headers["location"]).path == expected_redirect
+
+    url = app.url_path_for("upload", username=user["username"], table_id="new-table")
+    response = await client.post(
+        url, files={"upload-file": csv_file}, allow_redirects=False
+    )
+    assert response.is_redirect
+    preview_url = URL(response.headers["location"]).path
+
+    # The upload is previewed before being imported.
+    response = await client.get(preview_url)
+    assert response.template.name == "upload.html"
+    assert response.context["preview_columns"] == [
+        ("name", "name", "string"),
+        ("score", "score", "integer"),
+    ]
+    assert response.context["preview"].rows == [
+        ["tom", "123"],
+        ["lucy", "456"],
+        ["rose", "789"],
+    ]
+
+    response = await client.post(
+        preview_url, data={"action": "import"}, allow_redirects=False
+    )
+    expected_redirect = app.url_path_for(
+        "table", username=user["username"], table_id="new-table"
+    )
+
+    assert response.is_redirect
+    assert URL(response.headers["location"]).path == expected_redirect
+
+    # The upload is queued as a background job, which reports its progress.
+    response = await client.get(expected_redirect)
+    job = response.context["jobs"][0]
+    assert job.status == "pending"
+
+    job_url = app.url_path_for(
+        "job", username=user["username"], table_id="new-table", job_id=job.pk
+    )
+    response = await client.get(job_url)
+    assert response.status_code == 200
+    assert response.json()["status"] == "pending"
+
+    assert await jobs.run_pending_jobs() == 1
+
+    response = await client.get(job_url)
+    assert response.json() == {
+        "kind": "import",
+        "status": "complete",
+        "rows_processed": 3,
+        "rows_total": 3,
+        "percent_complete": 100,
+        "eta": None,
+        "errors": [],
+        "summary": None,
+    }
+
+    response = await client.get(expected_redirect)
+    rendered_names = [item["name"] for item in response.context["queryset"]]
+    rendered_scores = [item["score"] for item in response.context["queryset"]]
+    assert rendered_names == ["tom", "lucy", "rose"]
+    assert rendered_scores == [123, 456, 789]
+    assert response.context["jobs"] == []
+
+    # The table can be re-imported, now that it has columns and rows.
+    assert 'id="uploadForm"' in response.text
+
+    client.cookies.clear()
+    response = await client.get(expected_redirect)
+    assert 'id="uploadForm"' not in response.text
+
+
+@pytest.mark.asyncio
+async def test_upload_typed_columns(client):
+    user = await create_user()
+    client.login(user)
+
+    url = app.url_path_for("profile", username=user["username"])
+    await client.post(url, data={"name": "new table"})
+
+    csv_file = io.BytesIO(
+        b"name,height,member,joined\n"
+        b"tom,1.8,true,2019-01-31\n"
+        b"lucy,1.65,false,\n"
+        b"rose,,TRUE,2020-02-29\n"
+    )
+    await upload_and_import(client, user, "new-table", csv_file)
+    await jobs.run_pending_jobs()
+
+    url = app.url_path_for("columns", username=user["username"], table_id="new-table")
+    response = await client.get(url)
+    datatypes = [column["datatype"] for column in response.context["columns"]]
+    assert datatypes == ["string", "float", "boolean", "date"]
+
+    url = app.url_path_for("table", username=user["username"], table_id="new-table")
+    data = {"name": "zoe", "height": "1.7", "member": "false", "joined": "2020-03-01"}
+    response = await client.post(url, data=data, allow_redirects=False)
+    assert response.is_redirect
+
+    response = await client.get(url, headers={"Accept": "application/json"})
+    assert response.json() == [
+        {"name": "tom", "height": 1.8, "member": True, "joined": "2019-01-31"},
+        {"name": "lucy", "height": 1.65, "member": False, "joined": None},
+        {"name": "rose", "height": None, "member": True, "joined": "2020-02-29"},
+        {"name": "zoe", "height": 1.7, "member": False, "joined": "2020-03-01"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_compressed_upload(client):
+    user = await create_user()
+    client.login(user)
+
+    url = app.url_path_for("profile", username=user["username"])
+    await client.post(url, data={"name": "new table"})
+
+    csv_file = io.BytesIO(gzip.compress(b"name,score\ntom,123\nlucy,456\n"))
+    await upload_and_import(client, user, "new-table", csv_file)
+    await jobs.run_pending_jobs()
+
+    url = app.url_path_for("table", username=user["username"], table_id="new-table")
+    response = await client.get(url, headers={"Accept": "application/json"})
+    assert response.json() == [
+        {"name": "tom", "score": 123},
+        {"name": "lucy", "score": 456},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_json_upload(client, monkeypatch):
+    monkeypatch.setattr(importer, "CHUNK_SIZE", 2)
+
+    user = await create_user()
+    client.login(user)
+
+    url = app.url_path_for("profile", username=user["username"])
+    await client.post(url, data={"name": "new table"})
+
+    records = [
+        {"name": "tom", "score": 123},
+        {"name": "lucy", "score": 456, "member": True},
+        {"name": "rose", "score": 7.5},
+    ]
+    json_file = io.BytesIO(json.dumps(records).encode("utf-8"))
+    url = app.url_path_for("upload", username=user["username"], table_id="new-table")
+    files = {"upload-file": ("upload.json", json_file)}
+    response = await client.post(url, files=files, allow_redirects=False)
+    preview_url = URL(response.headers["location"]).path
+
+    response = await client.get(preview_url)
+    assert response.context["preview"].names == ["name", "score", "member"]
+    assert response.context["preview"].types == ["string", "float", "boolean"]
+
+    await client.post(preview_url, data={"action": "import"})
+    await jobs.run_pending_jobs()
+
+    url = app.url_path_for("table", username=user["username"], table_id="new-table")
+    response = await client.get(url, headers={"Accept": "application/json"})
+    assert response.json() == [
+        {"name": "tom", "score": 123, "member": None},
+        {"name": "lucy", "score": 456, "member": True},
+        {"name": "rose", "score": 7.5, "member": None},
+    ]
+
+    # Newline delimited JSON is also supported.
+    url = app.url_path_for("profile", username=user["username"])
+    await client.post(url, data={"name": "other table"})
+    json_file = io.BytesIO(b'{"name": "tom"}\n{"name": "lucy"}\n')
+    await upload_and_import(client, user, "other-table", json_file)
+    await jobs.run_pending_jobs()
+
+    url = app.url_path_for("table", username=user["username"], table_id="other-table")
+    response = await client.get(url, headers={"Accept": "application/json"})
+    assert response.json() == [{"name": "tom"}, {"name": "lucy"}]
+
+
+@pytest.mark.asyncio
+async def test_empty_json_upload(client):
+    user = await create_user()
+    client.login(user)
+
+    url = app.url_path_for("profile", username=user["username"])
+    await client.post(url, data={"name": "new table"})
+
+    await upload_and_import(client, user, "new-table", io.BytesIO(b"[]"))
+    await jobs.run_pending_jobs()
+
+    url = app.url_path_for("table", username=user["username"], table_id="new-table")
+    response = await client.get(url)
+    failed_job = response.context["jobs"][0]
+    assert failed_job.status == "failed"
+    assert failed_job.errors == ["The uploaded file does not contain any data."]
+
+
+@pytest.mark.asyncio
+async def test_upload_in_chunks(client, monkeypatch):
+    monkeypatch.setattr(csv_utils, "CSV_BLOCK_SIZE", 16)
+    monkeypatch.setattr(csv_utils, "NORMALIZE_SAMPLE_SIZE", 2)
+    monkeypatch.setattr(importer, "process_pool_size", 2)
+
+    user = await create_user()
+    client.login(user)
+
+    url = app.url_path_for("profile", username=user["username"])
+    await client.post(url, data={"name": "new table"})
+
+    # Values in later chunks widen the types decided from the first chunk.
+    lines = ["name,score,member"] + [f"name {idx},{idx},true" for idx in range(7)]
+    lines[6] = "name 5,5.5,true"
+    lines[7] = "name 6,6,unknown"
+    csv_file = io.BytesIO("\n".join(lines).encode("utf-8"))
+    await upload_and_import(client, user, "new-table", csv_file)
+    await jobs.run_pending_jobs()
+
+    url = app.url_path_for("columns", username=user["username"], table_id="new-table")
+    response = await client.get(url)
+    datatypes = [column["datatype"] for column in response.context["columns"]]
+    assert datatypes == ["string", "float", "string"]
+
+    url = app.url_path_for("table", username=user["username"], table_id="new-table")
+    response = await client.get(url, headers={"Accept": "application/json"})
+    assert [item["score"] for item in response.json()] == [0, 1, 2, 3, 4, 5.5, 6]
+
+
+@pytest.mark.asyncio
+async def test_empty_upload(client):
+    user = await create_user()
+    client.login(user)
+
+    url = app.url_path_for("profile", username=user["username"])
+    await client.post(url, data={"name": "new table"})
+
+    await upload_and_import(client, user, "new-table", io.BytesIO(b""))
+    await jobs.run_pending_jobs()
+
+    url = app.url_path_for("table", username=user["username"], table_id="new-table")
+    response = await client.get(url)
+    failed_job = response.context["jobs"][0]
+    assert failed_job.status == "failed"
+    assert failed_job.errors == ["The uploaded file does not contain any data."]
+
+
+@pytest.mark.asyncio
+async def test_upload_preview_cancel(client, mock_csv):
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    url = app.url_path_for(
+        "upload", username=user["username"], table_id=table["identity"]
+    )
+    files = {"upload-file": open(mock_csv.name, "rb")}
+    response = await client.post(url, files=files, allow_redirects=False)
+    preview_url = URL(response.headers["location"]).path
+
+    response = await client.post(preview_url, data={"action": "cancel"})
+    assert response.template.name == "table.html"
+    assert response.context["jobs"] == []
+
+    # The upload has been discarded.
+    response = await client.get(preview_url)
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_upload_preview_resubmitted(client, mock_csv):
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    url = app.url_path_for(
+        "upload", username=user["username"], table_id=table["identity"]
+    )
+    files = {"upload-file": open(mock_csv.name, "rb")}
+    response = await client.post(url, files=files, allow_redirects=False)
+    preview_url = URL(response.headers["location"]).path
+
+    # Submitting the form again only imports the upload once.
+    await client.post(preview_url, data={"action": "import"})
+    response = await client.post(preview_url, data={"action": "import"})
+    assert response.template.name == "table.html"
+    assert len(response.context["jobs"]) == 1
+
+    response = await client.post(preview_url, data={"action": "cancel"})
+    assert len(response.context["jobs"]) == 1
+
+
+@pytest.mark.asyncio
+async def test_expired_uploads(client, monkeypatch, tmpdir):
+    """
+    Uploads that are never imported, discarded, or completed are removed once
+    they have expired, while uploads that are waiting to be imported are kept.
+    """
+    monkeypatch.setattr(settings, "UPLOAD_DIR", str(tmpdir))
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    url = app.url_path_for(
+        "upload", username=user["username"], table_id=table["identity"]
+    )
+    preview_urls = []
+    for name in ["Abandoned", "Imported", "Recent"]:
+        files = {
+            "upload-file": ("upload.csv", io.BytesIO(b"surname\n" + name.encode()))
+        }
+        response = await client.post(url, files=files, allow_redirects=False)
+        preview_urls.append(URL(response.headers["location"]).path)
+    await client.post(preview_urls[1], data={"action": "import"})
+
+    # A chunked upload that was never completed.
+    url = app.url_path_for(
+        "chunked-uploads", username=user["username"], table_id=table["identity"]
+    )
+    response = await client.post(url, json={"size": 20})
+    chunked_url = app.url_path_for(
+        "chunked-upload",
+        username=user["username"],
+        table_id=table["identity"],
+        token=response.json()["token"],
+    )
+
+    # Everything but the most recent upload is a day old.
+    expired_at = time.time() - 24 * 60 * 60
+    recent_token = preview_urls[2].rsplit("/", 1)[-1]
+    for name in os.listdir(tmpdir):
+        if not name.startswith(recent_token):
+            os.utime(os.path.join(tmpdir, name), (expired_at, expired_at))
+
+    uploads.expire_uploads(max_age=60 * 60)
+    response = await client.get(preview_urls[0])
+    assert response.status_code == 404
+    response = await client.get(chunked_url)
+    assert response.status_code == 404
+    response = await client.get(preview_urls[2])
+    assert response.status_code == 200
+    assert len(os.listdir(tmpdir)) == 3
+
+    assert await jobs.run_pending_jobs() == 1
+    query = select([tables.row.c.data]).where(tables.row.c.table == table["pk"])
+    surnames = [row["data"]["surname"] for row in await database.fetch_all(query)]
+    assert "Imported" in surnames
+
+    # Uploads that another worker removes at the same time are skipped.
+    for name in os.listdir(tmpdir):
+        os.utime(os.path.join(tmpdir, name), (expired_at, expired_at))
+    remove = os.remove
+
+    def remove_concurrently(path):
+        remove(path)
+        remove(path)
+
+    monkeypatch.setattr(os, "remove", remove_concurrently)
+    uploads.expire_uploads(max_age=60 * 60)
+    assert os.listdir(tmpdir) == []
+
+    # There's nothing to expire if nothing has been uploaded yet.
+    monkeypatch.setattr(settings, "UPLOAD_DIR", os.path.join(tmpdir, "missing"))
+    uploads.expire_uploads(max_age=60 * 60)
+
+
+@pytest.mark.asyncio
+async def test_interrupted_upload(client, monkeypatch):
+    monkeypatch.setattr(csv_utils, "CSV_BLOCK_SIZE", 1)
+    monkeypatch.setattr(csv_utils, "NORMALIZE_SAMPLE_SIZE", 1)
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+    query = tables.job.select().where(tables.job.c.kind == "import")
+
+    # The worker is shut down partway through the import.
+    bulk_create = TableDataSource.bulk_create
+    calls = []
+
+    async def interrupted_bulk_create(self, *args, **kwargs):
+        calls.append(True)
+        if len(calls) == 2:
+            raise asyncio.CancelledError()
+        await bulk_create(self, *args, **kwargs)
+
+    monkeypatch.setattr(TableDataSource, "bulk_create", interrupted_bulk_create)
+    csv_file = io.BytesIO(b"constituency,votes\nA,1\nB,2\nC,3\n")
+    await upload_and_import(client, user, table["identity"], csv_file)
+    with pytest.raises(asyncio.CancelledError):
+        await jobs.run_pending_jobs()
+
+    job = await database.fetch_one(query)
+    assert job["status"] == "pending"
+    assert job["rows_processed"] == 1
+    assert os.path.exists(job["params"]["path"])
+
+    # When the job is run again it carries on from the rows already added.
+    assert await jobs.run_pending_jobs() == 1
+    job = await database.fetch_one(query)
+    assert job["status"] == "complete"
+    assert job["rows_processed"] == 3
+    assert not os.path.exists(job["params"]["path"])
+
+    query = (
+        select([tables.row.c.data])
+        .where(tables.row.c.table == table["pk"])
+        .order_by(tables.row.c.pk)
+    )
+    data = [row["data"] for row in await database.fetch_all(query)]
+    assert [item["constituency"] for item in data[len(rows) :]] == ["A", "B", "C"]
+
+
+@pytest.mark.asyncio
+async def test_upload_into_deleted_table(client, monkeypatch):
+    monkeypatch.setattr(csv_utils, "CSV_BLOCK_SIZE", 1)
+    monkeypatch.setattr(csv_utils, "NORMALIZE_SAMPLE_SIZE", 1)
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+    delete_url = app.url_path_for(
+        "delete-table", username=user["username"], table_id=table["identity"]
+    )
+    query = tables.job.select().where(tables.job.c.kind == "import")
+
+    # An import that is still waiting when its table is deleted fails.
+    csv_file = io.BytesIO(b"constituency,votes\nHarrow East,1\n")
+    await upload_and_import(client, user, table["identity"], csv_file)
+    await client.post(delete_url)
+    assert await jobs.run_pending_jobs() == 2
+
+    job = await database.fetch_one(query)
+    assert job["status"] == "failed"
+    assert job["errors"] == [importer.TABLE_DELETED_MESSAGE]
+    assert not os.path.exists(job["params"]["path"])
+
+    # An import that is running when its table is deleted stops at the next
+    # chunk of rows.
+    table, columns, rows = await create_table(user)
+    bulk_create = TableDataSource.bulk_create
+
+    async def bulk_create_then_delete(self, *args, **kwargs):
+        await bulk_create(self, *args, **kwargs)
+        await client.post(delete_url)
+
+    monkeypatch.setattr(TableDataSource, "bulk_create", bulk_create_then_delete)
+    csv_file = io.BytesIO(b"constituency,votes\nHarrow East,1\nHarrow West,2\n")
+    await upload_and_import(client, user, table["identity"], csv_file)
+    assert await jobs.run_pending_jobs() == 2
+
+    job = await database.fetch_one(query.where(tables.job.c.table == table["pk"]))
+    assert job["status"] == "failed"
+    assert job["rows_processed"] == 1
+    assert job["errors"] == [importer.TABLE_DELETED_MESSAGE]
+
+
+@pytest.mark.asyncio
+async def test_upload_preview_empty_file(client):
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    url = app.url_path_for(
+        "upload", username=user["username"], table_id=table["identity"]
+    )
+    files = {"upload-file": ("upload.csv", io.BytesIO(b""))}
+    response = await client.post(url, files=files)
+    assert response.template.name == "upload.html"
+    assert response.context["preview"].names == []
+    assert "does not contain any data" in response.text
+
+
+@pytest.mark.asyncio
+async def test_upload_preview_404(client):
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    for token in ["does-not-exist", "{%s}" % uuid.uuid4(), str(uuid.uuid4())]:
+        url = app.url_path_for(
+            "upload-preview",
+            username=user["username"],
+            table_id=table["identity"],
+            token=token,
+        )
+        response = await client.get(url)
+        assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_upload_preview_permissions(client):
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+
+    url = app.url_path_for(
+        "upload-preview",
+        username=user["username"],
+        table_id=table["identity"],
+        token=str(uuid.uuid4()),
+    )
+    response = await client.get(url)
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_chunked_upload(client, monkeypatch):
+    monkeypatch.setattr(uploads, "UPLOAD_CHUNK_SIZE", 16)
+
+    user = await create_user()
+    client.login(user)
+    url = app.url_path_for("profile", username=user["username"])
+    await client.post(url, data={"name": "new table"})
+
+    content = b"name,score\ntom,123\nlucy,456\nrose,789\n"
+    chunks = [content[idx : idx + 16] for idx in range(0, len(content), 16)]
+
+    url = app.url_path_for(
+        "chunked-uploads", username=user["username"], table_id="new-table"
+    )
+    response = await client.post(url, json={"size": len(content)})
+    assert response.status_code == 201
+    upload = response.json()
+    assert upload["chunk_count"] == 3
+    assert upload["received_chunks"] == []
+
+    # Chunks may be sent in any order.
+    for index in [2, 0]:
+        chunk = chunks[index]
+        url = app.url_path_for(
+            "upload-chunk",
+            username=user["username"],
+            table_id="new-table",
+            token=upload["token"],
+            index=index,
+        )
+        headers = {"X-Checksum-SHA256": hashlib.sha256(chunk).hexdigest()}
+        response = await client.put(url, data=chunk, headers=headers)
+        assert response.status_code == 200
+
+    # The upload can't complete until all the chunks have been received.
+    upload_url = app.url_path_for(
+        "chunked-upload",
+        username=user["username"],
+        table_id="new-table",
+        token=upload["token"],
+    )
+    response = await client.post(upload_url)
+    assert response.status_code == 400
+
+    # An interrupted upload can be resumed from the chunks already received.
+    response = await client.get(upload_url)
+    assert response.json()["received_chunks"] == [0, 2]
+
+    url = app.url_path_for(
+        "upload-chunk",
+        username=user["username"],
+        table_id="new-table",
+        token=upload["token"],
+        index=1,
+    )
+    headers = {"X-Checksum-SHA256": hashlib.sha256(chunks[1]).hexdigest()}
+    response = await client.put(url, data=chunks[1], headers=headers)
+    assert response.json()["received_chunks"] == [0, 1, 2]
+
+    response = await client.post(upload_url)
+    preview_url = response.json()["preview_url"]
+
+    response = await client.get(preview_url)
+    assert response.context["preview"].rows == [
+        ["tom", "123"],
+        ["lucy", "456"],
+        ["rose", "789"],
+    ]
+
+    # The assembled upload can only be previewed and imported for the table
+    # that it was uploaded to.
+    url = app.url_path_for("profile", username=user["username"])
+    await client.post(url, data={"name": "other table"})
+    other_url = app.url_path_for(
+        "upload-preview",
+        username=user["username"],
+        table_id="other-table",
+        token=upload["token"],
+    )
+    response = await client.get(other_url)
+    assert response.status_code == 404
+    response = await client.post(other_url, data={"action": "import"})
+    assert response.status_code == 404
+    response = await client.get(preview_url)
+    assert response.status_code == 200
+
+    # Once complete, the chunked upload no longer exists.
+    response = await client.get(upload_url)
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_invalid_chunked_upload(client, monkeypatch):
+    monkeypatch.setattr(uploads, "UPLOAD_CHUNK_SIZE", 16)
+
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    url = app.url_path_for(
+        "chunked-uploads", username=user["username"], table_id=table["identity"]
+    )
+    response = await client.post(url, data=b"not json")
+    assert response.status_code == 400
+    response = await client.post(url, json={"size": -1})
+    assert response.status_code == 400
+    assert response.json() == {"size": "Must be greater than or equal to 0."}
+    response = await client.post(
+        url, json={"size": settings.MAX_CHUNKED_UPLOAD_SIZE + 1}
+    )
+    assert response.status_code == 400
+    assert response.json() == {
+        "size": f"Must be less than or equal to {settings.MAX_CHUNKED_UPLOAD_SIZE}."
+    }
+
+    response = await client.post(url, json={"size": 20})
+    upload = response.json()
+
+    def chunk_url(index):
+        return app.url_path_for(
+            "upload-chunk",
+            username=user["username"],
+            table_id=table["identity"],
+            token=upload["token"],
+            index=index,
+        )
+
+    def checksum(data):
+        return {"X-Checksum-SHA256": hashlib.sha256(data).hexdigest()}
+
+    response = await client.put(chunk_url(0), data=b"x" * 16)
+    assert response.text == "Missing checksum."
+
+    response = await client.put(chunk_url(0), data=b"x" * 16, headers=checksum(b""))
+    assert response.text == "Checksum mismatch."
+
+    response = await client.put(chunk_url(0), data=b"x" * 17, headers=checksum(b""))
+    assert response.text == "Chunk too large."
+
+    response = await client.put(chunk_url(1), data=b"x" * 5, headers=checksum(b""))
+    assert response.text == "Incorrect chunk length."
+
+    response = await client.put(chunk_url(2), data=b"x", headers=checksum(b"x"))
+    assert response.status_code == 404
+
+    # None of the invalid chunks were kept.
+    url = app.url_path_for(
+        "chunked-upload",
+        username=user["username"],
+        table_id=table["identity"],
+        token=upload["token"],
+    )
+    response = await client.get(url)
+    assert response.json()["received_chunks"] == []
+
+
+@pytest.mark.asyncio
+async def test_chunked_upload_404(client):
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    url = app.url_path_for(
+        "chunked-uploads", username=user["username"], table_id=table["identity"]
+    )
+    response = await client.post(url, json={"size": 20})
+    token = response.json()["token"]
+
+    # Uploads are only accessible through the table they were created for.
+    query = tables.table.insert()
+    values = {
+        "created_at": datetime.datetime.now(),
+        "identity": "other",
+        "name": "Other",
+        "user_id": user["pk"],
+    }
+    await database.execute(query, values=values)
+
+    for table_id, token in [
+        ("other", token),
+        (table["identity"], "does-not-exist"),
+        (table["identity"], str(uuid.uuid4())),
+    ]:
+        url = app.url_path_for(
+            "chunked-upload", username=user["username"], table_id=table_id, token=token,
+        )
+        response = await client.get(url)
+        assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_chunked_upload_permissions(client):
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+
+    url = app.url_path_for(
+        "chunked-upload",
+        username=user["username"],
+        table_id=table["identity"],
+        token=str(uuid.uuid4()),
+    )
+    response = await client.get(url)
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_upload_with_errors(client):
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    job = await jobs.enqueue("import", table=table["pk"], params={})
+    await job.update(status="complete", errors=["Row 3, votes: Must be a number."])
+
+    url = app.url_path_for(
+        "table", username=user["username"], table_id=table["identity"]
+    )
+    response = await client.get(url)
+    assert response.context["jobs"][0].pk == job.pk
+    assert "Imported with errors." in response.text
+
+
+@pytest.mark.asyncio
+async def test_failed_upload(client):
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    job = await jobs.enqueue(
+        "import", table=table["pk"], params={"path": "/does-not-exist"}
+    )
+    await jobs.run_pending_jobs()
+
+    url = app.url_path_for(
+        "table", username=user["username"], table_id=table["identity"]
+    )
+    response = await client.get(url)
+    failed_job = response.context["jobs"][0]
+    assert failed_job.pk == job.pk
+    assert failed_job.status == "failed"
+    assert len(failed_job.errors) == 1
+
+
+@pytest.mark.asyncio
+async def test_job_permissions(client):
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+
+    url = app.url_path_for(
+        "job", username=user["username"], table_id=table["identity"], job_id=1
+    )
+    response = await client.get(url)
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_job_404(client):
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    client.login(user)
+
+    url = app.url_path_for(
+        "job", username=user["username"], table_id=table["identity"], job_id=0
     )
-    response = await client.post(url, allow_redirects=False)
-    expected_redirect = app.url_path_for("profile", username=user["username"])
+    response = await client.get(url)
+    assert response.status_code == 404
 
-    assert response.is_redirect
-    assert URL(response.headers["location"]).path == expected_redirect
+
+@pytest.mark.asyncio
+async def test_bulk_create(client):
+    """
+    Ensure that rows can be inserted in bulk, using the COPY protocol.
+    """
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    datasource = await load_datasource_or_404(user["username"], table["identity"])
+
+    values = [
+        {
+            "constituency": "Harrow East",
+            "surname": "WALLACE",
+            "first_name": "Emma",
+            "party": "Green Party",
+            "votes": 846,
+        }
+    ]
+    await datasource.bulk_create(values)
+
+    assert await datasource.count() == len(rows) + 1
+    item = await datasource.search("WALLACE").get()
+    assert item["votes"] == 846
+    assert item.row["search_text"] == "Harrow East WALLACE Emma Green Party"
 
 
 @pytest.mark.asyncio
-async def test_delete(client):
+async def test_bulk_upsert(client):
     """
-    Test row delete.
+    Rows are merged on the key column, and unchanged rows are left untouched.
     """
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+    params = {"column": "surname"}
+    await jobs.enqueue("set_key_column", table=table["pk"], params=params)
+    assert await jobs.run_pending_jobs() == 1
+    datasource = await load_datasource_or_404(user["username"], table["identity"])
+    assert datasource.key_column == "surname"
+
+    existing = rows[0]["data"]
+    changed = dict(rows[1]["data"], votes=1)
+    values = [
+        existing,
+        changed,
+        {"constituency": "Harrow East", "surname": "WALLACE", "votes": 1},
+        {"constituency": "Harrow East", "surname": "WALLACE", "votes": 846},
+        {"constituency": "Harrow East", "surname": "", "votes": 2},
+    ]
+    search_texts = [value["surname"] for value in values]
+    summary = await datasource.bulk_upsert(values, search_texts)
+    # Rows stored before content hashes were recorded count as changed.
+    assert summary == {"inserted": 2, "updated": 2, "unchanged": 0}
+
+    item = await datasource.filter(uuid=rows[1]["uuid"]).get()
+    assert item["votes"] == 1
+    item = await datasource.filter(uuid=None).search("WALLACE").get()
+    assert item["votes"] == 846
+    assert item.row["key"] == "WALLACE"
+
+    # Only rows without a key are inserted again.
+    datasource = await load_datasource_or_404(user["username"], table["identity"])
+    summary = await datasource.bulk_upsert(values, search_texts)
+    assert summary == {"inserted": 1, "updated": 0, "unchanged": 3}
+    assert await datasource.count() == len(rows) + 3
+
+    # Rows with a key that wasn't seen may be deleted.
+    await datasource.start_tracking_keys()
+    await datasource.bulk_upsert([rows[2]["data"]], [""], track_keys=True)
+    assert await datasource.delete_missing_rows() == len(rows)
+    assert await datasource.count() == 3
+
+
+@pytest.mark.asyncio
+async def test_set_key_column(client):
     user = await create_user()
     table, columns, rows = await create_table(user)
     client.login(user)
 
     url = app.url_path_for(
-        "delete-row",
-        username=user["username"],
-        table_id=table["identity"],
-        row_uuid=rows[0]["uuid"],
+        "columns", username=user["username"], table_id=table["identity"]
     )
-    response = await client.post(url, allow_redirects=False)
-    expected_redirect = app.url_path_for(
+    data = {"action": "set-key", "key_column": "constituency"}
+    response = await client.post(url, data=data)
+    assert response.status_code == 400
+    assert response.context["key_errors"] == {
+        "key_column": "This column contains duplicate values."
+    }
+
+    data = {"action": "set-key", "key_column": "missing"}
+    response = await client.post(url, data=data)
+    assert response.status_code == 400
+    assert response.context["key_errors"] == {"key_column": "Select a valid column."}
+
+    # The keys of the existing rows are set in the background.
+    data = {"action": "set-key", "key_column": "surname"}
+    response = await client.post(url, data=data)
+    assert response.template.name == "table.html"
+    job = response.context["jobs"][0]
+    assert job.kind == "set_key_column"
+    assert job.status == "pending"
+
+    response = await client.get(url)
+    assert response.context["key_column"] is None
+    assert await jobs.run_pending_jobs() == 1
+    response = await client.get(url)
+    assert response.context["key_column"] == "surname"
+
+    query = select([tables.row.c.key]).where(tables.row.c.table == table["pk"])
+    keys = [row["key"] for row in await database.fetch_all(query)]
+    assert sorted(keys) == sorted(row["data"]["surname"] for row in rows)
+
+    # Changing the key column replaces the keys.
+    data = {"action": "set-key", "key_column": "votes"}
+    await client.post(url, data=data)
+    assert await jobs.run_pending_jobs() == 1
+    keys = [row["key"] for row in await database.fetch_all(query)]
+    assert sorted(keys) == sorted(str(row["data"]["votes"]) for row in rows)
+
+    # Duplicate values added before the job runs make it fail, leaving the
+    # existing key column in place.
+    data = {"action": "set-key", "key_column": "surname"}
+    await client.post(url, data=data)
+    values = dict(rows[0]["data"], votes=0)
+    await database.execute(
+        tables.row.insert(),
+        values={
+            "created_at": datetime.datetime.now(),
+            "uuid": str(uuid.uuid4()),
+            "table": table["pk"],
+            "data": values,
+            "search_text": "",
+        },
+    )
+    assert await jobs.run_pending_jobs() == 1
+    response = await client.get(url)
+    assert response.context["key_column"] == "votes"
+    table_url = app.url_path_for(
         "table", username=user["username"], table_id=table["identity"]
     )
+    response = await client.get(table_url)
+    failed_job = response.context["jobs"][0]
+    assert failed_job.status == "failed"
+    assert failed_job.errors == ["The column contains duplicate values."]
 
-    assert response.is_redirect
-    assert URL(response.headers["location"]).path == expected_redirect
+    # Deleting the key column clears the key.
+    url = app.url_path_for(
+        "delete-column",
+        username=user["username"],
+        table_id=table["identity"],
+        column_id="votes",
+    )
+    await client.post(url)
+    datasource = await load_datasource_or_404(user["username"], table["identity"])
+    assert datasource.key_column is None
+
+    # The keys are cleared along with the column's values.
+    assert await jobs.run_pending_jobs() == 1
+    keys = [row["key"] for row in await database.fetch_all(query)]
+    assert keys == [None] * (len(rows) + 1)
+
+    # A column that is deleted before its keys are set doesn't become the key.
+    params = {"column": "missing"}
+    await jobs.enqueue("set_key_column", table=table["pk"], params=params)
+    assert await jobs.run_pending_jobs() == 1
+    response = await client.get(table_url)
+    failed_job = response.context["jobs"][0]
+    assert failed_job.errors == ["The column has been deleted."]
+    datasource = await load_datasource_or_404(user["username"], table["identity"])
+    assert datasource.key_column is None
 
 
 @pytest.mark.asyncio
-async def test_upload(client, mock_csv):
+async def test_row_key_conflicts(client):
     user = await create_user()
+    table, columns, rows = await create_table(user)
+    params = {"column": "votes"}
+    await jobs.enqueue("set_key_column", table=table["pk"], params=params)
+    await jobs.run_pending_jobs()
+    datasource = await load_datasource_or_404(user["username"], table["identity"])
     client.login(user)
-    csv_file = open(mock_csv.name, "r")
 
-    url = app.url_path_for("profile", username=user["username"])
-    data = {"name": "new table"}
-    response = await client.post(url, data=data, allow_redirects=False)
-    expected_redirect = url
+    url = app.url_path_for(
+        "table", username=user["username"], table_id=table["identity"]
+    )
+    data = dict(rows[0]["data"], surname="WALLACE")
+    response = await client.post(url, data=data)
+    assert response.status_code == 400
+    assert response.context["form_errors"] == {
+        "votes": "A row with this key already exists."
+    }
 
+    # A row may keep its own key, but not take the key of another row.
+    url = app.url_path_for(
+        "detail",
+        username=user["username"],
+        table_id=table["identity"],
+        row_uuid=rows[0]["uuid"],
+    )
+    response = await client.post(url, data=data, allow_redirects=False)
     assert response.is_redirect
-    assert URL(response.headers["location"]).path == expected_redirect
 
-    url = app.url_path_for("upload", username=user["username"], table_id="new-table")
-    response = await client.post(
-        url, files={"upload-file": csv_file}, allow_redirects=False
+    url = app.url_path_for(
+        "detail",
+        username=user["username"],
+        table_id=table["identity"],
+        row_uuid=rows[1]["uuid"],
     )
-    expected_redirect = app.url_path_for(
-        "table", username=user["username"], table_id="new-table"
+    response = await client.post(url, data=data)
+    assert response.status_code == 400
+    assert response.context["form_errors"] == {
+        "votes": "A row with this key already exists."
+    }
+
+    item = await datasource.filter(uuid=rows[0]["uuid"]).get()
+    assert item.row["key"] == str(rows[0]["data"]["votes"])
+
+    # Once the key column is cleared, rows may share the same values.
+    url = app.url_path_for(
+        "columns", username=user["username"], table_id=table["identity"]
     )
+    await client.post(url, data={"action": "set-key", "key_column": ""})
+    assert await jobs.run_pending_jobs() == 1
+    item = await datasource.filter(uuid=rows[0]["uuid"]).get()
+    assert item.row["key"] is None
 
+    url = app.url_path_for(
+        "detail",
+        username=user["username"],
+        table_id=table["identity"],
+        row_uuid=rows[1]["uuid"],
+    )
+    response = await client.post(url, data=data, allow_redirects=False)
     assert response.is_redirect
-    assert URL(response.headers["location"]).path == expected_redirect
+
+
+@pytest.mark.asyncio
+async def test_upsert_upload(client):
+    user = await create_user()
+    client.login(user)
+
+    url = app.url_path_for("profile", username=user["username"])
+    await client.post(url, data={"name": "new table"})
+
+    csv_file = io.BytesIO(b"name,score\ntom,123\nlucy,456\n")
+    await upload_and_import(client, user, "new-table", csv_file)
+    await jobs.run_pending_jobs()
+
+    url = app.url_path_for("columns", username=user["username"], table_id="new-table")
+    await client.post(url, data={"action": "set-key", "key_column": "name"})
+
+    url = app.url_path_for("table", username=user["username"], table_id="new-table")
+    response = await client.get(url)
+    tom_uuid = response.context["queryset"][0].uuid
+
+    # Uploading again updates existing rows, and adds new rows and columns.
+    csv_file = io.BytesIO(b"age,name,score\n30,tom,124\n40,rose,789\n")
+    await upload_and_import(client, user, "new-table", csv_file)
+    await jobs.run_pending_jobs()
+
+    response = await client.get(url, headers={"Accept": "application/json"})
+    assert response.json() == [
+        {"name": "tom", "score": 124, "age": 30},
+        {"name": "lucy", "score": 456, "age": None},
+        {"name": "rose", "score": 789, "age": 40},
+    ]
+    response = await client.get(url)
+    assert response.context["queryset"][0].uuid == tom_uuid
+
+    # The key column must be included in the upload.
+    csv_file = io.BytesIO(b"score\n1\n")
+    await upload_and_import(client, user, "new-table", csv_file)
+    await jobs.run_pending_jobs()
+
+    response = await client.get(url)
+    failed_job = response.context["jobs"][0]
+    assert failed_job.status == "failed"
+    assert failed_job.errors == [
+        'The uploaded file does not contain the key column "name".'
+    ]
+
+
+@pytest.mark.asyncio
+async def test_incremental_upload(client):
+    user = await create_user()
+    client.login(user)
+
+    url = app.url_path_for("profile", username=user["username"])
+    await client.post(url, data={"name": "new table"})
+
+    csv_file = io.BytesIO(b"name,score\ntom,1\nlucy,2\nrose,3\n")
+    await upload_and_import(client, user, "new-table", csv_file)
+    await jobs.run_pending_jobs()
+
+    url = app.url_path_for("columns", username=user["username"], table_id="new-table")
+    await client.post(url, data={"action": "set-key", "key_column": "name"})
+
+    csv_file = io.BytesIO(b"name,score\ntom,1\nlucy,20\nbob,4\n")
+    await upload_and_import(client, user, "new-table", csv_file, delete_missing=True)
+    await jobs.run_pending_jobs()
+
+    url = app.url_path_for("table", username=user["username"], table_id="new-table")
+    response = await client.get(url)
+    job = response.context["jobs"][0]
+    assert job.errors == []
+    assert job.summary == {"inserted": 1, "updated": 1, "unchanged": 1, "deleted": 1}
+
+    response = await client.get(url, headers={"Accept": "application/json"})
+    assert response.json() == [
+        {"name": "tom", "score": 1},
+        {"name": "lucy", "score": 20},
+        {"name": "bob", "score": 4},
+    ]
+
+    # Missing rows aren't deleted if any rows in the upload are invalid.
+    csv_file = io.BytesIO(b"name,score\ntom,x\n")
+    await upload_and_import(client, user, "new-table", csv_file, delete_missing=True)
+    await jobs.run_pending_jobs()
+
+    response = await client.get(url)
+    assert len(response.context["queryset"]) == 3
+    job = response.context["jobs"][0]
+    assert job.errors == [
+        "Row 1, score: Must be a number.",
+        importer.DELETE_SKIPPED_MESSAGE,
+    ]
 
 
 # Filters
@@ -741,7 +2240,7 @@ async def test_404_not_found(client):
 
 
 @pytest.mark.asyncio
-async def test_500_server_error():
+async def test_500_server_error(client):
     """
     Ensure that exceptions in the application render the '500.html' template.
     """
@@ -752,7 +2251,7 @@ async def test_500_server_error():
 
 
 @pytest.mark.asyncio
-async def test_raise_500_server_error():
+async def test_raise_500_server_error(client):
     """
     Ensure that exceptions in the application raise through the client.
     """
@@ -885,3 +2384,178 @@ async def test_details_with_json_response(client):
 
     assert response.status_code == 200
     assert len(response.json().keys()) == len(columns)
+
+
+@pytest.mark.asyncio
+async def test_table_conditional_requests(client):
+    """
+    Responses carry an ETag derived from the table's write version, and
+    repeated requests are answered with 304 until the table changes.
+    """
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+
+    url = app.url_path_for(
+        "table", username=user["username"], table_id=table["identity"]
+    )
+    headers = {"Accept": "application/json"}
+    response = await client.get(url, headers=headers)
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+    assert response.headers["Last-Modified"]
+
+    response = await client.get(url, headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    # The query parameters and media type form part of the ETag.
+    response = await client.get(url + "?page=2", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    response = await client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+    # Any change to the table changes the ETag.
+    client.login(user)
+    data = {
+        "constituency": "Hove",
+        "surname": "KYLE",
+        "first_name": "Peter",
+        "party": "Labour",
+        "votes": "22082",
+    }
+    response = await client.post(url, data=data)
+    assert "ETag" not in response.headers
+
+    anonymous_client = TestClient(app=app)
+    response = await anonymous_client.get(
+        url, headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.json()) == len(rows) + 1
+
+
+@pytest.mark.asyncio
+async def test_detail_conditional_requests(client):
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+
+    url = app.url_path_for(
+        "detail",
+        username=user["username"],
+        table_id=table["identity"],
+        row_uuid=rows[0]["uuid"],
+    )
+    response = await client.get(url)
+    etag = response.headers["ETag"]
+
+    response = await client.get(url, headers={"If-None-Match": f'"other", W/{etag}'})
+    assert response.status_code == 304
+
+    datasource = await load_datasource_or_404(user["username"], table["identity"])
+    item = await datasource.filter(uuid=rows[1]["uuid"]).get()
+    await item.delete()
+
+    response = await client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+    url = app.url_path_for(
+        "detail",
+        username=user["username"],
+        table_id="missing",
+        row_uuid=rows[0]["uuid"],
+    )
+    response = await client.get(url, headers={"If-None-Match": "*"})
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_query_cache(client):
+    """
+    Table queries are served from the query cache until the table changes.
+    """
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+
+    url = app.url_path_for(
+        "table", username=user["username"], table_id=table["identity"]
+    )
+    await client.get(url + "?order=votes")
+    hits = query_cache.hits
+    response = await client.get(url + "?order=votes")
+    assert query_cache.hits == hits + 2
+    assert len(response.context["queryset"]) == len(rows)
+
+    datasource = await load_datasource_or_404(user["username"], table["identity"])
+    item = await datasource.filter(uuid=rows[0]["uuid"]).get()
+    await item.delete()
+
+    response = await client.get(url + "?order=votes")
+    assert query_cache.hits == hits + 2
+    assert len(response.context["queryset"]) == len(rows) - 1
+
+
+@pytest.mark.asyncio
+async def test_response_cache(client, monkeypatch):
+    """
+    Responses for anonymous users are served from the response cache until
+    the table changes.
+    """
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_TTL", 60)
+
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+
+    url = app.url_path_for(
+        "table", username=user["username"], table_id=table["identity"]
+    )
+    response = await client.get(url)
+    assert response.template.name == "table.html"
+    etag = response.headers["ETag"]
+
+    response = await client.get(url)
+    assert response.template is None
+    assert response.headers["ETag"] == etag
+    assert "UK General Election 2015" in response.text
+
+    # Logged in users get their own pages.
+    client.login({"username": "other", "avatar_url": "http://example.com/a.jpg"})
+    response = await client.get(url)
+    assert response.template.name == "table.html"
+
+    datasource = await load_datasource_or_404(user["username"], table["identity"])
+    item = await datasource.filter(uuid=rows[0]["uuid"]).get()
+    await item.delete()
+
+    anonymous_client = TestClient(app=app)
+    response = await anonymous_client.get(url)
+    assert response.template.name == "table.html"
+    assert response.headers["ETag"] != etag
+    assert len(response.context["queryset"]) == len(rows) - 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_queries(client, monkeypatch):
+    """
+    Identical requests that arrive at the same time run each query once.
+    """
+    user = await create_user()
+    table, columns, rows = await create_table(user)
+
+    fetch_rows = TableDataSource.fetch_rows
+    calls = []
+
+    async def slow_fetch_rows(self):
+        calls.append(True)
+        await asyncio.sleep(0.05)
+        return await fetch_rows(self)
+
+    monkeypatch.setattr(TableDataSource, "fetch_rows", slow_fetch_rows)
+
+    url = app.url_path_for(
+        "table", username=user["username"], table_id=table["identity"]
+    )
+    responses = await asyncio.gather(*[client.get(url) for _ in range(5)])
+    for response in responses:
+        assert len(response.context["queryset"]) == len(rows)
+    assert len(calls) == 1
@@ -0,0 +1,73 @@
+from source.cache import LRUCache, SingleFlight
+import asyncio
+import pytest
+
+
+def test_lru_cache():
+    cache = LRUCache(max_size=100)
+    assert cache.get("a") is None
+
+    cache.set("a", 1, size=40)
+    cache.set("b", 2, size=40)
+    assert cache.get("a") == 1
+
+    # The least recently used entry is evicted to make room.
+    cache.set("c", 3, size=40)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+    # Replacing an entry replaces its size.
+    cache.set("c", 4, size=10)
+    assert cache.get("c") == 4
+
+    # Values larger than the cache aren't stored.
+    cache.set("d", 5, size=101)
+    assert cache.get("d") is None
+
+    assert cache.stats() == {
+        "hits": 4,
+        "misses": 3,
+        "evictions": 1,
+        "entries": 2,
+        "size": 50,
+        "max_size": 100,
+    }
+
+    cache.evict(lambda key: key == "a")
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 10
+
+    cache.clear()
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def func():
+        calls.append(True)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    results = await asyncio.gather(*[single_flight.run("a", func) for _ in range(5)])
+    assert results == [1, 1, 1, 1, 1]
+    assert await single_flight.run("a", func) == 2
+    assert single_flight.calls == {}
+
+
+@pytest.mark.asyncio
+async def test_single_flight_errors():
+    single_flight = SingleFlight()
+
+    async def func():
+        await asyncio.sleep(0.01)
+        raise ValueError()
+
+    results = await asyncio.gather(
+        *[single_flight.run("a", func) for _ in range(3)], return_exceptions=True
+    )
+    assert [type(result) for result in results] == [ValueError] * 3
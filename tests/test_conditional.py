@@ -0,0 +1,51 @@
+from source.conditional import get_etag, get_last_modified, is_not_modified
+from starlette.requests import Request
+import datetime
+
+
+def make_request(path="/", query_string=b"", headers=None):
+    headers = [
+        (key.lower().encode("latin-1"), value.encode("latin-1"))
+        for key, value in (headers or {}).items()
+    ]
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "query_string": query_string,
+        "headers": headers,
+    }
+    return Request(scope)
+
+
+def test_get_etag():
+    etag = get_etag(make_request(), version=3)
+    assert etag.startswith('"3-') and etag.endswith('"')
+    assert get_etag(make_request(), version=3) == etag
+    assert get_etag(make_request(), version=4) != etag
+    assert get_etag(make_request(query_string=b"page=2"), version=3) != etag
+    assert get_etag(make_request(path="/other"), version=3) != etag
+    request = make_request(headers={"Accept": "application/json"})
+    assert get_etag(request, version=3) != etag
+
+
+def test_get_last_modified():
+    created_at = datetime.datetime(2020, 1, 31, 12, tzinfo=datetime.timezone.utc)
+    updated_at = datetime.datetime(2020, 2, 1, 12, tzinfo=datetime.timezone.utc)
+    table = {"created_at": created_at, "updated_at": None}
+    assert get_last_modified(table) == "Fri, 31 Jan 2020 12:00:00 GMT"
+    table = {"created_at": created_at, "updated_at": updated_at}
+    assert get_last_modified(table) == "Sat, 01 Feb 2020 12:00:00 GMT"
+
+
+def test_is_not_modified():
+    etag = '"3-abc"'
+    assert not is_not_modified(make_request(), etag)
+    request = make_request(headers={"If-None-Match": etag})
+    assert is_not_modified(request, etag)
+    request = make_request(headers={"If-None-Match": '"1-abc", W/"3-abc"'})
+    assert is_not_modified(request, etag)
+    request = make_request(headers={"If-None-Match": '"1-abc"'})
+    assert not is_not_modified(request, etag)
+    request = make_request(headers={"If-None-Match": "*"})
+    assert is_not_modified(request, etag)
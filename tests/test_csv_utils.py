@@ -1,4 +1,28 @@
-from source.csv_utils import normalize_table
+from source.csv_utils import (
+    Normalization,
+    TableLayout,
+    detect_encoding,
+    determine_csv_header,
+    determine_chunk_types,
+    determine_column_types,
+    iter_csv_blocks,
+    iter_normalized_rows,
+    merge_column_types,
+    normalize_table,
+    open_upload,
+    preview_csv_file,
+    process_csv_block,
+    read_csv,
+    validate_rows,
+)
+import chardet
+import codecs
+import gzip
+import io
+import pytest
+import source.csv_utils
+import tempfile
+import zipfile
 
 
 def test_normalize_rows():
@@ -21,3 +45,276 @@ def test_normalize_rows():
         ["5", "foo", "bar"],
     ]
     assert normalize_table(rows) == expected_rows
+
+
+def test_determine_column_types():
+    rows = [
+        ["a", "b", "c", "d", "e", "f", "g"],
+        ["1", "1", "true", "2020-01-01", "2020-01-01", "", "1"],
+        ["-2", "2.5", "False", "", "2020-02-30", "", "1e5"],
+        ["", "-.5e3", "", "2020-12-31", "", "", "x"],
+    ]
+    column_types, schema = determine_column_types(rows)
+    assert column_types == [
+        "integer",
+        "float",
+        "boolean",
+        "date",
+        "string",
+        "string",
+        "string",
+    ]
+
+
+def test_determine_column_types_in_chunks(monkeypatch):
+    # Values after the first chunk of rows may widen the column types.
+    monkeypatch.setattr(source.csv_utils, "TYPE_CHUNK_SIZE", 2)
+    rows = [
+        ["a", "b", "c", "d"],
+        ["1", "1", "", "true"],
+        ["2", "2", "", "false"],
+        ["3", "3.5", "4", "true"],
+        ["4", "x", "", "maybe"],
+        ["5", "6", "7.5", "false"],
+    ]
+    column_types, schema = determine_column_types(rows)
+    assert column_types == ["integer", "string", "float", "string"]
+
+
+def test_detect_encoding():
+    assert detect_encoding(b"name,score\ntom,123\n") == "utf-8"
+    assert detect_encoding("name\nrosé\n".encode("utf-8")) == "utf-8"
+    assert detect_encoding(codecs.BOM_UTF8 + b"name\n") == "utf-8-sig"
+
+    # The sample may end part way through a multi-byte character.
+    assert detect_encoding("name\nrosé".encode("utf-8")[:-1]) == "utf-8"
+
+    # Anything that isn't valid UTF-8 falls back to `chardet`.
+    sample = "name\nrosé\nzoë\nrenée\n".encode("latin-1")
+    assert detect_encoding(sample) == chardet.detect(sample)["encoding"]
+
+
+def test_open_upload():
+    data = "name,score\ntom,123\nrosé,789\n".encode("utf-8")
+    expected_rows = [["name", "score"], ["tom", "123"], ["rosé", "789"]]
+
+    with tempfile.NamedTemporaryFile() as upload_file:
+        upload_file.write(data)
+        upload_file.flush()
+        with open_upload(upload_file.name) as input_file:
+            assert list(read_csv(input_file)) == expected_rows
+
+    with tempfile.NamedTemporaryFile() as upload_file:
+        upload_file.write(gzip.compress(data))
+        upload_file.flush()
+        with open_upload(upload_file.name) as input_file:
+            assert list(read_csv(input_file)) == expected_rows
+
+    # The first CSV file in a zip archive is used.
+    with tempfile.NamedTemporaryFile() as upload_file:
+        with zipfile.ZipFile(upload_file, "w") as archive:
+            archive.writestr("docs/", "")
+            archive.writestr("docs/README.txt", "Some notes.")
+            archive.writestr("export/data.CSV", data)
+        upload_file.flush()
+        with open_upload(upload_file.name) as input_file:
+            assert list(read_csv(input_file)) == expected_rows
+
+    with tempfile.NamedTemporaryFile() as upload_file:
+        with zipfile.ZipFile(upload_file, "w") as archive:
+            pass
+        upload_file.flush()
+        with open_upload(upload_file.name) as input_file:
+            assert list(read_csv(input_file)) == []
+
+
+def test_read_csv():
+    data = 'name,notes\ntom,"multi\nline"\nrosé,\n'.encode("utf-8")
+    rows = list(read_csv(io.BytesIO(data)))
+    assert rows == [["name", "notes"], ["tom", "multi\nline"], ["rosé", ""]]
+
+
+def test_read_csv_invalid_encoding():
+    # Bytes beyond the sample used to detect the encoding are decoded strictly.
+    data = b"name\n" + b"tom\n" * source.csv_utils.ENCODING_SAMPLE_SIZE + b"ros\xe9\n"
+    rows = read_csv(io.BytesIO(data))
+    with pytest.raises(ValueError, match="isn't valid utf-8 text, after line"):
+        list(rows)
+
+    # Unless they're replaced, as they are for previews.
+    rows = list(read_csv(io.BytesIO(data), errors="replace"))
+    assert rows[-1] == ["ros\ufffd"]
+
+
+def test_iter_normalized_rows():
+    # Rows beyond the sample are streamed through the same normalization.
+    rows = [
+        ["", ""],
+        ["a", "", "b"],
+        ["1", "", "2"],
+        ["", "", ""],
+        ["3", "", "4", "5"],
+        ["6"],
+    ]
+    expected_rows = [["a", "b"], ["1", "2"], ["3", "4"], ["6", ""]]
+    assert list(iter_normalized_rows(rows, sample_size=2)) == expected_rows
+    assert list(iter_normalized_rows([["", ""]])) == []
+
+    # Without any completely populated rows, the table starts from the first.
+    rows = [["a", ""], ["", "b"]]
+    assert list(iter_normalized_rows(rows)) == rows
+
+
+def test_iter_csv_blocks(monkeypatch):
+    monkeypatch.setattr(source.csv_utils, "CSV_BLOCK_SIZE", 4)
+    monkeypatch.setattr(source.csv_utils, "NORMALIZE_SAMPLE_SIZE", 4)
+    text = 'name,notes\r\ntom,"multi\nline, ""quoted"""\nrosé,5" screen\nzoë,\n'
+    blocks = list(iter_csv_blocks(io.BytesIO(text.encode("utf-8"))))
+    assert blocks == [
+        'name,notes\r\ntom,"multi\nline, ""quoted"""\nrosé,5" screen\n',
+        "zoë,\n",
+    ]
+
+    # A block is only ended after a complete row.
+    monkeypatch.setattr(source.csv_utils, "NORMALIZE_SAMPLE_SIZE", 1)
+    blocks = list(iter_csv_blocks(io.BytesIO(text.encode("utf-8"))))
+    assert blocks == [
+        "name,notes\r\n",
+        'tom,"multi\nline, ""quoted"""\n',
+        'rosé,5" screen\n',
+        "zoë,\n",
+    ]
+
+    # Anything after the last line break is in the final block.
+    blocks = list(iter_csv_blocks(io.BytesIO(b'name\ntom\n"rose')))
+    assert blocks == ["name\n", "tom\n", '"rose']
+
+    # Bytes beyond the sample used to detect the encoding are decoded strictly.
+    data = b"name\n" + b"tom\n" * source.csv_utils.ENCODING_SAMPLE_SIZE + b"ros\xe9\n"
+    with pytest.raises(ValueError, match="isn't valid utf-8 text, after line"):
+        list(iter_csv_blocks(io.BytesIO(data)))
+
+
+def test_determine_csv_header():
+    text = "Results,,\n,,\nname,,score\ntom,,123\n"
+    normalization, header, skip = determine_csv_header(text)
+    assert normalization == Normalization(length=3, keep_columns=[0, 2])
+    assert header == ["name", "score"]
+    assert skip == 2
+
+    assert determine_csv_header(",,\n") == (None, [], 0)
+
+
+def test_process_csv_block():
+    normalization = Normalization(length=3, keep_columns=[0, 2])
+    text = " tom ,,123\n\nlucy,,456,extra\nrose\n"
+    assert process_csv_block(len, (), normalization, 0, text) == (0, 3, 3)
+    assert process_csv_block(list, (), normalization, 2, text) == (
+        2,
+        1,
+        [["rose", ""]],
+    )
+    assert process_csv_block(len, (), normalization, 5, text) == (3, 0, 0)
+
+
+def test_determine_chunk_types():
+    rows = [["1", "x", ""], ["2.5", "", ""]]
+    assert determine_chunk_types([None, None, None], rows) == ["float", "string", None]
+    assert determine_chunk_types(["integer", None, "date"], []) == [
+        "integer",
+        None,
+        "date",
+    ]
+
+
+def test_merge_column_types():
+    column_types = [None, "integer", "integer", "float", "boolean", "date", "string"]
+    other_types = ["date", None, "float", "integer", "integer", "string", "boolean"]
+    assert merge_column_types(column_types, other_types) == [
+        "date",
+        "integer",
+        "float",
+        "float",
+        "string",
+        "string",
+        "string",
+    ]
+
+
+def test_validate_rows():
+    layout = TableLayout(
+        names=["Name", "Score", "Height", "Member", "Joined"],
+        identities=["name", "score", "height", "member", "joined"],
+        types=["string", "integer", "float", "boolean", "date"],
+        row_count=3,
+    )
+    rows = [
+        ["tom", "123", "1.8", "true", "2019-01-31"],
+        ["lucy", "", "", "", ""],
+        ["rosé", "789", "1.65", "FALSE", "2020-02-29"],
+        ["zoë", "abc", "1.7", "maybe", "2020-02-30"],
+    ]
+    data, search_texts, errors = validate_rows(layout, rows)
+    assert data == [
+        {
+            "name": "tom",
+            "score": 123,
+            "height": 1.8,
+            "member": True,
+            "joined": "2019-01-31",
+        },
+        {"name": "lucy", "score": None, "height": None, "member": None, "joined": None},
+        {
+            "name": "rosé",
+            "score": 789,
+            "height": 1.65,
+            "member": False,
+            "joined": "2020-02-29",
+        },
+    ]
+    assert search_texts == [
+        "tom 123 1.8 true 2019-01-31",
+        "lucy    ",
+        "rosé 789 1.65 FALSE 2020-02-29",
+    ]
+    assert errors == [
+        (3, "score: Must be a number."),
+        (3, "member: Must be a boolean."),
+        (3, "joined: Must be a real date."),
+    ]
+
+
+def test_preview_csv_file(monkeypatch):
+    monkeypatch.setattr(source.csv_utils, "PREVIEW_ROWS", 2)
+    with tempfile.NamedTemporaryFile() as csv_file:
+        csv_file.write(b"name,score\ntom,123\nlucy,456\nrose,789\n")
+        csv_file.flush()
+        preview = preview_csv_file(csv_file.name)
+
+        assert preview.names == ["name", "score"]
+        assert preview.identities == ["name", "score"]
+        assert preview.types == ["string", "integer"]
+        assert preview.rows == [["tom", "123"], ["lucy", "456"]]
+        assert not preview.is_truncated
+
+        # Only a prefix of the file is parsed, without any incomplete line.
+        monkeypatch.setattr(source.csv_utils, "PREVIEW_SIZE", 24)
+        preview = preview_csv_file(csv_file.name)
+        assert preview.rows == [["tom", "123"]]
+        assert preview.is_truncated
+
+
+def test_preview_empty_csv_file():
+    with tempfile.NamedTemporaryFile() as csv_file:
+        preview = preview_csv_file(csv_file.name)
+        assert preview.names == []
+        assert preview.rows == []
+        assert not preview.is_truncated
+
+        # A header without any rows still gives the columns.
+        csv_file.write(b"name,score\n")
+        csv_file.flush()
+        preview = preview_csv_file(csv_file.name)
+        assert preview.names == ["name", "score"]
+        assert preview.identities == ["name", "score"]
+        assert preview.rows == []
@@ -0,0 +1,62 @@
+from source import importer
+from source.csv_utils import Normalization
+import pytest
+import tempfile
+
+
+@pytest.mark.asyncio
+async def test_map_chunks(monkeypatch):
+    monkeypatch.setattr(importer, "CHUNK_SIZE", 2)
+    monkeypatch.setattr(importer, "process_pool_size", 3)
+
+    rows = iter([["a"], ["b"], ["c"], ["d"], ["e"]])
+    results = [item async for item in importer.map_chunks(len, rows)]
+    assert results == [(2, 2), (2, 2), (1, 1)]
+
+    # Any chunks still in flight are cancelled if the caller stops early.
+    rows = iter([["a"], ["b"], ["c"], ["d"], ["e"]])
+    chunks = importer.map_chunks(len, rows)
+    assert await chunks.__anext__() == (2, 2)
+    await chunks.aclose()
+
+
+@pytest.mark.asyncio
+async def test_map_csv_blocks(monkeypatch):
+    monkeypatch.setattr(importer, "process_pool_size", 3)
+    normalization = Normalization(length=1, keep_columns=None)
+    blocks = ["name\na\nb\n", "c\n", "d\ne\n"]
+
+    results = [
+        item
+        async for item in importer.map_csv_blocks(len, iter(blocks), normalization, 1)
+    ]
+    assert results == [(2, 2), (1, 1), (2, 2)]
+
+    # Skipped rows may span several blocks.
+    results = [
+        item
+        async for item in importer.map_csv_blocks(list, iter(blocks), normalization, 4)
+    ]
+    assert results == [(2, [["d"], ["e"]])]
+
+    # Any blocks still in flight are cancelled if the caller stops early.
+    chunks = importer.map_csv_blocks(len, iter(blocks), normalization, 0)
+    assert await chunks.__anext__() == (3, 3)
+    await chunks.aclose()
+
+
+def test_preview_upload():
+    # Previews normally run in the process pool, so call them directly here.
+    with tempfile.NamedTemporaryFile() as upload_file:
+        upload_file.write(b"name,score\ntom,123\n")
+        upload_file.flush()
+        preview = importer.preview_upload(upload_file.name)
+        assert preview.names == ["name", "score"]
+        assert preview.rows == [["tom", "123"]]
+
+    with tempfile.NamedTemporaryFile() as upload_file:
+        upload_file.write(b'[{"name": "tom", "score": 123}]')
+        upload_file.flush()
+        preview = importer.preview_upload(upload_file.name)
+        assert preview.names == ["name", "score"]
+        assert preview.rows == [["tom", "123"]]
@@ -0,0 +1,134 @@
+from source import jobs, settings
+import asyncio
+import datetime
+import pytest
+
+
+async def create_job(**values):
+    job = await jobs.enqueue("import", table=1, params={"path": "/does-not-exist"})
+    if values:
+        await job.update(**values)
+    return job
+
+
+@pytest.mark.asyncio
+async def test_claim_job(client):
+    first = await create_job()
+    second = await create_job()
+
+    claimed = await jobs.claim_job(pk=second.pk)
+    assert claimed.pk == second.pk
+    assert claimed.status == "running"
+    assert claimed.started_at is not None
+
+    # Jobs that are not pending can't be claimed.
+    assert await jobs.claim_job(pk=second.pk) is None
+
+    # Otherwise we claim the oldest pending job.
+    claimed = await jobs.claim_job()
+    assert claimed.pk == first.pk
+    assert await jobs.claim_job() is None
+
+
+@pytest.mark.asyncio
+async def test_unknown_job_kind(client):
+    job = await create_job(kind="does-not-exist")
+    assert await jobs.run_pending_jobs() == 1
+
+    job = await jobs.load_job_or_404(table_pk=1, job_pk=job.pk)
+    assert job.status == "failed"
+    assert job.errors == ["'does-not-exist'"]
+
+
+@pytest.mark.asyncio
+async def test_progress(client):
+    job = await create_job()
+    assert job.percent_complete == 0
+    assert job.eta is None
+
+    started_at = datetime.datetime.now() - datetime.timedelta(seconds=10)
+    await job.update(
+        status="running", started_at=started_at, rows_processed=250, rows_total=1000
+    )
+    assert job.percent_complete == 25
+    assert 29 <= job.eta <= 31
+
+    await job.update(status="complete", rows_processed=1000)
+    assert job.percent_complete == 100
+    assert job.eta is None
+
+
+@pytest.mark.asyncio
+async def test_database_queue(client):
+    queue = jobs.DatabaseQueue(poll_interval=0)
+    assert await queue.get() is None
+
+    job = await create_job()
+    await queue.put(job.pk)
+    claimed = await queue.get()
+    assert claimed.pk == job.pk
+
+
+@pytest.mark.asyncio
+async def test_startup_and_shutdown(client, monkeypatch):
+    monkeypatch.setattr(settings, "RUN_WORKER", True)
+    await jobs.startup()
+    assert jobs.worker_task is not None
+    await jobs.shutdown()
+    assert jobs.worker_task is None
+
+
+@pytest.mark.asyncio
+async def test_stale_jobs(client, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_STALE_TIMEOUT", 60)
+    job = await create_job()
+    assert (await jobs.claim_job()).pk == job.pk
+    assert await jobs.claim_job() is None
+
+    # A running job is claimed again once its heartbeat is stale.
+    updated_at = datetime.datetime.now() - datetime.timedelta(seconds=61)
+    await job.update(updated_at=updated_at)
+    claimed = await jobs.claim_job()
+    assert claimed.pk == job.pk
+    assert claimed.updated_at > updated_at
+
+
+@pytest.mark.asyncio
+async def test_heartbeat(client, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_HEARTBEAT_INTERVAL", 0.01)
+
+    async def handler(job):
+        await asyncio.sleep(0.1)
+        # Stop the heartbeat before the job completes, since tests share a
+        # single connection, which can't run both queries at once.
+        monkeypatch.setattr(settings, "JOB_HEARTBEAT_INTERVAL", 60)
+        await asyncio.sleep(0.1)
+
+    monkeypatch.setitem(jobs.HANDLERS, "slow", handler)
+    job = await create_job(kind="slow")
+    assert await jobs.run_pending_jobs() == 1
+    job = await jobs.load_job_or_404(table_pk=1, job_pk=job.pk)
+    assert job.status == "complete"
+    assert job.updated_at > job.started_at
+
+
+@pytest.mark.asyncio
+async def test_interrupted_job(client, monkeypatch):
+    started = asyncio.Event()
+
+    async def handler(job):
+        started.set()
+        await asyncio.sleep(60)
+
+    monkeypatch.setitem(jobs.HANDLERS, "slow", handler)
+    job = await create_job(kind="slow")
+
+    # A job that is interrupted, such as when the worker shuts down, is put
+    # back to be run again.
+    task = asyncio.ensure_future(jobs.run_pending_jobs())
+    await started.wait()
+    task.cancel()
+    await asyncio.wait([task])
+    job = await jobs.load_job_or_404(table_pk=1, job_pk=job.pk)
+    assert job.status == "pending"
+    assert (await jobs.claim_job()).pk == job.pk
@@ -0,0 +1,163 @@
+from source.csv_utils import TableLayout
+from source.json_utils import (
+    determine_record_types,
+    is_json_file,
+    iter_json_records,
+    merge_record_types,
+    preview_json_file,
+    validate_records,
+)
+import io
+import pytest
+import source.json_utils
+import tempfile
+
+
+RECORDS = [
+    {"name": "tom", "score": 123, "member": True, "tags": ["a"]},
+    {"name": "lucy", "score": 4.5, "joined": "2020-01-31", "tags": None},
+    {"name": "", "score": None, "member": False, "joined": ""},
+]
+
+
+def test_is_json_file():
+    assert is_json_file(io.BytesIO(b'  [{"a": 1}]'))
+    assert is_json_file(io.BytesIO(b'\xef\xbb\xbf{"a": 1}\n{"a": 2}\n'))
+    assert not is_json_file(io.BytesIO(b"name,score\ntom,123\n"))
+    assert not is_json_file(io.BytesIO(b""))
+
+
+@pytest.mark.parametrize("read_size", [1, 3, 7, 64 * 1024])
+def test_iter_json_array(monkeypatch, read_size):
+    """
+    Arrays are parsed incrementally, including values that are split
+    across several reads.
+    """
+    monkeypatch.setattr(source.json_utils, "READ_SIZE", read_size)
+    text = '\ufeff [\n  {"name": "tom", "score": 123},\n  {"name": "l\\u00fccy", "score": 45.5} ]'
+    input_file = io.BytesIO(text.encode("utf-8"))
+    assert list(iter_json_records(input_file)) == [
+        {"name": "tom", "score": 123},
+        {"name": "lücy", "score": 45.5},
+    ]
+
+    assert list(iter_json_records(io.BytesIO(b"[ ]"))) == []
+
+
+@pytest.mark.parametrize(
+    "text", [b'[{"a": 1} {"a": 2}]', b'[{"a": 1},', b'[{"a": 1}, {"a"}]', b"[1]"]
+)
+def test_iter_json_array_invalid(text):
+    with pytest.raises(ValueError):
+        list(iter_json_records(io.BytesIO(text)))
+
+
+def test_iter_json_array_invalid_early():
+    """
+    An invalid value is reported without reading the rest of the file.
+    """
+
+    class CountingBytesIO(io.BytesIO):
+        reads = 0
+
+        def read1(self, *args):
+            self.reads += 1
+            return super().read1(*args)
+
+    records = ['{"name": "tom"}', '{"name": tru}'] + ['{"name": "lucy"}'] * 100000
+    input_file = CountingBytesIO(("[" + ",".join(records) + "]").encode("utf-8"))
+    with pytest.raises(ValueError):
+        list(iter_json_records(input_file))
+    assert input_file.reads < 10
+
+
+def test_iter_ndjson():
+    input_file = io.BytesIO(b'{"name": "tom"}\n\n{"name": "lucy", "score": 1}\n')
+    assert list(iter_json_records(input_file)) == [
+        {"name": "tom"},
+        {"name": "lucy", "score": 1},
+    ]
+
+    assert list(iter_json_records(io.BytesIO(b""))) == []
+
+    with pytest.raises(ValueError):
+        list(iter_json_records(io.BytesIO(b'{"name": "tom"}\n"lucy"\n')))
+
+
+def test_determine_record_types():
+    names, column_types = determine_record_types(RECORDS)
+    assert names == ["name", "score", "member", "tags", "joined"]
+    assert column_types == ["string", "float", "boolean", "string", "date"]
+
+    assert determine_record_types([]) == ([], [])
+
+
+def test_merge_record_types():
+    names, column_types = merge_record_types(
+        ["name", "score"], ["string", "integer"], ["score", "joined"], ["float", None]
+    )
+    assert names == ["name", "score", "joined"]
+    assert column_types == ["string", "float", None]
+
+
+def test_validate_records():
+    layout = TableLayout(
+        names=["name", "score", "member", "tags", "joined"],
+        identities=["name", "score", "member", "tags", "joined"],
+        types=["string", "float", "boolean", "string", "date"],
+        row_count=3,
+    )
+    records = RECORDS + [{"name": "rose", "score": "high"}]
+    data, search_texts, errors = validate_records(layout, records)
+    assert data == [
+        {
+            "name": "tom",
+            "score": 123.0,
+            "member": True,
+            "tags": '["a"]',
+            "joined": None,
+        },
+        {
+            "name": "lucy",
+            "score": 4.5,
+            "member": None,
+            "tags": "",
+            "joined": "2020-01-31",
+        },
+        {"name": "", "score": None, "member": False, "tags": "", "joined": None},
+    ]
+    assert search_texts == [
+        'tom 123 true ["a"] ',
+        "lucy 4.5   2020-01-31",
+        "  false  ",
+    ]
+    assert errors == [(3, "score: Must be a number.")]
+
+
+def test_preview_json_file(monkeypatch):
+    monkeypatch.setattr(source.json_utils, "PREVIEW_RECORDS", 2)
+    with tempfile.NamedTemporaryFile() as json_file:
+        json_file.write(b'{"name": "tom", "score": 123}\n{"name": "lucy"}\n')
+        json_file.flush()
+        preview = preview_json_file(json_file.name)
+
+        assert preview.names == ["name", "score"]
+        assert preview.identities == ["name", "score"]
+        assert preview.types == ["string", "integer"]
+        assert preview.rows == [["tom", "123"], ["lucy", ""]]
+        assert not preview.is_truncated
+
+        # Only the first few objects are parsed.
+        json_file.write(b'{"name": "rose", "score": 1.5}\n')
+        json_file.flush()
+        preview = preview_json_file(json_file.name)
+        assert preview.types == ["string", "integer"]
+        assert preview.is_truncated
+
+    # Invalid JSON is only reported once the file is imported.
+    with tempfile.NamedTemporaryFile() as json_file:
+        json_file.write(b'[{"name": "tom"}, {"name": ')
+        json_file.flush()
+        preview = preview_json_file(json_file.name)
+        assert preview.rows == [["tom"]]
+        assert preview.is_truncated
@@ -0,0 +1,195 @@
+from source import settings
+from source.middleware import DatabaseMiddleware
+from source.replicas import ReplicatedDatabase
+from source.resources import gather_queries, run_single_flight
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from tests.client import TestClient
+import pytest
+
+
+# The application's database is configured with `force_rollback`, which runs
+# everything in a single transaction, so use a separate instance here.
+database = ReplicatedDatabase(settings.TEST_DATABASE_URL)
+
+
+async def transaction_info(request):
+    query = "SELECT pg_backend_pid() AS pid"
+    first_pid = await database.fetch_val(query, column="pid")
+    second_pid = await database.fetch_val(query, column="pid")
+    isolation = await database.fetch_one("SHOW transaction_isolation")
+    read_only = await database.fetch_one("SHOW transaction_read_only")
+    return JSONResponse(
+        {
+            "same_connection": first_pid == second_pid,
+            "isolation": isolation["transaction_isolation"],
+            "read_only": read_only["transaction_read_only"],
+        }
+    )
+
+
+async def batch_info(request):
+    query = """
+        SELECT
+            pg_backend_pid() AS pid,
+            txid_current_snapshot()::text AS snapshot,
+            current_setting('transaction_read_only') AS read_only
+    """
+    results = await gather_queries(
+        *[lambda: database.fetch_one(query) for _ in range(4)], database=database
+    )
+    return JSONResponse(
+        {
+            "connections": len({result["pid"] for result in results}),
+            "snapshots": len({result["snapshot"] for result in results}),
+            "read_only": [result["read_only"] for result in results],
+        }
+    )
+
+
+async def flight_info(request):
+    query = """
+        SELECT
+            pg_backend_pid() AS pid,
+            txid_current_snapshot()::text AS snapshot,
+            current_setting('transaction_isolation') AS isolation
+    """
+    request_result = await database.fetch_one(query)
+    results = await run_single_flight(
+        ("flight", request.method),
+        lambda: gather_queries(
+            *[lambda: database.fetch_one(query) for _ in range(2)], database=database
+        ),
+        database=database,
+    )
+    return JSONResponse(
+        {
+            "request_connection": request_result["pid"] in {r["pid"] for r in results},
+            "snapshots": len(
+                {request_result["snapshot"]} | {r["snapshot"] for r in results}
+            ),
+            "isolation": [result["isolation"] for result in results],
+        }
+    )
+
+
+app = Starlette(
+    routes=[
+        Route("/", transaction_info, methods=["GET", "POST"]),
+        Route("/excluded/", transaction_info),
+        Route("/uploads/{index:int}", transaction_info),
+        Route("/batch/", batch_info, methods=["GET", "POST"]),
+        Route("/flight/", flight_info, methods=["GET", "POST"]),
+    ],
+    middleware=[
+        Middleware(
+            DatabaseMiddleware,
+            database=database,
+            exclude_paths=["/excluded/"],
+            exclude_patterns=[r"/uploads/\d+"],
+        )
+    ],
+)
+
+
+@pytest.fixture()
+async def client():
+    await database.connect()
+    try:
+        yield TestClient(app=app)
+    finally:
+        await database.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_read_only_snapshot(client):
+    response = await client.get("/")
+    assert response.json() == {
+        "same_connection": True,
+        "isolation": "repeatable read",
+        "read_only": "on",
+    }
+
+
+@pytest.mark.asyncio
+async def test_write_requests(client):
+    response = await client.post("/")
+    assert response.json() == {
+        "same_connection": True,
+        "isolation": "read committed",
+        "read_only": "off",
+    }
+
+
+@pytest.mark.asyncio
+async def test_excluded_paths(client):
+    response = await client.get("/excluded/")
+    assert response.json()["read_only"] == "off"
+
+    response = await client.get("/uploads/1")
+    assert response.json()["read_only"] == "off"
+
+
+@pytest.mark.asyncio
+async def test_batched_queries(client):
+    response = await client.get("/batch/")
+    assert response.json() == {
+        "connections": 4,
+        "snapshots": 1,
+        "read_only": ["on", "on", "on", "on"],
+    }
+
+    response = await client.post("/batch/")
+    assert response.json()["connections"] == 4
+    assert response.json()["read_only"] == ["off", "off", "off", "off"]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_snapshot(client):
+    # Shared queries run on spare connections, within the request's snapshot.
+    response = await client.get("/flight/")
+    assert response.json() == {
+        "request_connection": False,
+        "snapshots": 1,
+        "isolation": ["repeatable read", "repeatable read"],
+    }
+
+    response = await client.post("/flight/")
+    assert response.json()["request_connection"] is False
+    assert response.json()["isolation"] == ["read committed", "read committed"]
+
+
+@pytest.mark.asyncio
+async def test_batched_queries_without_spare_connections():
+    single_database = ReplicatedDatabase(
+        settings.TEST_DATABASE_URL, min_size=1, max_size=1
+    )
+    query = "SELECT pg_backend_pid() AS pid"
+    await single_database.connect()
+    try:
+        results = await gather_queries(
+            lambda: single_database.fetch_val(query, column="pid"),
+            lambda: single_database.fetch_val(query, column="pid"),
+            database=single_database,
+        )
+    finally:
+        await single_database.disconnect()
+    assert results[0] == results[1]
+
+
+@pytest.mark.asyncio
+async def test_batched_queries_results(client):
+    async def fetch(value):
+        if value is None:
+            raise ValueError()
+        return value
+
+    results = await gather_queries(
+        *[lambda value=value: fetch(value) for value in range(5)], database=database
+    )
+    assert results == [0, 1, 2, 3, 4]
+
+    with pytest.raises(ValueError):
+        await gather_queries(lambda: fetch(1), lambda: fetch(None), database=database)
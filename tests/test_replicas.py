@@ -0,0 +1,169 @@
+from source import settings
+from source.middleware import DatabaseMiddleware
+from source.replicas import ReplicatedDatabase
+from source.resources import gather_queries, run_single_flight
+from sqlalchemy_utils import create_database, drop_database
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from tests.client import TestClient
+import asyncio
+import pytest
+
+
+# A second local database stands in for a read replica. Reads are routed
+# by database, so it doesn't need the tables or data of the primary.
+PRIMARY_URL = settings.TEST_DATABASE_URL
+REPLICA_URL = PRIMARY_URL.replace(database=PRIMARY_URL.database + "_replica")
+MISSING_URL = PRIMARY_URL.replace(database=PRIMARY_URL.database + "_missing")
+
+DATABASE_NAME_QUERY = "SELECT current_database() AS name"
+BACKEND_QUERY = "SELECT current_database() AS name, pg_backend_pid() AS pid"
+
+
+@pytest.fixture(scope="module", autouse=True)
+def create_replica_database():
+    create_database(str(REPLICA_URL))
+    yield
+    drop_database(str(REPLICA_URL))
+
+
+def create_app(database, write_window):
+    async def database_name(request):
+        record = await database.fetch_one(DATABASE_NAME_QUERY)
+        return JSONResponse(record["name"])
+
+    async def database_names(request):
+        records = await gather_queries(
+            *[lambda: database.fetch_one(DATABASE_NAME_QUERY) for _ in range(3)],
+            database=database,
+        )
+        return JSONResponse([record["name"] for record in records])
+
+    async def flight_backends(request):
+        async def fetch_backend():
+            record = await database.fetch_one(BACKEND_QUERY)
+            return [record["name"], record["pid"]]
+
+        request_backend = await fetch_backend()
+        flight_backend = await run_single_flight(
+            ("backend", request.url.path), fetch_backend, database=database
+        )
+        return JSONResponse([request_backend, flight_backend])
+
+    return Starlette(
+        routes=[
+            Route("/", database_name, methods=["GET", "POST"]),
+            Route("/batch/", database_names),
+            Route("/flight/", flight_backends),
+        ],
+        middleware=[
+            Middleware(SessionMiddleware, secret_key="TESTING"),
+            Middleware(
+                DatabaseMiddleware, database=database, write_window=write_window
+            ),
+        ],
+    )
+
+
+@pytest.fixture()
+async def connect():
+    databases = []
+
+    async def connect(replica_urls, retry_interval=10, write_window=5, **options):
+        database = ReplicatedDatabase(
+            PRIMARY_URL,
+            replica_urls=replica_urls,
+            retry_interval=retry_interval,
+            **options,
+        )
+        await database.connect()
+        databases.append(database)
+        return database, TestClient(app=create_app(database, write_window))
+
+    try:
+        yield connect
+    finally:
+        for database in databases:
+            await database.disconnect()
+
+
+async def get_database_names(client, count):
+    return [(await client.get("/")).json() for _ in range(count)]
+
+
+@pytest.mark.asyncio
+async def test_replica_round_robin(connect):
+    # The primary also stands in for a second replica.
+    database, client = await connect([REPLICA_URL, PRIMARY_URL])
+    assert await get_database_names(client, 3) == [
+        REPLICA_URL.database,
+        PRIMARY_URL.database,
+        REPLICA_URL.database,
+    ]
+
+    # Batched queries all read from the same replica.
+    response = await client.get("/batch/")
+    assert response.json() == [PRIMARY_URL.database] * 3
+
+
+@pytest.mark.asyncio
+async def test_single_flight_connections(connect):
+    # Shared queries run on a connection of their own, on the same replica.
+    database, client = await connect([REPLICA_URL])
+    response = await client.get("/flight/")
+    request_backend, flight_backend = response.json()
+    assert request_backend[0] == flight_backend[0] == REPLICA_URL.database
+    assert request_backend[1] != flight_backend[1]
+
+    # Without a spare connection they run on the request's connection.
+    database, client = await connect([], min_size=1, max_size=1)
+    response = await client.get("/flight/")
+    request_backend, flight_backend = response.json()
+    assert request_backend == flight_backend
+
+
+@pytest.mark.asyncio
+async def test_read_your_writes(connect):
+    database, client = await connect([REPLICA_URL], write_window=0.2)
+
+    response = await client.post("/")
+    assert response.json() == PRIMARY_URL.database
+
+    # The session reads from the primary until the window has passed.
+    assert await get_database_names(client, 2) == [PRIMARY_URL.database] * 2
+    await asyncio.sleep(0.2)
+    assert await get_database_names(client, 2) == [REPLICA_URL.database] * 2
+
+
+@pytest.mark.asyncio
+async def test_unavailable_replicas(connect):
+    database, client = await connect([MISSING_URL, REPLICA_URL], retry_interval=0)
+    assert await get_database_names(client, 2) == [REPLICA_URL.database] * 2
+
+    database, client = await connect([MISSING_URL])
+    assert await get_database_names(client, 2) == [PRIMARY_URL.database] * 2
+
+
+@pytest.mark.asyncio
+async def test_replica_failure(connect):
+    database, client = await connect([REPLICA_URL])
+    assert await get_database_names(client, 1) == [REPLICA_URL.database]
+
+    # Stop the replica from accepting connections, and close its existing
+    # ones, so that requests fail to start reading from it, and fall back to
+    # the primary.
+    name = REPLICA_URL.database
+    await database.execute(f"ALTER DATABASE {name} ALLOW_CONNECTIONS false")
+    query = (
+        "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = :name"
+    )
+    await database.fetch_all(query, values={"name": name})
+    assert await get_database_names(client, 2) == [PRIMARY_URL.database] * 2
+
+    # Once the retry interval has passed, the replica is checked again.
+    await database.execute(f"ALTER DATABASE {name} ALLOW_CONNECTIONS true")
+    database.retry_interval = 0
+    assert await get_database_names(client, 1) == [REPLICA_URL.database]
@@ -0,0 +1,101 @@
+from source import settings
+from source.response_cache import MemoryBackend, ResponseCache
+from starlette.responses import JSONResponse, Response
+import asyncio
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_response_cache(monkeypatch):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_TTL", 60)
+    cache = ResponseCache(MemoryBackend())
+    await cache.connect()
+    rendered = []
+
+    async def render():
+        rendered.append(True)
+        return JSONResponse({"count": len(rendered)}, headers={"ETag": '"1-abc"'})
+
+    response = await cache.fetch(1, '"1-abc"', render)
+    assert response.body == b'{"count":1}'
+
+    response = await cache.fetch(1, '"1-abc"', render)
+    assert response.body == b'{"count":1}'
+    assert response.headers["ETag"] == '"1-abc"'
+    assert response.headers["Content-Type"] == "application/json"
+    assert len(rendered) == 1
+
+    # Responses are cached separately for each table and ETag, and are
+    # dropped once the table changes.
+    response = await cache.fetch(2, '"1-abc"', render)
+    assert response.body == b'{"count":2}'
+    await cache.invalidate(1)
+    response = await cache.fetch(1, '"1-abc"', render)
+    assert response.body == b'{"count":3}'
+    await cache.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_response_cache_disabled(monkeypatch):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_TTL", 0)
+    cache = ResponseCache(MemoryBackend())
+
+    async def render():
+        return Response("content")
+
+    await cache.fetch(1, '"1-abc"', render)
+    assert cache.backend.values == {}
+
+
+@pytest.mark.asyncio
+async def test_response_cache_stampede(monkeypatch):
+    """
+    Concurrent requests for the same response wait for a single render.
+    """
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_TTL", 60)
+    cache = ResponseCache(MemoryBackend())
+    rendered = []
+
+    async def render():
+        rendered.append(True)
+        await asyncio.sleep(0.1)
+        return Response("content")
+
+    responses = await asyncio.gather(
+        *[cache.fetch(1, '"1-abc"', render) for _ in range(5)]
+    )
+    assert [response.body for response in responses] == [b"content"] * 5
+    assert len(rendered) == 1
+
+
+@pytest.mark.asyncio
+async def test_response_cache_errors(monkeypatch):
+    """
+    Unsuccessful responses aren't cached, and any waiting requests render
+    the response themselves instead.
+    """
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_TTL", 60)
+    cache = ResponseCache(MemoryBackend())
+    rendered = []
+
+    async def render():
+        rendered.append(True)
+        await asyncio.sleep(0.1)
+        return Response("error", status_code=500)
+
+    responses = await asyncio.gather(
+        *[cache.fetch(1, '"1-abc"', render) for _ in range(3)]
+    )
+    assert [response.status_code for response in responses] == [500] * 3
+    assert len(rendered) == 3
+
+
+@pytest.mark.asyncio
+async def test_memory_backend_expiry():
+    backend = MemoryBackend()
+    assert await backend.set("key", "value", ttl=60)
+    assert not await backend.set("key", "other", ttl=60, only_if_missing=True)
+    assert await backend.get("key") == "value"
+
+    assert await backend.set("key", "value", ttl=0)
+    assert await backend.get("key") is None
@@ -0,0 +1,49 @@
+from databases.core import Connection
+from source import tables
+from source.resources import database
+from source.statements import Statement, dialect
+from sqlalchemy.sql import bindparam
+import asyncio
+import pytest
+
+
+STATEMENT = Statement(
+    tables.users.select()
+    .where(tables.users.c.username == bindparam("username"))
+    .where(tables.users.c.is_admin == bindparam("is_admin"))
+)
+
+
+def test_private_attributes():
+    """
+    `Statement` uses these private attributes, so check that they are still
+    provided by the installed versions of SQLAlchemy and `databases`.
+    """
+    query = tables.users.select().where(tables.users.c.pk == bindparam("pk"))
+    compiled = query.compile(dialect=dialect)
+    assert isinstance(compiled._bind_processors, dict)
+    assert isinstance(compiled._result_columns, list)
+
+    connection = Connection(database._backend)
+    assert isinstance(connection._query_lock, asyncio.Lock)
+
+
+def test_statement_parameters():
+    assert STATEMENT.names == ["is_admin", "username"]
+    assert "$1" in STATEMENT.sql and "$2" in STATEMENT.sql
+    assert STATEMENT.get_args({"username": "tomchristie", "is_admin": False}) == [
+        False,
+        "tomchristie",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_statement_queries(client):
+    query = "SELECT count(*) AS prepared FROM pg_prepared_statements"
+    prepared = await database.fetch_val(query, column="prepared")
+
+    assert await STATEMENT.fetch_one(username="missing", is_admin=False) is None
+    assert await STATEMENT.fetch_all(username="missing", is_admin=False) == []
+
+    # Each connection prepares the statement only once.
+    assert await database.fetch_val(query, column="prepared") == prepared + 1
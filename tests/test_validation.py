@@ -0,0 +1,91 @@
+from source.datasource import StoredDate
+from source.validation import RowValidator
+import datetime
+import pytest
+import typesystem
+
+
+class ExampleSchema(typesystem.Schema):
+    name = typesystem.String(max_length=10)
+    notes = typesystem.String(allow_blank=True)
+    nickname = typesystem.String(allow_null=True)
+    score = typesystem.Integer()
+    rank = typesystem.Integer(allow_null=True)
+    height = typesystem.Float(allow_null=True)
+    member = typesystem.Boolean()
+    admin = typesystem.Boolean(allow_null=True)
+    joined = StoredDate(allow_null=True)
+    code = typesystem.String(pattern="^[A-Z]+$", default="X")
+    level = typesystem.Integer(minimum=1, allow_null=True)
+
+
+VALID = {
+    "name": "tom",
+    "notes": "",
+    "nickname": "",
+    "score": "123",
+    "rank": "",
+    "height": "1.8",
+    "member": "true",
+    "admin": "",
+    "joined": "2020-02-29",
+    "code": "ABC",
+    "level": "2",
+}
+
+CASES = [
+    {},
+    {"name": None, "notes": None, "nickname": None},
+    {"name": "  padded\0 ", "notes": "  "},
+    {"name": "much too long", "nickname": 123},
+    {"name": ""},
+    {"score": "1.0", "rank": "1e3", "height": ".5e-3"},
+    {"score": "1.5", "rank": 2.0, "height": 3},
+    {"score": 1.5, "rank": None, "height": None},
+    {"score": "abc", "rank": "nan", "height": "inf"},
+    {"score": None, "rank": True, "height": [1]},
+    {"score": " 12 ", "rank": "1_000", "height": "-0"},
+    {"member": "FALSE", "admin": "none"},
+    {"member": "on", "admin": "0"},
+    {"member": None, "admin": None},
+    {"member": "yes", "admin": 1},
+    {"member": True, "admin": 2},
+    {"joined": "2020-1-5"},
+    {"joined": "2020-02-30"},
+    {"joined": "31/01/2020"},
+    {"joined": datetime.date(2020, 1, 31)},
+    {"joined": ""},
+    {"code": "abc", "level": "0"},
+    {"code": None, "level": None},
+]
+
+
+@pytest.mark.parametrize("changes", CASES)
+def test_row_validator(changes):
+    """
+    Compiled validators should behave exactly as `typesystem` itself does.
+    """
+    data = dict(VALID)
+    data.update(changes)
+
+    record, expected_error = ExampleSchema.validate_or_error(data)
+    value, error = RowValidator(ExampleSchema).validate_or_error(data)
+
+    if expected_error:
+        assert value is None
+        assert error.messages() == expected_error.messages()
+        assert dict(error) == dict(expected_error)
+    else:
+        assert error is None
+        assert value == dict(record)
+
+
+def test_row_validator_missing_fields():
+    record, expected_error = ExampleSchema.validate_or_error({"notes": "x"})
+    value, error = RowValidator(ExampleSchema).validate_or_error({"notes": "x"})
+    assert error.messages() == expected_error.messages()
+
+    data = {key: value for key, value in VALID.items() if key not in ("code", "rank")}
+    record, expected_error = ExampleSchema.validate_or_error(data)
+    value, error = RowValidator(ExampleSchema).validate_or_error(data)
+    assert value == dict(record)